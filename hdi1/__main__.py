@@ -1,16 +1,32 @@
 from .nf4 import *
+from .manifest import load_manifest, run_manifest
+from .vae_decode import VAE_DECODE_MODES
+from .latents import LATENT_STORAGE_FORMATS, load_latents, save_latents
+from .noise import NoiseCache
+from .tracing import TRACE_FORMATS, Tracer, get_tracer, set_tracer
 
 import argparse
+import os
 import time
 import logging
 
 
+def save_trace(path, format):
+    tracer = get_tracer()
+    if tracer is None:
+        return
+    tracer.save(path, format)
+    for name, stats in tracer.summary().items():
+        print(f"  {name:<16} {stats['count']:>5} x {stats['mean_ms']:9.2f} ms = {stats['total_ms']:10.2f} ms")
+    print(f"Trace saved to {path}")
+
+
 if __name__ == "__main__":
     logging.getLogger("transformers.modeling_utils").setLevel(logging.ERROR)
     
     parser = argparse.ArgumentParser()
     
-    parser.add_argument("prompt", type=str, help="Prompt to generate image from")
+    parser.add_argument("prompt", type=str, nargs="?", help="Prompt to generate image from")
     
     parser.add_argument("-m", "--model", type=str, default="dev",
                         help="Model to use",
@@ -25,19 +41,126 @@ if __name__ == "__main__":
     
     parser.add_argument("-o", "--output", type=str, default="output.png")
     
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="JSONL or CSV file with prompt, seed, resolution and output columns; "
+                             "loads the model once and skips rows whose output already exists")
+    
+    parser.add_argument("--batch-size", type=int, default=4,
+                        help="Prompts per pipeline call in --manifest mode")
+    
+    parser.add_argument("--output-dir", type=str, default="outputs",
+                        help="Where --manifest rows without an output path are written")
+    
+    parser.add_argument("--offload", type=str, default="sequential",
+                        help="Offload strategy for the transformer",
+                        choices=OFFLOAD_MODES)
+    
+    parser.add_argument("--prefetch-depth", type=int, default=1,
+                        help="Number of transformer blocks to prefetch when --offload stream is used")
+    
+    parser.add_argument("--text-encoder-quant", type=str, default="bf16",
+                        help="Quantization of the Llama text encoder",
+                        choices=TEXT_ENCODER_QUANT_OPTIONS)
+    
+    parser.add_argument("--text-encoder-device", type=str, default="auto",
+                        help="Keep the Llama text encoder on the CPU or let it follow the pipeline offload",
+                        choices=TEXT_ENCODER_DEVICE_OPTIONS)
+    
+    parser.add_argument("--encoder-process", type=str, default=None,
+                        help="Run the text encoders in a worker process on this device (e.g. cpu, cuda:1)")
+    
+    parser.add_argument("--vae-decode", type=str, default="auto",
+                        help="VAE decode strategy; auto picks full, sliced or tiled decode from the free memory",
+                        choices=VAE_DECODE_MODES)
+    
+    parser.add_argument("--save-latents", type=str, default=None,
+                        help="Also save the denoised latents to this .safetensors file for re-decoding")
+    
+    parser.add_argument("--latent-storage", type=str, default="bf16",
+                        help="Precision of --save-latents files",
+                        choices=LATENT_STORAGE_FORMATS)
+    
+    parser.add_argument("--decode-latents", type=str, default=None,
+                        help="Decode a --save-latents file to --output with only the VAE loaded, then exit")
+    
+    parser.add_argument("--noise-cache-mb", type=int, default=0,
+                        help="With --manifest, cache the noise of repeated seeds in this many MiB (results are identical)")
+    
+    parser.add_argument("--trace", type=str, default=None,
+                        help="Record per-stage latency spans and save them to this file")
+    
+    parser.add_argument("--trace-format", type=str, default="json",
+                        help="Format of --trace; chrome opens in chrome://tracing or Perfetto",
+                        choices=TRACE_FORMATS)
+    
+    parser.add_argument("--check-text-encoder", action="store_true",
+                        help="Compare the quantized text encoder embeddings against bf16 and exit")
+    
     args = parser.parse_args()
     model_type = args.model
     
+    if args.check_text_encoder:
+        report = check_text_encoder_quality(args.text_encoder_quant, args.text_encoder_device)
+        raise SystemExit(0 if report["passed"] else 1)
+    
+    if args.decode_latents is not None:
+        batch = load_latents(args.decode_latents)
+        vae = load_vae(model_type)
+        images = decode_latents(vae, batch, mode=args.vae_decode)
+        root, ext = os.path.splitext(args.output)
+        for i, (image, meta) in enumerate(zip(images, batch.metadata)):
+            path = args.output if len(images) == 1 else f"{root}_{i}{ext}"
+            image.save(path)
+            print(f"Decoded {path} (seed {meta.get('seed')})")
+        raise SystemExit(0)
+    
+    if args.prompt is None and args.manifest is None:
+        parser.error("the following arguments are required: prompt")
+    
+    # Read the manifest before loading the model so a malformed file fails fast
+    if args.manifest is not None:
+        items = load_manifest(args.manifest, default_res=args.res, default_seed=args.seed, output_dir=args.output_dir)
+        if all(os.path.exists(item["output"]) for item in items):
+            print(f"All {len(items)} manifest outputs already exist, nothing to do.")
+            raise SystemExit(0)
+    
     # Initialize with default model
     print(f"Loading model {model_type}...")
-    pipe, _ = load_models(model_type)
+    pipe, _ = load_models(
+        model_type,
+        offload=args.offload,
+        prefetch_depth=args.prefetch_depth,
+        text_encoder_quant=args.text_encoder_quant,
+        text_encoder_device=args.text_encoder_device,
+        encoder_process=args.encoder_process,
+    )
+    pipe.set_vae_decode_mode(args.vae_decode)
     print("Model loaded successfully!")
+    if args.trace is not None:
+        set_tracer(Tracer(sync_cuda=True))
+    
+    if args.manifest is not None:
+        noise_cache = NoiseCache(args.noise_cache_mb * 1024**2) if args.noise_cache_mb > 0 else None
+        summary = run_manifest(pipe, model_type, items, batch_size=args.batch_size, noise_cache=noise_cache)
+        print(f"Generated {summary['generated']} images ({summary['skipped']} skipped) in {summary['elapsed']:.2f} seconds, "
+              f"{summary['images_per_second']:.3f} images/s")
+        if args.trace is not None:
+            save_trace(args.trace, args.trace_format)
+        raise SystemExit(0)
     
     st = time.time()
     
     resolution = tuple(map(int, args.res.strip().split("x")))
-    image, seed = generate_image(pipe, model_type, args.prompt, resolution, args.seed)
+    if args.save_latents is not None:
+        batch, seed = generate_image(pipe, model_type, args.prompt, resolution, args.seed, output_type="latent")
+        save_latents(batch, args.save_latents, storage=args.latent_storage)
+        print(f"Latents saved to {args.save_latents}")
+        image = decode_latents(pipe, batch)[0]
+    else:
+        image, seed = generate_image(pipe, model_type, args.prompt, resolution, args.seed)
     image.save(args.output)
     
     print(f"Image saved to {args.output}, elapsed time: {time.time() - st:.2f} seconds")
     print(f"Seed used: {seed}")
+    if args.trace is not None:
+        save_trace(args.trace, args.trace_format)
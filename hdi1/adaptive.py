@@ -0,0 +1,93 @@
+from typing import Sequence, Union
+
+import torch
+
+
+class AdaptiveStepController:
+    """
+    Ends denoising early for items whose prediction has settled. After every transformer forward it compares each
+    item's predicted clean latents (`denoised`) with those of the previous step; once the relative change
+
+        ||denoised_i - denoised_{i-1}|| / ||denoised_i||
+
+    stays below `tolerance` for `patience` consecutive steps, the item is finished with one large final step, straight
+    to its `denoised` (the Euler step to sigma 0), instead of walking the rest of its schedule.
+
+    Steps are solver steps: a two-stage scheduler (Heun) passes the same `step_index` for both evaluations of a step.
+
+    The controller keeps one row of state per batch item. Rows can be added and removed as a running batch changes,
+    e.g. in the `ContinuousPipelineEngine`, which retires finished rows right away; rows without a previous prediction
+    never finish early. Within one `HiDreamImagePipeline` call finished rows stay in the batch until every row has
+    finished, so that call only runs fewer transformer forwards once the whole batch has settled.
+
+    Args:
+        tolerance (`float`, defaults to 0.01):
+            Relative change of `denoised` below which a step counts as settled.
+        min_steps (`int`, defaults to 4):
+            Steps every item runs before it may finish early.
+        patience (`int`, defaults to 2):
+            Consecutive settled steps needed to finish.
+    """
+
+    def __init__(self, tolerance: float = 0.01, min_steps: int = 4, patience: int = 2):
+        if tolerance <= 0:
+            raise ValueError(f"tolerance must be positive, got {tolerance}")
+        self.tolerance = tolerance
+        self.min_steps = max(min_steps, patience + 1)
+        self.patience = patience
+        self.reset()
+
+    def reset(self):
+        self._previous = None
+        self._streak = None
+
+    def add(self, count: int):
+        """Appends `count` rows without history. Before the first `update` the batch size comes from `denoised`."""
+        if self._previous is None:
+            return
+        empty = self._previous.new_full((count, *self._previous.shape[1:]), float("nan"))
+        self._previous = torch.cat([self._previous, empty])
+        self._streak = torch.cat([self._streak, self._streak.new_zeros(count)])
+
+    def remove(self, rows: Sequence[int]):
+        if self._previous is None:
+            return
+        keep = [i for i in range(len(self._streak)) if i not in set(rows)]
+        if not keep:
+            self.reset()
+            return
+        self._previous = self._previous[keep]
+        self._streak = self._streak[keep]
+
+    @torch.no_grad()
+    def update(
+        self,
+        denoised: torch.Tensor,
+        step_index: Union[int, torch.Tensor],
+        num_inference_steps: Union[int, torch.Tensor],
+    ) -> torch.Tensor:
+        """
+        Records the `denoised` prediction of `step_index` (per row or shared) and returns a boolean mask of the rows to
+        finish now. The final step of a schedule is never reported, as there is nothing left to skip.
+        """
+        denoised = denoised.float()
+        if self._previous is None:
+            self._previous = torch.full_like(denoised, float("nan"))
+            self._streak = torch.zeros(len(denoised), dtype=torch.int64, device=denoised.device)
+        change = (denoised - self._previous).flatten(1).norm(dim=1) / denoised.flatten(1).norm(dim=1).clamp_min(1e-12)
+        # NaN (no previous prediction) compares False
+        self._streak = torch.where(change < self.tolerance, self._streak + 1, torch.zeros_like(self._streak))
+        self._previous = denoised
+
+        step_index = torch.as_tensor(step_index, device=denoised.device)
+        num_inference_steps = torch.as_tensor(num_inference_steps, device=denoised.device)
+        return (
+            (self._streak >= self.patience)
+            & (step_index + 1 >= self.min_steps)
+            & (step_index < num_inference_steps - 1)
+        )
+
+    @staticmethod
+    def skipped_steps(step_index: int, num_inference_steps: int) -> int:
+        """Solver steps saved by finishing at `step_index`, each one transformer forward (two for Heun)."""
+        return num_inference_steps - 1 - step_index
@@ -0,0 +1,368 @@
+import argparse
+import base64
+import json
+import logging
+import os
+import sys
+import threading
+import uuid
+from concurrent.futures import CancelledError, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# Add parent directory to path for direct execution
+if __name__ == "__main__":
+    parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if parent_dir not in sys.path:
+        sys.path.insert(0, parent_dir)
+
+# Handle imports for both direct execution and module import
+try:
+    from .nf4 import *
+    from .batching import MicroBatchScheduler
+    from .continuous import ContinuousBatchScheduler, ContinuousPipelineEngine
+    from .cancellation import GenerationCancelled
+    from .vae_decode import VAE_DECODE_MODES
+    from .image_encoder import DEFAULT_ENCODE_OPTIONS, ImageEncoderPool
+    from .schedulers.registry import load_schedules
+    from .tracing import TRACE_FORMATS, Tracer, get_tracer, set_tracer
+except ImportError:
+    # Fallback for direct execution
+    from hdi1.nf4 import *
+    from hdi1.batching import MicroBatchScheduler
+    from hdi1.continuous import ContinuousBatchScheduler, ContinuousPipelineEngine
+    from hdi1.cancellation import GenerationCancelled
+    from hdi1.vae_decode import VAE_DECODE_MODES
+    from hdi1.image_encoder import DEFAULT_ENCODE_OPTIONS, ImageEncoderPool
+    from hdi1.schedulers.registry import load_schedules
+    from hdi1.tracing import TRACE_FORMATS, Tracer, get_tracer, set_tracer
+
+logger = logging.getLogger(__name__)
+
+API_IMAGE_FORMATS = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+API_RESPONSE_FORMATS = ["base64", "bytes"]
+# Sizes must be whole transformer patches: 8x VAE downsampling times 2x2 patches
+API_RESOLUTION_STRIDE = 16
+# The pipeline rescales every size to the model's native area; beyond this one side shrinks to nothing
+API_MAX_ASPECT_RATIO = 4
+
+
+def parse_api_resolution(resolution):
+    """Accepts `"1024x1024"` or `[1024, 1024]` (width, height)."""
+    try:
+        values = resolution.lower().split("x") if isinstance(resolution, str) else resolution
+        width, height = (int(v) for v in values)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid resolution: {resolution!r}, expected e.g. \"1024x1024\"") from e
+    if width <= 0 or height <= 0:
+        raise ValueError(f"Resolution must be positive, got {width}x{height}")
+    if width % API_RESOLUTION_STRIDE or height % API_RESOLUTION_STRIDE:
+        raise ValueError(f"Resolution must be a multiple of {API_RESOLUTION_STRIDE}, got {width}x{height}")
+    if max(width, height) > API_MAX_ASPECT_RATIO * min(width, height):
+        raise ValueError(f"Aspect ratio of {width}x{height} exceeds {API_MAX_ASPECT_RATIO}:1")
+    return width, height
+
+
+def _typed(body: dict, name: str, default, types, description: str):
+    """`body[name]` (or `default`), which must be of `types`. JSON `true`/`false` are not numbers here."""
+    value = body.get(name, default)
+    if isinstance(value, bool) or not isinstance(value, types):
+        raise ValueError(f"`{name}` must be {description}, got {json.dumps(value)}")
+    return value
+
+
+def build_generation_request(body: dict, default_model: str):
+    """Validates a `/v1/generate` body and returns `(key, payload, options)`."""
+    if not isinstance(body, dict):
+        raise ValueError("Request body must be a JSON object")
+    model = _typed(body, "model", default_model, str, "a string")
+    if model not in MODEL_CONFIGS:
+        raise ValueError(f"Invalid model: {model}")
+    config = MODEL_CONFIGS[model]
+
+    # checked before `validate_generation_params`, which assumes the types
+    prompt = _typed(body, "prompt", None, str, "a string")
+    seed = _typed(body, "seed", -1, int, "an integer")
+    guidance_scale = _typed(body, "guidance_scale", config["guidance_scale"], (int, float), "a number")
+    num_inference_steps = _typed(body, "num_inference_steps", config["num_inference_steps"], int, "an integer")
+    shift = _typed(body, "shift", config["shift"], (int, float), "a number")
+    scheduler = _typed(body, "scheduler", config["scheduler"].__name__, str, "a string")
+    _typed(body, "request_id", "", str, "a string")
+    validate_generation_params(prompt, seed, guidance_scale, num_inference_steps, shift)
+
+    image_format = _typed(body, "image_format", "PNG", str, "a string").upper()
+    if image_format not in API_IMAGE_FORMATS:
+        raise ValueError(f"Invalid image format: {image_format}")
+    response_format = body.get("response_format", "base64")
+    if response_format not in API_RESPONSE_FORMATS:
+        raise ValueError(f"Invalid response format: {response_format}")
+    priority = _typed(body, "priority", 0, int, "an integer")
+    timeout = body.get("timeout")
+    if timeout is not None:
+        _typed(body, "timeout", None, (int, float), "a number of seconds")
+
+    key = PipelineRunner.key(
+        model,
+        scheduler,
+        parse_api_resolution(body.get("resolution", "1024x1024")),
+        num_inference_steps,
+        guidance_scale,
+        shift,
+    )
+    options = {
+        "image_format": image_format,
+        "response_format": response_format,
+        "priority": priority,
+        "timeout": None if timeout is None else float(timeout),
+    }
+    # `stats` is filled in by the runner
+    return key, {"prompt": prompt, "seed": int(seed), "stats": {}}, options
+
+
+class ApiRequestHandler(BaseHTTPRequestHandler):
+    """
+    JSON endpoints on top of the shared `MicroBatchScheduler`:
+
+        POST   /v1/generate        generate an image (base64 JSON or raw bytes)
+        GET    /v1/requests/<id>   status of a queued request
+        DELETE /v1/requests/<id>   cancel a queued or running request
+        GET    /v1/metrics         queue and image encoder metrics
+        GET    /v1/trace           recorded spans (?format=json|chrome|otlp|summary) when started with --trace
+        GET    /health             liveness probe
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.info("%s - %s", self.address_string(), format % args)
+
+    def _send(self, status: int, body: bytes, content_type: str, headers: dict = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, data: dict, headers: dict = None):
+        self._send(status, json.dumps(data).encode("utf-8"), "application/json", headers)
+
+    def _request_id_from_path(self):
+        prefix = "/v1/requests/"
+        if self.path.startswith(prefix) and len(self.path) > len(prefix):
+            return self.path[len(prefix):]
+        return None
+
+    def do_GET(self):
+        scheduler = self.server.batch_scheduler
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif self.path == "/v1/metrics":
+            self._send_json(200, {**scheduler.metrics(), "encoding": self.server.encoder_pool.metrics()})
+        elif urlsplit(self.path).path == "/v1/trace":
+            self._send_trace()
+        elif (request_id := self._request_id_from_path()) is not None:
+            status = scheduler.status(request_id)
+            if status is None:
+                self._send_json(404, {"request_id": request_id, "error": "Unknown or finished request"})
+            else:
+                self._send_json(200, {"request_id": request_id, "status": status})
+        else:
+            self._send_json(404, {"error": f"Not found: {self.path}"})
+
+    def _send_trace(self):
+        tracer = get_tracer()
+        if tracer is None:
+            self._send_json(404, {"error": "Tracing is off; start the server with --trace"})
+            return
+        format = parse_qs(urlsplit(self.path).query).get("format", ["json"])[0]
+        if format == "summary":
+            self._send_json(200, tracer.summary())
+        elif format in TRACE_FORMATS:
+            self._send_json(200, tracer.export(format))
+        else:
+            self._send_json(400, {"error": f"Unknown trace format: {format}"})
+
+    def do_DELETE(self):
+        scheduler = self.server.batch_scheduler
+        request_id = self._request_id_from_path()
+        if request_id is None:
+            self._send_json(404, {"error": f"Not found: {self.path}"})
+        elif scheduler.cancel(request_id):
+            self._send_json(200, {"request_id": request_id, "cancelled": True})
+        else:
+            self._send_json(404, {"request_id": request_id, "cancelled": False, "error": "Unknown or finished request"})
+
+    def do_POST(self):
+        if self.path != "/v1/generate":
+            self._send_json(404, {"error": f"Not found: {self.path}"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            key, payload, options = build_generation_request(body, self.server.default_model)
+        except (ValueError, TypeError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+
+        request_id = body.get("request_id") or self.headers.get("X-Request-Id") or uuid.uuid4().hex
+        try:
+            request = self.server.batch_scheduler.submit(key, payload, request_id=request_id, priority=options["priority"])
+        except ValueError as e:
+            self._send_json(409, {"request_id": request_id, "error": str(e)})
+            return
+        except RuntimeError as e:
+            self._send_json(503, {"request_id": request_id, "error": str(e)})
+            return
+
+        try:
+            image, seed = request.future.result(timeout=options["timeout"])
+        except (CancelledError, GenerationCancelled):
+            self._send_json(409, {"request_id": request_id, "error": "Request was cancelled"})
+            return
+        except TimeoutError:
+            self.server.batch_scheduler.cancel(request_id)
+            self._send_json(504, {"request_id": request_id, "error": "Request timed out"})
+            return
+        except Exception as e:
+            logger.error(f"❌ Request {request_id} failed: {e}")
+            self._send_json(500, {"request_id": request_id, "error": str(e)})
+            return
+
+        image_format = options["image_format"]
+        data = self.server.encoder_pool.encode(image, image_format).result()
+        headers = {"X-Request-Id": request_id, "X-Seed": seed}
+        stats = payload["stats"]
+        if stats:
+            headers["X-Skipped-Steps"] = stats["skipped_steps"]
+        if options["response_format"] == "bytes":
+            self._send(200, data, API_IMAGE_FORMATS[image_format], headers)
+        else:
+            self._send_json(200, {
+                "request_id": request_id,
+                "seed": seed,
+                **stats,
+                "image_format": image_format,
+                "image": base64.b64encode(data).decode("ascii"),
+            }, headers)
+
+
+def create_api_server(
+    batch_scheduler: MicroBatchScheduler,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    default_model: str = "fast",
+    encoder_pool: ImageEncoderPool = None,
+):
+    """
+    Creates (but does not start) a threaded HTTP server that submits to `batch_scheduler` and encodes responses on
+    `encoder_pool` (a new pool if not given).
+    """
+    server = ThreadingHTTPServer((host, port), ApiRequestHandler)
+    server.daemon_threads = True
+    server.batch_scheduler = batch_scheduler
+    server.default_model = default_model
+    server.encoder_pool = encoder_pool or ImageEncoderPool()
+    return server
+
+
+def start_api_server(
+    batch_scheduler: MicroBatchScheduler,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    default_model: str = "fast",
+    encoder_pool: ImageEncoderPool = None,
+):
+    """Serves the API from a daemon thread, e.g. next to the Gradio UI. Returns the server."""
+    server = create_api_server(batch_scheduler, host, port, default_model, encoder_pool)
+    threading.Thread(target=server.serve_forever, name="hdi1-api", daemon=True).start()
+    logger.info(f"🌐 HTTP API listening on http://{host}:{server.server_port}")
+    return server
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("transformers.modeling_utils").setLevel(logging.ERROR)
+
+    parser = argparse.ArgumentParser(description="Headless HTTP API for HiDream-I1")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("-m", "--model", type=str, default="fast",
+                        help="Model to preload and use when a request does not name one",
+                        choices=list(MODEL_CONFIGS.keys()))
+    parser.add_argument("--max-batch-size", type=int, default=4)
+    parser.add_argument("--batch-wait", type=float, default=0.1,
+                        help="Seconds a request may wait for compatible requests to batch with")
+    parser.add_argument("--continuous-batching", action="store_true",
+                        help="Admit and retire requests between denoising steps instead of batching whole generations")
+    parser.add_argument("--offload", type=str, default="sequential", choices=OFFLOAD_MODES)
+    parser.add_argument("--prefetch-depth", type=int, default=1)
+    parser.add_argument("--text-encoder-quant", type=str, default="bf16", choices=TEXT_ENCODER_QUANT_OPTIONS)
+    parser.add_argument("--text-encoder-device", type=str, default="auto", choices=TEXT_ENCODER_DEVICE_OPTIONS)
+    parser.add_argument("--encoder-process", type=str, default=None)
+    parser.add_argument("--vae-decode", type=str, default="auto", choices=VAE_DECODE_MODES)
+    parser.add_argument("--pipelined-decode", action="store_true",
+                        help="Decode each batch in the background while the next one denoises")
+    parser.add_argument("--compile-step", action="store_true",
+                        help="Fuse the guided scheduler step into one torch.compile'd kernel")
+    parser.add_argument("--dynamic-shift", action="store_true",
+                        help="Scale each request's shift to the image tokens actually generated")
+    parser.add_argument("--adaptive-tolerance", type=float, default=0.0,
+                        help="Finish an image early once its prediction changes by less than this per step (0: off)")
+    parser.add_argument("--adaptive-min-steps", type=int, default=4)
+    parser.add_argument("--schedules", type=str, nargs="+", default=[],
+                        help="Tuned sigma schedules (JSON files or directories) to serve as extra schedulers")
+    parser.add_argument("--trace", action="store_true",
+                        help="Record per-stage spans, served at GET /v1/trace")
+    parser.add_argument("--trace-sync-cuda", action="store_true",
+                        help="Synchronize CUDA at span boundaries so spans measure device time (slower)")
+    parser.add_argument("--trace-max-spans", type=int, default=100000, help="Most recent spans kept")
+    parser.add_argument("--encoder-threads", type=int, default=2, help="Threads encoding response images")
+    parser.add_argument("--png-compress-level", type=int, default=DEFAULT_ENCODE_OPTIONS["PNG"]["compress_level"],
+                        choices=range(10), help="zlib level for PNG responses (lossless; 1 is several times faster than 6 but larger)")
+    parser.add_argument("--jpeg-quality", type=int, default=DEFAULT_ENCODE_OPTIONS["JPEG"]["quality"])
+    parser.add_argument("--webp-quality", type=int, default=DEFAULT_ENCODE_OPTIONS["WEBP"]["quality"])
+    args = parser.parse_args()
+
+    for name in load_schedules(args.schedules):
+        print(f"📈 Loaded schedule {name}")
+    if args.trace:
+        set_tracer(Tracer(max_spans=args.trace_max_spans, sync_cuda=args.trace_sync_cuda))
+
+    runner = PipelineRunner(
+        vae_decode_mode=args.vae_decode,
+        pipelined_decode=args.pipelined_decode,
+        offload=args.offload,
+        prefetch_depth=args.prefetch_depth,
+        text_encoder_quant=args.text_encoder_quant,
+        text_encoder_device=args.text_encoder_device,
+        encoder_process=args.encoder_process,
+        compile_step=args.compile_step,
+        dynamic_shift=args.dynamic_shift,
+        adaptive_tolerance=args.adaptive_tolerance,
+        adaptive_min_steps=args.adaptive_min_steps,
+    )
+    # Load the model up front so the first request doesn't pay for it
+    runner.load(args.model)
+
+    if args.continuous_batching:
+        batch_scheduler = ContinuousBatchScheduler(ContinuousPipelineEngine(runner), max_batch_size=args.max_batch_size).start()
+    else:
+        batch_scheduler = MicroBatchScheduler(runner, max_batch_size=args.max_batch_size, max_wait=args.batch_wait).start()
+    encoder_pool = ImageEncoderPool(args.encoder_threads, {
+        "PNG": {"compress_level": args.png_compress_level},
+        "JPEG": {"quality": args.jpeg_quality},
+        "WEBP": {"quality": args.webp_quality},
+    })
+    server = create_api_server(batch_scheduler, args.host, args.port, default_model=args.model, encoder_pool=encoder_pool)
+    logger.info(f"🌐 HTTP API listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batch_scheduler.stop()
+        encoder_pool.shutdown()
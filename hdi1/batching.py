@@ -0,0 +1,268 @@
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+try:
+    from .cancellation import AllCancelledToken, CancellationToken, GenerationCancelled
+except ImportError:
+    # Fallback for direct execution
+    from hdi1.cancellation import AllCancelledToken, CancellationToken, GenerationCancelled
+
+
+@dataclass
+class BatchRequest:
+    """A queued request. Requests with equal `key` can share one pipeline call; higher `priority` runs first."""
+
+    key: Hashable
+    payload: Any
+    request_id: str
+    priority: int = 0
+    enqueued_at: float = field(default_factory=time.monotonic)
+    future: Future = field(default_factory=Future)
+    cancellation_token: CancellationToken = field(default_factory=CancellationToken)
+
+
+class MicroBatchScheduler:
+    """
+    Gathers queued requests with compatible shapes into micro-batches.
+
+    A single worker thread owns the model. It takes the pending request with the highest priority (oldest first among
+    equals), waits up to `max_wait` seconds (counted from when that request was queued) for more requests with the same
+    `key`, and runs them together through `run_batch(key, payloads, cancellation_token)`, which must return one result
+    per payload in order, or a `Future` of that list to let the batch finish in the background while the worker moves
+    on to the next one. Results and exceptions are fanned out to the per-request futures. If `run_batch` has a
+    `prefetch(key, payloads)` method, it is called with the batch expected to run next just before each batch runs,
+    e.g. to encode its prompts in the meantime (see `PipelineRunner.prefetch`).
+
+    Requests can be cancelled by id. A pending request is dropped and its future cancelled. A running request fails
+    with `GenerationCancelled`; the batch's `cancellation_token` fires once every request in it has been cancelled, so
+    `run_batch` can stop computing without cutting short the requests that are still wanted.
+
+    Args:
+        run_batch (`Callable[[Hashable, List[Any], CancellationToken], List[Any]]`):
+            Runs one batch. Only ever called from the worker thread.
+        max_batch_size (`int`, defaults to 4):
+            Upper bound on the number of requests per batch.
+        max_wait (`float`, defaults to 0.05):
+            How long the oldest request may wait for batch mates, in seconds.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[Hashable, List[Any]], List[Any]],
+        max_batch_size: int = 4,
+        max_wait: float = 0.05,
+    ):
+        if max_batch_size < 1:
+            raise ValueError(f"`max_batch_size` must be >= 1, got {max_batch_size}")
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self._pending: List[BatchRequest] = []
+        self._running: Dict[str, BatchRequest] = {}
+        self._cond = threading.Condition()
+        self._ids = itertools.count()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, name="hdi1-batch-scheduler", daemon=True)
+
+        self._completed = 0
+        self._failed = 0
+        self._cancelled = 0
+        self._batches = 0
+        self._batch_sizes = deque(maxlen=1000)
+        self._queue_waits = deque(maxlen=1000)
+        self._batch_seconds = deque(maxlen=1000)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+        with self._cond:
+            pending, self._pending = self._pending, []
+        for request in pending:
+            request.future.set_exception(RuntimeError("Scheduler stopped before the request ran"))
+
+    def submit(self, key: Hashable, payload: Any, request_id: Optional[str] = None, priority: int = 0) -> BatchRequest:
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Scheduler is stopped")
+            if request_id is not None and self.status(request_id) is not None:
+                raise ValueError(f"Request id {request_id!r} is already queued or running")
+            request = BatchRequest(
+                key=key,
+                payload=payload,
+                request_id=request_id or f"req-{next(self._ids)}",
+                priority=priority,
+            )
+            self._pending.append(request)
+            self._cond.notify_all()
+        return request
+
+    def status(self, request_id: str) -> Optional[str]:
+        """Returns `"pending"`, `"running"`, or `None` for unknown and finished requests."""
+        with self._cond:
+            if request_id in self._running:
+                return "running"
+            if any(r.request_id == request_id for r in self._pending):
+                return "pending"
+            return None
+
+    def cancel(self, request_id: str) -> bool:
+        """Cancels a pending or running request. Returns `False` if the request is unknown or already finished."""
+        with self._cond:
+            running = self._running.get(request_id)
+            if running is not None:
+                running.cancellation_token.cancel()
+                return True
+            for i, request in enumerate(self._pending):
+                if request.request_id == request_id:
+                    del self._pending[i]
+                    break
+            else:
+                return False
+            self._cancelled += 1
+            self._cond.notify_all()
+        request.future.cancel()
+        return True
+
+    def _next_batch(self) -> Optional[List[BatchRequest]]:
+        with self._cond:
+            while not self._pending and not self._stopped:
+                self._cond.wait()
+            if self._stopped:
+                return None
+
+            while True:
+                if not self._pending:
+                    # everything we were waiting on got cancelled
+                    return []
+                head = min(self._pending, key=self._order)
+                batch = sorted((r for r in self._pending if r.key == head.key), key=self._order)
+                batch = batch[:self.max_batch_size]
+                remaining = head.enqueued_at + self.max_wait - time.monotonic()
+                if len(batch) >= self.max_batch_size or remaining <= 0 or self._stopped:
+                    break
+                self._cond.wait(remaining)
+
+            taken = {id(r) for r in batch}
+            self._pending = [r for r in self._pending if id(r) not in taken]
+            # futures cancelled directly by their owner are dropped here; the rest can no longer be `Future.cancel`ed
+            batch = [r for r in batch if r.future.set_running_or_notify_cancel()]
+            for request in batch:
+                self._running[request.request_id] = request
+            return batch
+
+    @staticmethod
+    def _order(request: BatchRequest):
+        return -request.priority, request.enqueued_at
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            if not batch:
+                continue
+
+            start = time.monotonic()
+            for request in batch:
+                self._queue_waits.append(start - request.enqueued_at)
+            token = AllCancelledToken([r.cancellation_token for r in batch])
+            self._prefetch_next()
+            try:
+                results = self.run_batch(batch[0].key, [r.payload for r in batch], token)
+            except Exception as e:
+                self._finish(batch, start, error=e)
+                continue
+            if isinstance(results, Future):
+                # the tail of the batch (e.g. VAE decode) finishes in the background while the next batch starts
+                results.add_done_callback(lambda f, batch=batch, start=start: self._finish(batch, start, future=f))
+            else:
+                self._finish(batch, start, results=results)
+
+    def _prefetch_next(self):
+        prefetch = getattr(self.run_batch, "prefetch", None)
+        if prefetch is None:
+            return
+        with self._cond:
+            if not self._pending:
+                return
+            head = min(self._pending, key=self._order)
+            batch = sorted((r for r in self._pending if r.key == head.key), key=self._order)[:self.max_batch_size]
+        try:
+            prefetch(head.key, [r.payload for r in batch])
+        except Exception as e:
+            # only an optimization; the batch encodes its prompts itself when it runs
+            print(f"⚠️ Prefetch failed: {e}")
+
+    def _finish(self, batch: List[BatchRequest], start: float, results=None, error=None, future: Future = None):
+        if future is not None:
+            try:
+                results = future.result()
+            except Exception as e:
+                error = e
+        if error is None and len(results) != len(batch):
+            error = RuntimeError(f"run_batch returned {len(results)} results for {len(batch)} requests")
+
+        with self._cond:
+            if isinstance(error, GenerationCancelled):
+                self._cancelled += len(batch)
+            elif error is not None:
+                self._failed += len(batch)
+            for request in batch:
+                self._running.pop(request.request_id, None)
+            self._batches += 1
+            self._batch_sizes.append(len(batch))
+            self._batch_seconds.append(time.monotonic() - start)
+
+        if error is not None:
+            for request in batch:
+                request.future.set_exception(error)
+            return
+        for request, result in zip(batch, results):
+            if request.cancellation_token.cancelled:
+                # its batch mates kept the batch alive; the result is no longer wanted
+                with self._cond:
+                    self._cancelled += 1
+                request.future.set_exception(GenerationCancelled("Generation was cancelled"))
+            else:
+                with self._cond:
+                    self._completed += 1
+                request.future.set_result(result)
+
+    @staticmethod
+    def _percentile(values, q):
+        if not values:
+            return 0.0
+        values = sorted(values)
+        return values[min(int(q * len(values)), len(values) - 1)]
+
+    def metrics(self) -> dict:
+        with self._cond:
+            queue_depth = len(self._pending)
+        waits = list(self._queue_waits)
+        sizes = list(self._batch_sizes)
+        seconds = list(self._batch_seconds)
+        return {
+            "queue_depth": queue_depth,
+            "completed": self._completed,
+            "failed": self._failed,
+            "cancelled": self._cancelled,
+            "running": len(self._running),
+            "batches": self._batches,
+            "mean_batch_size": sum(sizes) / len(sizes) if sizes else 0.0,
+            "max_batch_size": max(sizes) if sizes else 0,
+            "queue_wait_p50_s": self._percentile(waits, 0.5),
+            "queue_wait_p95_s": self._percentile(waits, 0.95),
+            "batch_time_p50_s": self._percentile(seconds, 0.5),
+        }
@@ -0,0 +1,78 @@
+"""
+Compares two `hdi1.benchmarks.suite` runs and flags regressions.
+
+A benchmark regresses when its median time (or `--metric`) grew by more than `--threshold` (relative) and by more
+than `--min-ms` (absolute, so sub-millisecond noise doesn't count). Exits with status 1 if anything regressed, for use
+in CI:
+
+    python -m hdi1.benchmarks.compare base.json new.json --threshold 0.1
+"""
+
+import argparse
+import json
+import sys
+
+
+def load_results(path: str) -> tuple[dict, dict]:
+    with open(path) as f:
+        data = json.load(f)
+    return data.get("meta", {}), {result["name"]: result for result in data["results"]}
+
+
+def compare(base: dict, new: dict, threshold: float, min_ms: float, metric: str = "median_ms") -> list[dict]:
+    """One row per benchmark in both runs, with the relative change of `metric` and whether it regressed."""
+    rows = []
+    for name, result in new.items():
+        if name not in base:
+            continue
+        before, after = base[name][metric], result[metric]
+        change = after / before - 1 if before > 0 else 0.0
+        rows.append({
+            "name": name,
+            "base_ms": before,
+            "new_ms": after,
+            "change": change,
+            "regression": change > threshold and after - before > min_ms,
+            "improvement": change < -threshold and before - after > min_ms,
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("base", type=str, help="Results of the baseline run")
+    parser.add_argument("new", type=str, help="Results of the run to check")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown that counts as a regression")
+    parser.add_argument("--min-ms", type=float, default=0.05, help="Ignore changes smaller than this")
+    parser.add_argument("--metric", type=str, default="median_ms", choices=["median_ms", "min_ms", "mean_ms"],
+                        help="min_ms is steadier on a busy machine")
+    parser.add_argument("--all", action="store_true", help="List unchanged benchmarks too")
+    args = parser.parse_args()
+
+    base_meta, base = load_results(args.base)
+    new_meta, new = load_results(args.new)
+    for key in ("device", "dtype", "threads", "torch"):
+        if base_meta.get(key) != new_meta.get(key):
+            print(f"⚠️ Runs differ in {key}: {base_meta.get(key)} vs {new_meta.get(key)}")
+
+    rows = compare(base, new, args.threshold, args.min_ms, args.metric)
+    width = max((len(row["name"]) for row in rows), default=10)
+    print(f"{'benchmark':<{width}}  {'base ms':>10}  {'new ms':>10}  {'change':>8}")
+    for row in rows:
+        mark = "❌ regression" if row["regression"] else "✅ faster" if row["improvement"] else ""
+        if mark or args.all:
+            print(f"{row['name']:<{width}}  {row['base_ms']:10.3f}  {row['new_ms']:10.3f}  {row['change']:+8.1%}  {mark}")
+
+    only_base, only_new = sorted(set(base) - set(new)), sorted(set(new) - set(base))
+    if only_base:
+        print(f"⏭️ {len(only_base)} benchmark(s) only in {args.base}")
+    if only_new:
+        print(f"⏭️ {len(only_new)} benchmark(s) only in {args.new}")
+
+    regressions = [row for row in rows if row["regression"]]
+    print(f"{len(rows)} compared, {len(regressions)} regression(s)")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
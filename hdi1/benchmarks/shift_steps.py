@@ -0,0 +1,112 @@
+"""
+Steps each resolution needs for a fixed quality.
+
+For every resolution the images of a few prompts and seeds are generated once with `--reference-steps` and then with
+each of `--steps`; the quality of a step count is the mean PSNR of its decoded images against the reference. The
+smallest step count reaching `--target-psnr` is what that resolution needs. Run with and without `--dynamic-shift` to
+see what the token-count shift buys:
+
+    python -m hdi1.benchmarks.shift_steps --model fast --steps 8 10 12 14 16 --output shift_steps.json
+"""
+
+import argparse
+import json
+
+import numpy as np
+import torch
+
+try:
+    from ..nf4 import MODEL_CONFIGS, QUALITY_CHECK_PROMPTS, generate_images, load_models, make_scheduler
+    from ..schedulers.registry import PRESETS, SCHEDULERS
+except ImportError:
+    # Fallback for direct execution
+    from hdi1.nf4 import MODEL_CONFIGS, QUALITY_CHECK_PROMPTS, generate_images, load_models, make_scheduler
+    from hdi1.schedulers.registry import PRESETS, SCHEDULERS
+
+DEFAULT_RESOLUTIONS = ["1024x1024", "768x1360", "1360x768", "880x1168", "1168x880", "1248x832", "832x1248"]
+
+
+def psnr(images: np.ndarray, reference: np.ndarray) -> float:
+    """Mean PSNR in dB of `images` against `reference`, both in [0, 1]."""
+    mse = ((images.astype(np.float64) - reference.astype(np.float64)) ** 2).reshape(len(images), -1).mean(axis=1)
+    return float(np.mean(10 * np.log10(1.0 / np.maximum(mse, 1e-12))))
+
+
+def measure_resolution(pipe, args, resolution, scheduler_name, shift):
+    seeds = list(range(args.seeds))
+    prompts = [prompt for prompt in QUALITY_CHECK_PROMPTS[:args.prompts] for _ in seeds]
+    seeds = seeds * args.prompts
+
+    def render(num_inference_steps):
+        pipe.scheduler = make_scheduler(scheduler_name, shift, dynamic_shift=args.dynamic_shift)
+        latents, _ = generate_images(
+            pipe, prompts, resolution, seeds, args.guidance_scale, num_inference_steps, output_type="latent"
+        )
+        return latents, pipe.decode_latents(latents, output_type="np")
+
+    reference_latents, reference = render(args.reference_steps)
+    image_seq_len = pipe.image_seq_len(reference_latents)
+    quality = {steps: psnr(render(steps)[1], reference) for steps in sorted(args.steps)}
+    needed = next((steps for steps, value in quality.items() if value >= args.target_psnr), None)
+    return {
+        "resolution": f"{resolution[0]}x{resolution[1]}",
+        "image_seq_len": image_seq_len,
+        "shift_kwargs": pipe.shift_kwargs(pipe.scheduler, image_seq_len),
+        "psnr": quality,
+        "steps_needed": needed,
+    }
+
+
+@torch.inference_mode()
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-m", "--model", type=str, default="fast", choices=list(MODEL_CONFIGS.keys()))
+    parser.add_argument("--scheduler", type=str, default=None, choices=list(SCHEDULERS) + list(PRESETS),
+                        help="Defaults to the model's scheduler")
+    parser.add_argument("--shift", type=float, default=None, help="Defaults to the model's shift")
+    parser.add_argument("--dynamic-shift", action="store_true")
+    parser.add_argument("--resolutions", type=str, nargs="+", default=DEFAULT_RESOLUTIONS, help="WIDTHxHEIGHT")
+    parser.add_argument("--steps", type=int, nargs="+", required=True, help="Step counts to measure")
+    parser.add_argument("--reference-steps", type=int, default=None, help="Defaults to twice the largest of --steps")
+    parser.add_argument("--target-psnr", type=float, default=30.0)
+    parser.add_argument("--guidance-scale", type=float, default=None, help="Defaults to the model's guidance scale")
+    parser.add_argument("--prompts", type=int, default=2)
+    parser.add_argument("--seeds", type=int, default=2)
+    parser.add_argument("--offload", type=str, default="sequential")
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON")
+    args = parser.parse_args()
+
+    config = MODEL_CONFIGS[args.model]
+    scheduler_name = args.scheduler or config["scheduler"].__name__
+    shift = args.shift if args.shift is not None else config["shift"]
+    if args.guidance_scale is None:
+        args.guidance_scale = config["guidance_scale"]
+    if args.reference_steps is None:
+        args.reference_steps = 2 * max(args.steps)
+
+    pipe, _ = load_models(args.model, offload=args.offload)
+    results = []
+    for value in args.resolutions:
+        resolution = tuple(int(side) for side in value.lower().split("x"))
+        result = measure_resolution(pipe, args, resolution, scheduler_name, shift)
+        results.append(result)
+        curve = ", ".join(f"{steps}: {db:.1f}" for steps, db in result["psnr"].items())
+        print(f"📐 {result['resolution']} ({result['image_seq_len']} tokens): {curve} dB -> {result['steps_needed']} steps")
+
+    report = {
+        "model": args.model,
+        "scheduler": scheduler_name,
+        "shift": shift,
+        "dynamic_shift": args.dynamic_shift,
+        "reference_steps": args.reference_steps,
+        "target_psnr": args.target_psnr,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Quality against model evaluations (NFE) of the flow-matching solvers, without a model.
+
+The data is an anisotropic Gaussian, whose flow-matching velocity and probability-flow ODE solution are known in
+closed form, so every solver can be scored by its distance to the exact solution:
+
+    x_sigma = (1 - sigma) * x_0 + sigma * noise,   x_0 ~ N(mean, scale^2)
+    v(x, sigma) = E[noise - x_0 | x_sigma = x]
+
+The ODE keeps the standardized coordinate `(x - (1 - sigma) * mean) / sqrt(var(sigma))` fixed, so a sample started
+at the first sigma of a schedule ends at `mean + scale * z`. The error of a run is the RMS distance to that endpoint,
+relative to the data scale. Run e.g.
+
+    python -m hdi1.benchmarks.solvers_nfe --shift 3.0 --nfe 8 12 16 20 28 50 --output solvers_nfe.json
+"""
+
+import argparse
+import json
+import math
+
+import torch
+
+try:
+    from ..schedulers.flow_heun import FlowHeunDiscreteScheduler
+    from ..schedulers.fm_solvers_dpm import FlowDPMSolverMultistepScheduler
+    from ..schedulers.fm_solvers_unipc import FlowUniPCMultistepScheduler
+except ImportError:
+    # Fallback for direct execution
+    from hdi1.schedulers.flow_heun import FlowHeunDiscreteScheduler
+    from hdi1.schedulers.fm_solvers_dpm import FlowDPMSolverMultistepScheduler
+    from hdi1.schedulers.fm_solvers_unipc import FlowUniPCMultistepScheduler
+
+# name -> (scheduler class, config overrides)
+SOLVERS = {
+    "unipc-bh2": (FlowUniPCMultistepScheduler, {"solver_order": 2, "solver_type": "bh2"}),
+    "unipc-bh1-3": (FlowUniPCMultistepScheduler, {"solver_order": 3, "solver_type": "bh1"}),
+    "dpm++2m": (FlowDPMSolverMultistepScheduler, {"solver_order": 2}),
+    "dpm++2m-heun": (FlowDPMSolverMultistepScheduler, {"solver_order": 2, "solver_type": "heun"}),
+    "dpm++3m": (FlowDPMSolverMultistepScheduler, {"solver_order": 3}),
+    "deis-3": (FlowDPMSolverMultistepScheduler, {"solver_order": 3, "algorithm_type": "deis"}),
+    "heun": (FlowHeunDiscreteScheduler, {"solver_type": "heun"}),
+    "midpoint": (FlowHeunDiscreteScheduler, {"solver_type": "midpoint"}),
+    "euler": (FlowDPMSolverMultistepScheduler, {"solver_order": 1}),
+}
+
+
+class GaussianFlow:
+    """Exact flow-matching velocity of `N(mean, scale^2)` data, per dimension."""
+
+    def __init__(self, mean: torch.Tensor, scale: torch.Tensor):
+        self.mean = mean
+        self.scale = scale
+
+    def variance(self, sigma: float) -> torch.Tensor:
+        return (1 - sigma) ** 2 * self.scale**2 + sigma**2
+
+    def velocity(self, x: torch.Tensor, sigma: float) -> torch.Tensor:
+        centered = x - (1 - sigma) * self.mean
+        variance = self.variance(sigma)
+        x0 = self.mean + (1 - sigma) * self.scale**2 / variance * centered
+        noise = sigma / variance * centered
+        return noise - x0
+
+    def sample(self, z: torch.Tensor, sigma: float) -> torch.Tensor:
+        """The point at `sigma` with standardized coordinate `z`."""
+        return (1 - sigma) * self.mean + self.variance(sigma).sqrt() * z
+
+
+def steps_for_nfe(scheduler_class, nfe: int) -> int:
+    # two-stage solvers spend 2 evaluations per step except on the last one
+    return (nfe + 1) // 2 if scheduler_class.order == 2 else nfe
+
+
+def solve(name: str, flow: GaussianFlow, z: torch.Tensor, nfe: int, shift: float) -> dict:
+    scheduler_class, overrides = SOLVERS[name]
+    scheduler = scheduler_class(num_train_timesteps=1000, shift=shift, use_dynamic_shifting=False, **overrides)
+    scheduler.set_timesteps(steps_for_nfe(scheduler_class, nfe), device="cpu", shift=shift)
+    sigma_start = scheduler.sigmas[0].item()
+    x = flow.sample(z, sigma_start)
+    for i, t in enumerate(scheduler.timesteps):
+        # the velocity at the sigma the model would be conditioned on
+        sigma = float(t) / scheduler.config.num_train_timesteps
+        x = scheduler.step(flow.velocity(x, sigma), t, x, return_dict=False)[0]
+    exact = flow.mean + flow.scale * z
+    error = ((x - exact).pow(2).mean().sqrt() / flow.scale.pow(2).mean().sqrt()).item()
+    return {"solver": name, "nfe": len(scheduler.timesteps), "steps": scheduler.num_inference_steps, "rel_rmse": error}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--solvers", type=str, nargs="+", default=list(SOLVERS), choices=list(SOLVERS))
+    parser.add_argument("--nfe", type=int, nargs="+", default=[6, 8, 10, 12, 16, 20, 28, 50])
+    parser.add_argument("--shift", type=float, default=3.0)
+    parser.add_argument("--dims", type=int, default=4096)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON")
+    args = parser.parse_args()
+
+    generator = torch.Generator().manual_seed(args.seed)
+    # scales spread over two decades like latent channels; the solvers update in float32, so errors bottom out near 1e-7
+    flow = GaussianFlow(
+        mean=torch.randn(args.dims, generator=generator, dtype=torch.float64),
+        scale=torch.empty(args.dims, dtype=torch.float64).uniform_(math.log(0.05), math.log(5.0), generator=generator).exp(),
+    )
+    z = torch.randn(args.dims, generator=generator, dtype=torch.float64)
+
+    results = [solve(name, flow, z, nfe, args.shift) for name in args.solvers for nfe in sorted(args.nfe)]
+    width = max(len(name) for name in args.solvers)
+    print(f"{'solver':<{width}}  " + "  ".join(f"{nfe:>8}" for nfe in sorted(args.nfe)))
+    for name in args.solvers:
+        row = [r for r in results if r["solver"] == name]
+        print(f"{name:<{width}}  " + "  ".join(f"{r['rel_rmse']:8.2e}" for r in row))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"shift": args.shift, "dims": args.dims, "results": results}, f, indent=2)
+        print(f"✅ Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+"""
+Component timings on synthetic models, offline and without weights.
+
+Every model is built from a small random config: the transformer (`--configs`, see `CONFIGS`), stub text encoders of
+the same widths in place of the two CLIPs, T5 and Llama, and a two-block VAE. The suite times the transformer forward,
+its MoE feed-forward, attention, rope, every registered scheduler (classes and presets), prompt encoding and VAE decode
+for each batch size and latent resolution, and writes the timings as JSON for `hdi1.benchmarks.compare`:
+
+    python -m hdi1.benchmarks.suite --output base.json
+    python -m hdi1.benchmarks.suite --output new.json
+    python -m hdi1.benchmarks.compare base.json new.json
+
+Resolutions are latent sizes (`HxW`, 1/8 of the image); the absolute numbers say nothing about the real model, the
+ratios between runs do.
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import time
+from types import SimpleNamespace
+
+import torch
+from diffusers import AutoencoderKL
+from transformers import logging as transformers_logging
+from transformers import (
+    CLIPTextConfig,
+    CLIPTextModelWithProjection,
+    LlamaConfig,
+    LlamaForCausalLM,
+    T5Config,
+    T5EncoderModel,
+)
+
+try:
+    from .. import HiDreamImagePipeline, HiDreamImageTransformer2DModel
+    from ..models.attention_processor import apply_rope, attention
+    from ..models.embeddings import EmbedND
+    from ..models.moe import MOEFeedForwardSwiGLU
+    from ..schedulers.registry import PRESETS, SCHEDULERS, make_scheduler
+    from ..vae_decode import decode_latents_with_vae
+except ImportError:
+    # Fallback for direct execution
+    from hdi1 import HiDreamImagePipeline, HiDreamImageTransformer2DModel
+    from hdi1.models.attention_processor import apply_rope, attention
+    from hdi1.models.embeddings import EmbedND
+    from hdi1.models.moe import MOEFeedForwardSwiGLU
+    from hdi1.schedulers.registry import PRESETS, SCHEDULERS, make_scheduler
+    from hdi1.vae_decode import decode_latents_with_vae
+
+# Synthetic model sizes: transformer width and depth, the width of the stub text encoders and the Llama depth
+CONFIGS = {
+    "tiny": {"num_layers": 2, "num_single_layers": 2, "num_attention_heads": 2, "attention_head_dim": 32, "text_dim": 64, "llama_layers": 4},
+    "small": {"num_layers": 4, "num_single_layers": 8, "num_attention_heads": 4, "attention_head_dim": 64, "text_dim": 128, "llama_layers": 8},
+}
+
+BENCHMARKS = ["transformer", "moe", "attention", "rope", "scheduler", "encode", "vae"]
+
+DEFAULT_RESOLUTIONS = ["32x32", "64x64", "48x80"]
+
+LATENT_CHANNELS = 16
+CLIP_SEQ_LEN = 77
+
+
+def time_call(fn, warmup: int, repeats: int, device: torch.device) -> dict:
+    """Median, min and mean wall time of `fn()` in milliseconds, synchronizing CUDA around every call."""
+    def sync():
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    for _ in range(warmup):
+        fn()
+    sync()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        sync()
+        times.append((time.perf_counter() - start) * 1000)
+    return {
+        "median_ms": statistics.median(times),
+        "min_ms": min(times),
+        "mean_ms": statistics.fmean(times),
+        "repeats": repeats,
+    }
+
+
+def parse_latent_size(res: str) -> tuple[int, int]:
+    height, width = (int(v) for v in res.lower().split("x"))
+    return height, width
+
+
+def init_weights(module: torch.nn.Module, seed: int):
+    # random but well-scaled, so activations stay finite through the stack
+    generator = torch.Generator().manual_seed(seed)
+    with torch.no_grad():
+        for parameter in module.parameters():
+            parameter.copy_(torch.randn(parameter.shape, generator=generator) * 0.05)
+
+
+def build_transformer(config: dict, max_resolution: tuple[int, int]) -> HiDreamImageTransformer2DModel:
+    head_dim = config["attention_head_dim"]
+    num_blocks = config["num_layers"] + config["num_single_layers"]
+    return HiDreamImageTransformer2DModel(
+        patch_size=2,
+        in_channels=LATENT_CHANNELS,
+        num_layers=config["num_layers"],
+        num_single_layers=config["num_single_layers"],
+        attention_head_dim=head_dim,
+        num_attention_heads=config["num_attention_heads"],
+        caption_channels=[config["text_dim"], config["text_dim"]],
+        text_emb_dim=2 * config["text_dim"],
+        axes_dims_rope=(head_dim // 2, head_dim // 4, head_dim // 4),
+        max_resolution=max_resolution,
+        llama_layers=[i % config["llama_layers"] for i in range(num_blocks)],
+    )
+
+
+def build_text_encoders(config: dict) -> dict:
+    dim = config["text_dim"]
+    heads = max(dim // 32, 1)
+    clip = CLIPTextConfig(
+        vocab_size=1000, hidden_size=dim, intermediate_size=4 * dim, num_hidden_layers=2, num_attention_heads=heads,
+        projection_dim=dim, max_position_embeddings=CLIP_SEQ_LEN,
+    )
+    return {
+        "clip_l": CLIPTextModelWithProjection(clip),
+        "clip_g": CLIPTextModelWithProjection(clip),
+        "t5": T5EncoderModel(T5Config(
+            vocab_size=1000, d_model=dim, d_kv=32, d_ff=4 * dim, num_layers=2, num_heads=heads,
+        )),
+        "llama": LlamaForCausalLM(LlamaConfig(
+            vocab_size=1000, hidden_size=dim, intermediate_size=4 * dim, num_hidden_layers=config["llama_layers"],
+            num_attention_heads=heads, num_key_value_heads=heads,
+        )),
+    }
+
+
+def build_vae() -> AutoencoderKL:
+    return AutoencoderKL(
+        in_channels=3,
+        out_channels=3,
+        down_block_types=("DownEncoderBlock2D", "DownEncoderBlock2D"),
+        up_block_types=("UpDecoderBlock2D", "UpDecoderBlock2D"),
+        block_out_channels=(32, 32),
+        layers_per_block=1,
+        latent_channels=LATENT_CHANNELS,
+        norm_num_groups=32,
+        scaling_factor=0.3611,
+        shift_factor=0.1159,
+    )
+
+
+def transformer_forward(model, latents: torch.Tensor, text_len: int, config: dict, generator: torch.Generator):
+    """One denoising forward as the pipeline runs it (`transformer_output`, including the non-square padding)."""
+    batch_size, device, dtype = latents.shape[0], latents.device, latents.dtype
+    def randn(*shape):
+        return torch.randn(shape, generator=generator).to(device=device, dtype=dtype)
+
+    # the pipeline methods only need its transformer
+    pipe = SimpleNamespace(transformer=model)
+    img_sizes, img_ids = HiDreamImagePipeline.prepare_image_ids(pipe, latents, False)
+    if img_sizes is not None:
+        img_sizes, img_ids = img_sizes.repeat(batch_size, 1), img_ids.repeat(batch_size, 1, 1)
+    timesteps = torch.full((batch_size,), 500.0, device=device)
+    prompt_embeds = [
+        randn(batch_size, text_len, config["text_dim"]),
+        randn(config["llama_layers"], batch_size, text_len, config["text_dim"]),
+    ]
+    pooled_prompt_embeds = randn(batch_size, 2 * config["text_dim"])
+    return lambda: HiDreamImagePipeline.transformer_output(
+        pipe, latents, timesteps, prompt_embeds, pooled_prompt_embeds, img_sizes, img_ids,
+        do_classifier_free_guidance=False,
+    )
+
+
+def encode_prompts(encoders: dict, batch_size: int, text_len: int, device: torch.device, generator: torch.Generator):
+    # the encoder calls of `HiDreamImagePipeline.encode_prompt`, on random token ids
+    def ids(length):
+        return torch.randint(0, 1000, (batch_size, length), generator=generator).to(device)
+
+    pooled = [encoders[name](ids(CLIP_SEQ_LEN), output_hidden_states=True)[0] for name in ("clip_l", "clip_g")]
+    t5 = encoders["t5"](ids(text_len))[0]
+    llama = encoders["llama"](ids(text_len), output_hidden_states=True).hidden_states[1:]
+    return t5, torch.stack(llama, dim=0), torch.cat(pooled, dim=-1)
+
+
+@torch.inference_mode()
+def run_config(config_name: str, args, device: torch.device, dtype: torch.dtype) -> list[dict]:
+    config = CONFIGS[config_name]
+    latent_sizes = [parse_latent_size(res) for res in args.resolutions]
+    # large enough for every resolution; non-square latents are padded to its token count as in the real model
+    max_resolution = (max(h for h, _ in latent_sizes), max(w for _, w in latent_sizes))
+    heads, head_dim = config["num_attention_heads"], config["attention_head_dim"]
+    inner_dim = heads * head_dim
+    generator = torch.Generator().manual_seed(args.seed)
+
+    def randn(*shape):
+        return torch.randn(shape, generator=generator).to(device=device, dtype=dtype)
+
+    models = {}
+    if "transformer" in args.benchmarks:
+        models["transformer"] = build_transformer(config, max_resolution)
+    if "moe" in args.benchmarks:
+        models["moe"] = MOEFeedForwardSwiGLU(inner_dim, 4 * inner_dim, num_routed_experts=4, num_activated_experts=2)
+    if "encode" in args.benchmarks:
+        models.update(build_text_encoders(config))
+    if "vae" in args.benchmarks:
+        models["vae"] = build_vae()
+    for i, model in enumerate(models.values()):
+        init_weights(model, args.seed + i)
+        model.to(device=device, dtype=None if dtype == torch.float32 else dtype).eval()
+    rope_embedder = EmbedND(theta=10000, axes_dim=[head_dim // 2, head_dim // 4, head_dim // 4])
+
+    results = []
+    def record(benchmark, fn, batch_size, res=None, **extra):
+        name = "/".join([benchmark, config_name, f"b{batch_size}"] + ([res] if res else []) + [str(v) for v in extra.values()])
+        timing = time_call(fn, args.warmup, args.repeats, device)
+        results.append({
+            "name": name, "benchmark": benchmark, "config": config_name, "batch_size": batch_size,
+            "resolution": res, **extra, **timing,
+        })
+        print(f"{name:<60} {timing['median_ms']:10.3f} ms")
+
+    for batch_size in args.batch_sizes:
+        if "encode" in args.benchmarks:
+            record("encode", lambda: encode_prompts(models, batch_size, args.text_len, device, generator), batch_size)
+
+        for res, (height, width) in zip(args.resolutions, latent_sizes):
+            latents = randn(batch_size, LATENT_CHANNELS, height, width)
+            image_tokens = (height // 2) * (width // 2)
+            # image tokens plus the T5 and two Llama sequences a double-stream block attends over
+            tokens = image_tokens + 3 * args.text_len
+
+            if "transformer" in args.benchmarks:
+                forward = transformer_forward(models["transformer"], latents, args.text_len, config, generator)
+                record("transformer", forward, batch_size, res)
+            if "moe" in args.benchmarks:
+                x = randn(batch_size, image_tokens, inner_dim)
+                record("moe", lambda: models["moe"](x), batch_size, res)
+            if "attention" in args.benchmarks:
+                q, k, v = (randn(batch_size, tokens, heads, head_dim) for _ in range(3))
+                record("attention", lambda: attention(q, k, v), batch_size, res)
+            if "rope" in args.benchmarks:
+                ids = torch.zeros(batch_size, tokens, 3, device=device)
+                ids[:, :image_tokens, 1] = torch.arange(image_tokens, device=device) // (width // 2)
+                ids[:, :image_tokens, 2] = torch.arange(image_tokens, device=device) % (width // 2)
+                q, k = (randn(batch_size, tokens, heads, head_dim) for _ in range(2))
+                record("rope", lambda: apply_rope(q, k, rope_embedder(ids)), batch_size, res)
+            if "scheduler" in args.benchmarks:
+                velocity = randn(*latents.shape)
+                for scheduler_name in list(SCHEDULERS) + list(PRESETS):
+                    def sample(scheduler_name=scheduler_name):
+                        scheduler = make_scheduler(scheduler_name, 3.0)
+                        scheduler.set_timesteps(args.scheduler_steps, device=device)
+                        x = latents
+                        for t in scheduler.timesteps:
+                            x = scheduler.step(velocity, t, x, return_dict=False)[0]
+                        return x
+                    record("scheduler", sample, batch_size, res, scheduler=scheduler_name)
+            if "vae" in args.benchmarks:
+                record("vae", lambda: decode_latents_with_vae(models["vae"], latents, mode="full", output_type="pt"), batch_size, res)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--configs", type=str, nargs="+", default=["tiny"], choices=list(CONFIGS))
+    parser.add_argument("--benchmarks", type=str, nargs="+", default=BENCHMARKS, choices=BENCHMARKS)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--resolutions", type=str, nargs="+", default=DEFAULT_RESOLUTIONS, help="Latent HEIGHTxWIDTH")
+    parser.add_argument("--text-len", type=int, default=32, help="T5 and Llama sequence length")
+    parser.add_argument("--scheduler-steps", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "bfloat16", "float16"])
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON")
+    args = parser.parse_args()
+
+    transformers_logging.set_verbosity_error()
+    for res in args.resolutions:
+        height, width = parse_latent_size(res)
+        if height % 2 or width % 2:
+            raise ValueError(f"Latent size {res} must be divisible by the patch size 2")
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+
+    results = [result for config_name in args.configs for result in run_config(config_name, args, device, dtype)]
+    if args.output:
+        meta = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "device": args.device,
+            "dtype": args.dtype,
+            "threads": torch.get_num_threads(),
+            "args": vars(args),
+        }
+        with open(args.output, "w") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+        print(f"✅ Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+import threading
+from typing import List
+
+
+class GenerationCancelled(Exception):
+    """Raised from inside the pipeline when its cancellation token fires."""
+
+
+class CancellationToken:
+    """
+    A thread-safe flag that a request owner sets and the pipeline polls.
+
+    The pipeline checks it between denoising steps and the transformer between blocks. Checking only reads a
+    `threading.Event`, so it never synchronizes with the GPU.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise GenerationCancelled("Generation was cancelled")
+
+
+class AllCancelledToken(CancellationToken):
+    """Fires once every one of `tokens` has fired, e.g. for a batch whose items can be cancelled individually."""
+
+    def __init__(self, tokens: List[CancellationToken]):
+        super().__init__()
+        self.tokens = list(tokens)
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set() or all(token.cancelled for token in self.tokens)
@@ -0,0 +1,462 @@
+import inspect
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Any, Hashable, List, Optional, Tuple
+
+import torch
+
+try:
+    from .batching import BatchRequest, MicroBatchScheduler
+    from .cancellation import AllCancelledToken, CancellationToken, GenerationCancelled
+    from .latents import save_latents
+    from .nf4 import make_latent_batch, make_scheduler, record_steps, schedule_sigmas
+    from .noise import NoiseSeeds
+    from .preview import latents_to_rgb
+    from .schedulers.batched import batched_scheduler
+    from .tracing import span
+except ImportError:
+    # Fallback for direct execution
+    from hdi1.batching import BatchRequest, MicroBatchScheduler
+    from hdi1.cancellation import AllCancelledToken, CancellationToken, GenerationCancelled
+    from hdi1.latents import save_latents
+    from hdi1.nf4 import make_latent_batch, make_scheduler, record_steps, schedule_sigmas
+    from hdi1.noise import NoiseSeeds
+    from hdi1.preview import latents_to_rgb
+    from hdi1.schedulers.batched import batched_scheduler
+    from hdi1.tracing import span
+
+
+@dataclass
+class _Slot:
+    """One request in the running batch: everything that is per row except its latents and scheduler state."""
+
+    request_id: str
+    payload: dict
+    seed: int
+    prompt_embeds: List[torch.Tensor]  # [t5 (1, L, D), llama (layers, 1, L, D)]
+    negative_prompt_embeds: Optional[List[torch.Tensor]]
+    pooled_prompt_embeds: torch.Tensor  # (1, D)
+    negative_pooled_prompt_embeds: Optional[torch.Tensor]
+    noise_seeds: NoiseSeeds
+    metadata: dict
+
+
+def _cat_embeds(embeds: List[List[torch.Tensor]]) -> List[torch.Tensor]:
+    # T5 embeddings are (B, L, D), the stacked Llama layers (layers, B, L, D)
+    return [torch.cat(parts, dim=0 if parts[0].ndim == 3 else 1) for parts in zip(*embeds)]
+
+
+class ContinuousPipelineEngine:
+    """
+    Iteration-level batching for the pipeline loaded by a `PipelineRunner`: one running batch whose rows are separate
+    requests, each with its own latents, prompt embeddings, scheduler row (step count, shift and position) and noise
+    seed. `step()` runs one transformer forward for every row and advances each row by one step of its own schedule;
+    rows that reach the end, or settle early under the runner's `step_controller()`, are decoded and retired, and new
+    rows can be admitted before any step.
+
+    Rows in one running batch share a lane: model, scheduler, resolution and guidance scale (`lane(key)`), i.e. what
+    fixes the latent shape and the guided forward. Steps and shift differ freely between rows.
+
+    A row draws the same initial latents and per-step noise as a single pipeline call with its seed, and runs the same
+    schedule, so its image only differs from a single run by the batch composition of the transformer's matmuls.
+
+    Args:
+        runner (`PipelineRunner`):
+            Loads the model and supplies the preview, latent-storage, noise-cache and decode settings.
+        max_sequence_length (`int`, defaults to 128):
+            Padded prompt length; rows of different requests are concatenated, so it is the same for every row.
+    """
+
+    def __init__(self, runner, max_sequence_length: int = 128):
+        self.runner = runner
+        self.max_sequence_length = max_sequence_length
+        self.pipe = None
+        self.key = None
+        self.scheduler = None
+        self.latents = None
+        self.controller = None
+        self.slots: List[_Slot] = []
+
+    def __len__(self):
+        return len(self.slots)
+
+    @staticmethod
+    def lane(key: Hashable) -> Hashable:
+        """Requests with equal lanes (model, scheduler, resolution, guidance scale) can share the running batch."""
+        model_type, scheduler, resolution, num_inference_steps, guidance_scale, shift = key
+        return model_type, scheduler, resolution, guidance_scale
+
+    @property
+    def guidance_scale(self) -> float:
+        return self.key[4]
+
+    def _make_scheduler(self, shift: float):
+        return make_scheduler(self.key[1], shift, dynamic_shift=self.runner.dynamic_shift)
+
+    def reset(self):
+        """Drops every row, e.g. after a failed step."""
+        self.slots = []
+        self.latents = None
+        self.scheduler = None
+        self.controller = None
+
+    @torch.inference_mode()
+    def admit(self, requests: List[Tuple[str, Hashable, dict]]):
+        """
+        Adds `(request_id, key, payload)` rows at the first step of their schedules. Their prompts are encoded together;
+        the keys must share the lane of the running batch. Payloads are the `PipelineRunner` ones.
+        """
+        if not requests:
+            return
+        key = requests[0][1]
+        if self.slots and self.lane(key) != self.lane(self.key):
+            raise ValueError(f"Cannot admit lane {self.lane(key)} into a batch running {self.lane(self.key)}")
+        if not self.slots:
+            self.reset()
+            self.pipe = self.runner.load(key[0])
+            self.key = key
+            self.scheduler = batched_scheduler(self._make_scheduler(key[5]))
+            self.controller = self.runner.step_controller()
+        pipe = self.pipe
+        device = pipe._execution_device
+        do_classifier_free_guidance = self.guidance_scale > 1
+
+        prompts = [payload["prompt"] for _, _, payload in requests]
+        with span("encode_prompt", batch_size=len(prompts)):
+            prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds = pipe.encode_prompt(
+                prompt=prompts,
+                prompt_2=None,
+                prompt_3=None,
+                prompt_4=None,
+                device=device,
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=do_classifier_free_guidance,
+                max_sequence_length=self.max_sequence_length,
+            )
+
+        height, width = pipe.sample_size(*reversed(key[2]))
+        shape = (
+            pipe.transformer.config.in_channels,
+            2 * (height // (pipe.vae_scale_factor * 2)),
+            2 * (width // (pipe.vae_scale_factor * 2)),
+        )
+        def row(embeds, i):
+            return [e[:, i:i + 1] if e.ndim == 4 else e[i:i + 1] for e in embeds]
+
+        new_latents, new_rows, new_slots = [], [], []
+        for i, (request_id, request_key, payload) in enumerate(requests):
+            model_type, scheduler, resolution, num_inference_steps, guidance_scale, shift = request_key
+            seed = payload["seed"]
+            seed = torch.randint(0, 1000000, (1,)).item() if seed == -1 else int(seed)
+            noise_seeds = NoiseSeeds.philox([seed])
+            new_latents.append(noise_seeds.randn(shape, pooled_prompt_embeds.dtype, device, cache=self.runner.noise_cache))
+
+            row_scheduler = self._make_scheduler(shift)
+            # shifted as the pipeline shifts it
+            shift_kwargs = pipe.shift_kwargs(
+                row_scheduler, pipe.image_seq_len(new_latents[-1]), sigmas=schedule_sigmas(scheduler)
+            )
+            new_rows.append((num_inference_steps, row_scheduler, shift_kwargs))
+
+            new_slots.append(_Slot(
+                request_id=request_id,
+                payload=payload,
+                seed=seed,
+                prompt_embeds=row(prompt_embeds, i),
+                negative_prompt_embeds=row(negative_prompt_embeds, i) if do_classifier_free_guidance else None,
+                pooled_prompt_embeds=pooled_prompt_embeds[i:i + 1],
+                negative_pooled_prompt_embeds=(
+                    negative_pooled_prompt_embeds[i:i + 1] if do_classifier_free_guidance else None
+                ),
+                noise_seeds=noise_seeds,
+                metadata={
+                    "model": model_type,
+                    "scheduler": scheduler,
+                    "shift": shift,
+                    "guidance_scale": guidance_scale,
+                    "num_inference_steps": num_inference_steps,
+                },
+            ))
+
+        # nothing above touched the running batch, so a failed admission leaves it intact
+        for num_inference_steps, row_scheduler, kwargs in new_rows:
+            self.scheduler.add(num_inference_steps, row_scheduler, **kwargs)
+        self.slots.extend(new_slots)
+        if self.controller is not None:
+            self.controller.add(len(new_slots))
+        new_latents = torch.cat(new_latents)
+        self.latents = new_latents if self.latents is None else torch.cat([self.latents, new_latents])
+
+    def retire(self, request_ids: List[str]):
+        """Drops rows without finishing them, e.g. cancelled requests."""
+        drop = [i for i, slot in enumerate(self.slots) if slot.request_id in set(request_ids)]
+        self._remove(drop)
+
+    def _remove(self, rows: List[int]):
+        if not rows:
+            return
+        keep = [i for i in range(len(self.slots)) if i not in set(rows)]
+        self.scheduler.remove(rows)
+        if self.controller is not None:
+            self.controller.remove(rows)
+        self.slots = [self.slots[i] for i in keep]
+        self.latents = self.latents[keep] if keep else None
+        if not keep:
+            self.pipe.maybe_free_model_hooks()
+
+    def _guided_embeds(self):
+        slots = self.slots
+        prompt_embeds = _cat_embeds([slot.prompt_embeds for slot in slots])
+        pooled_prompt_embeds = torch.cat([slot.pooled_prompt_embeds for slot in slots])
+        if self.guidance_scale > 1:
+            # negative halves first, as in `HiDreamImagePipeline.__call__`
+            negative_prompt_embeds = _cat_embeds([slot.negative_prompt_embeds for slot in slots])
+            prompt_embeds = _cat_embeds([negative_prompt_embeds, prompt_embeds])
+            pooled_prompt_embeds = torch.cat(
+                [torch.cat([slot.negative_pooled_prompt_embeds for slot in slots]), pooled_prompt_embeds]
+            )
+        return prompt_embeds, pooled_prompt_embeds
+
+    def _preview(self, noise_pred: torch.Tensor, timesteps: torch.Tensor, step_index: torch.Tensor):
+        every = self.runner.preview_every
+        rows = [
+            i for i, slot in enumerate(self.slots)
+            if slot.payload.get("on_preview") is not None and (int(step_index[i]) + 1) % every == 0
+        ]
+        if not rows:
+            return
+        t = timesteps[rows].view(-1, 1, 1, 1) / self.scheduler.config.num_train_timesteps
+        denoised = self.latents[rows] - t * noise_pred[rows]
+        for i, image in zip(rows, latents_to_rgb(denoised)):
+            self.slots[i].payload["on_preview"](int(step_index[i]), image)
+
+    def _step_noise(self, step_index: torch.Tensor) -> Optional[torch.Tensor]:
+        num_steps = [row.num_inference_steps for row in self.scheduler.rows]
+        shape, device = self.latents.shape[1:], self.latents.device
+        noise = [
+            # a row's final step discards its noise, as in the pipeline
+            slot.noise_seeds.randn(shape, torch.float32, device, step=int(i), cache=self.runner.noise_cache)
+            if i < n - 1 else torch.zeros((1, *shape), device=device)
+            for slot, i, n in zip(self.slots, step_index.tolist(), num_steps)
+        ]
+        return torch.cat(noise)
+
+    @torch.inference_mode()
+    def step(self, cancellation_token: Optional[CancellationToken] = None) -> List[Tuple[str, Any]]:
+        """
+        Runs one transformer forward over the running batch and advances every row by one step. Returns
+        `(request_id, result)` for the rows that finished; a result is `(image, seed)` or a `Future` of it when the
+        runner decodes in the background. Raises `GenerationCancelled` if `cancellation_token` fires mid-forward.
+        """
+        pipe = self.pipe
+        latents = self.latents
+        step_index = self.scheduler.step_index
+        timesteps = self.scheduler.timesteps(latents.device)
+        prompt_embeds, pooled_prompt_embeds = self._guided_embeds()
+        img_sizes, img_ids = pipe.prepare_image_ids(latents, self.guidance_scale > 1)
+
+        pipe.transformer.cancellation_token = cancellation_token
+        try:
+            with span("transformer", batch_size=len(self.slots)):
+                noise_pred = pipe.predict_noise(
+                    latents, timesteps, prompt_embeds, pooled_prompt_embeds, img_sizes, img_ids,
+                    guidance_scale=self.guidance_scale,
+                )
+        finally:
+            pipe.transformer.cancellation_token = None
+        self._preview(noise_pred, timesteps, step_index)
+
+        # rows whose prediction settled finish now, straight at their `denoised`
+        num_steps = [row.num_inference_steps for row in self.scheduler.rows]
+        skipped = [0] * len(self.slots)
+        if self.controller is not None:
+            denoised = latents - timesteps.view(-1, 1, 1, 1) / self.scheduler.config.num_train_timesteps * noise_pred
+            settled = self.controller.update(denoised, step_index, num_steps).nonzero().flatten().tolist()
+            for i in settled:
+                skipped[i] = self.controller.skipped_steps(int(step_index[i]), num_steps[i])
+
+        step_kwargs = {}
+        if "noise" in inspect.signature(self.scheduler.step).parameters:
+            step_kwargs["noise"] = self._step_noise(step_index)
+        with span("scheduler", batch_size=len(self.slots)):
+            self.latents = self.scheduler.step(noise_pred, latents, return_dict=False, **step_kwargs)[0].to(latents.dtype)
+
+        for i, count in enumerate(skipped):
+            if count:
+                self.latents[i] = denoised[i]
+        finished = [i for i, done in enumerate(self.scheduler.finished) if done or skipped[i]]
+        if not finished:
+            return []
+        for i in finished:
+            record_steps(self.slots[i].payload, num_steps[i], skipped[i])
+        results = self._decode([self.slots[i] for i in finished], self.latents[finished])
+        self._remove(finished)
+        return results
+
+    def _decode(self, slots: List[_Slot], latents: torch.Tensor) -> List[Tuple[str, Any]]:
+        width, height = self.key[2]
+        for slot, item in zip(slots, latents):
+            if slot.payload.get("latents_path"):
+                batch = make_latent_batch(item[None], [slot.payload["prompt"]], [slot.seed], (width, height), **slot.metadata)
+                save_latents(batch, slot.payload["latents_path"], storage=self.runner.latent_storage)
+
+        if self.runner.decoder is None:
+            images = self.pipe.decode_latents(latents)
+            return [(slot.request_id, (image, slot.seed)) for slot, image in zip(slots, images)]
+
+        # the decode overlaps with the next steps
+        decoded = self.runner.decoder.submit(latents)
+        results = []
+        for i, slot in enumerate(slots):
+            result = Future()
+            def finish(decoded, result=result, i=i, seed=slot.seed):
+                try:
+                    result.set_result((decoded.result()[i], seed))
+                except Exception as e:
+                    result.set_exception(RuntimeError(f"Image decoding failed: {str(e)}"))
+            decoded.add_done_callback(finish)
+            results.append((slot.request_id, result))
+        return results
+
+
+class ContinuousBatchScheduler(MicroBatchScheduler):
+    """
+    A `MicroBatchScheduler` that batches at the granularity of denoising steps instead of whole generations.
+
+    The worker keeps one running batch in `engine` (a `ContinuousPipelineEngine`). Before every step it retires
+    cancelled rows and admits pending requests into the free rows, as long as they share the running batch's lane;
+    admission goes in priority order and stops at the first request of another lane, which then runs once the batch
+    drains, so no lane starves. A request that finishes returns at once instead of waiting for its batch mates, and a
+    new one starts at the next step instead of after the current batch.
+
+    Submitting, cancelling, `status` and `metrics` work as for `MicroBatchScheduler`; in `metrics`, a "batch" is one
+    step of the running batch.
+
+    Args:
+        engine (`ContinuousPipelineEngine`):
+            Holds the running batch. Only ever used from the worker thread.
+        max_batch_size (`int`, defaults to 4):
+            Upper bound on the number of rows in the running batch.
+    """
+
+    def __init__(self, engine: ContinuousPipelineEngine, max_batch_size: int = 4):
+        super().__init__(run_batch=None, max_batch_size=max_batch_size, max_wait=0.0)
+        self.engine = engine
+        self._lane = None
+
+    def _admissible(self) -> Optional[List[BatchRequest]]:
+        with self._cond:
+            while not self._pending and not self._running and not self._stopped:
+                self._cond.wait()
+            if self._stopped:
+                # the running batch is finished, nothing new is started
+                return None if not self._running else []
+
+            room = self.max_batch_size - len(self._running)
+            lane = self._lane if self._running else None
+            taken = []
+            for request in sorted(self._pending, key=self._order):
+                if len(taken) >= room:
+                    break
+                request_lane = self.engine.lane(request.key)
+                if lane is None:
+                    lane = request_lane
+                elif request_lane != lane:
+                    break
+                taken.append(request)
+
+            ids = {id(r) for r in taken}
+            self._pending = [r for r in self._pending if id(r) not in ids]
+            taken = [r for r in taken if r.future.set_running_or_notify_cancel()]
+            now = time.monotonic()
+            for request in taken:
+                self._running[request.request_id] = request
+                self._queue_waits.append(now - request.enqueued_at)
+            if taken:
+                self._lane = lane
+            return taken
+
+    def _loop(self):
+        while True:
+            admitted = self._admissible()
+            if admitted is None:
+                break
+
+            with self._cond:
+                cancelled = [r for r in self._running.values() if r.cancellation_token.cancelled]
+            if cancelled:
+                self.engine.retire([r.request_id for r in cancelled])
+                self._retire(cancelled, error=GenerationCancelled("Generation was cancelled"))
+
+            if admitted:
+                try:
+                    self.engine.admit([(r.request_id, r.key, r.payload) for r in admitted])
+                except Exception as e:
+                    self._retire(admitted, error=e)
+
+            with self._cond:
+                running = list(self._running.values())
+            if not running:
+                continue
+
+            start = time.monotonic()
+            token = AllCancelledToken([r.cancellation_token for r in running])
+            try:
+                finished = self.engine.step(token)
+            except Exception as e:
+                # the whole batch is lost; cancelled rows are reported as such by `_retire`
+                self.engine.reset()
+                if isinstance(e, GenerationCancelled) and torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+                self._retire(running, error=e)
+                finished = []
+            with self._cond:
+                self._batches += 1
+                self._batch_sizes.append(len(running))
+                self._batch_seconds.append(time.monotonic() - start)
+
+            for request_id, result in finished:
+                with self._cond:
+                    request = self._running.get(request_id)
+                if request is None:
+                    continue
+                if isinstance(result, Future):
+                    with self._cond:
+                        self._running.pop(request_id, None)
+                    result.add_done_callback(lambda f, request=request: self._complete(request, future=f))
+                else:
+                    self._retire([request], results=[result])
+
+    def _retire(self, requests: List[BatchRequest], results: Optional[List[Any]] = None, error: Optional[Exception] = None):
+        with self._cond:
+            for request in requests:
+                self._running.pop(request.request_id, None)
+        for i, request in enumerate(requests):
+            self._complete(request, result=None if results is None else results[i], error=error)
+
+    def _complete(self, request: BatchRequest, result=None, error=None, future: Future = None):
+        if future is not None:
+            try:
+                result = future.result()
+            except Exception as e:
+                error = e
+        if request.cancellation_token.cancelled:
+            error = GenerationCancelled("Generation was cancelled")
+        with self._cond:
+            if isinstance(error, GenerationCancelled):
+                self._cancelled += 1
+            elif error is not None:
+                self._failed += 1
+            else:
+                self._completed += 1
+        if error is not None:
+            request.future.set_exception(error)
+        else:
+            request.future.set_result(result)
+
+    def metrics(self) -> dict:
+        metrics = super().metrics()
+        with self._cond:
+            metrics["lane"] = list(self._lane) if self._running else None
+        return metrics
@@ -0,0 +1,211 @@
+import itertools
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Optional, Union
+
+import torch
+import torch.multiprocessing as mp
+
+
+def _to_shared(value, dtype: torch.dtype):
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple)):
+        return [_to_shared(v, dtype) for v in value]
+    # shared memory tensors are handed over by file descriptor instead of being pickled
+    return value.to(device="cpu", dtype=dtype).contiguous().share_memory_()
+
+
+def _to_device(value, device: Union[str, torch.device]):
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple)):
+        return [_to_device(v, device) for v in value]
+    return value.to(device, non_blocking=True)
+
+
+def _worker_main(model_type: str, device: str, text_encoder_quant: str, output_dtype: torch.dtype, requests, results):
+    try:
+        from .nf4 import load_text_encoders
+        pipe = load_text_encoders(model_type, device=device, text_encoder_quant=text_encoder_quant)
+    except Exception as e:
+        results.put(("error", None, f"{type(e).__name__}: {e}"))
+        return
+    results.put(("ready", None, None))
+
+    while True:
+        item = requests.get()
+        if item is None:
+            break
+        request_id, kwargs = item
+        try:
+            with torch.inference_mode():
+                outputs = pipe.encode_prompt(device=torch.device(device), **kwargs)
+                payload = tuple(_to_shared(x, output_dtype) for x in outputs)
+            results.put(("done", request_id, payload))
+        except Exception as e:
+            results.put(("error", request_id, f"{type(e).__name__}: {e}"))
+
+
+class PromptEncoderWorker:
+    """
+    Runs the HiDream text encoders (CLIP-L, CLIP-G, T5 and Llama) in a dedicated process.
+
+    Prompts are submitted asynchronously and return a `Future`; the embeddings come back through shared memory, so
+    only a file descriptor crosses the process boundary. Because encoding no longer blocks the denoising process,
+    request N+1 can be encoded while request N is still denoising. Attach the worker with
+    `HiDreamImagePipeline.set_prompt_encoder` to make `encode_prompt` use it transparently; `PipelineRunner.prefetch`
+    submits the next queued batch's prompts ahead of time and hands the future to `encode_prompt`.
+
+    Args:
+        model_type (`str`):
+            Key into `MODEL_CONFIGS`; selects which checkpoint the CLIP/T5 encoders are loaded from.
+        device (`str`, defaults to `"cpu"`):
+            Device the encoders run on inside the worker, e.g. `"cpu"` or `"cuda:1"`.
+        text_encoder_quant (`str`, defaults to `"bf16"`):
+            Quantization of the Llama encoder, see `TEXT_ENCODER_QUANT_OPTIONS`.
+        output_dtype (`torch.dtype`, defaults to `torch.bfloat16`):
+            Dtype of the embeddings handed back to the denoiser.
+    """
+
+    # seconds between liveness checks of the worker process while no result arrives
+    poll_interval = 1.0
+
+    def __init__(
+        self,
+        model_type: str,
+        device: str = "cpu",
+        text_encoder_quant: str = "bf16",
+        output_dtype: torch.dtype = torch.bfloat16,
+    ):
+        self.model_type = model_type
+        self.device = device
+        self.text_encoder_quant = text_encoder_quant
+        self.output_dtype = output_dtype
+
+        ctx = mp.get_context("spawn")
+        self._requests = ctx.Queue()
+        self._results = ctx.Queue()
+        self._process = ctx.Process(
+            target=_worker_main,
+            args=(model_type, device, text_encoder_quant, output_dtype, self._requests, self._results),
+            daemon=True,
+        )
+        self._futures = {}
+        self._error = None
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._ready = Future()
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+
+    def start(self, timeout: Optional[float] = None):
+        """Starts the worker process and blocks until the encoders are loaded."""
+        self._process.start()
+        self._collector.start()
+        self._ready.result(timeout=timeout)
+        return self
+
+    def _fail_all(self, error: Exception):
+        with self._lock:
+            self._error = error
+            futures, self._futures = self._futures, {}
+        if not self._ready.done():
+            self._ready.set_exception(error)
+        for future in futures.values():
+            future.set_exception(error)
+
+    def _collect(self):
+        while True:
+            try:
+                status, request_id, payload = self._results.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if self._process.is_alive():
+                    continue
+                # killed (e.g. by the OOM killer) or crashed; nothing will answer the pending requests
+                self._fail_all(RuntimeError(f"Prompt encoder worker exited with code {self._process.exitcode}"))
+                return
+            if status == "ready":
+                self._ready.set_result(True)
+                continue
+            if request_id is None:
+                # the worker failed before it could serve any request
+                self._fail_all(RuntimeError(f"Prompt encoder worker failed to start: {payload}"))
+                return
+            if status == "stopped":
+                return
+            with self._lock:
+                future = self._futures.pop(request_id, None)
+            if future is None:
+                continue
+            if status == "done":
+                future.set_result(payload)
+            else:
+                future.set_exception(RuntimeError(f"Prompt encoding failed: {payload}"))
+
+    def submit(
+        self,
+        prompt,
+        prompt_2=None,
+        prompt_3=None,
+        prompt_4=None,
+        num_images_per_prompt: int = 1,
+        do_classifier_free_guidance: bool = True,
+        negative_prompt=None,
+        negative_prompt_2=None,
+        negative_prompt_3=None,
+        negative_prompt_4=None,
+        max_sequence_length: int = 128,
+    ) -> Future:
+        """
+        Queues a prompt for encoding. The future resolves to the `encode_prompt` tuple `(prompt_embeds,
+        negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds)` as shared CPU tensors.
+        """
+        if not self._process.is_alive():
+            raise RuntimeError("Prompt encoder worker is not running, call `start()` first")
+        future = Future()
+        with self._lock:
+            if self._error is not None:
+                raise self._error
+            request_id = next(self._ids)
+            self._futures[request_id] = future
+        self._requests.put((request_id, dict(
+            prompt=prompt,
+            prompt_2=prompt_2,
+            prompt_3=prompt_3,
+            prompt_4=prompt_4,
+            num_images_per_prompt=num_images_per_prompt,
+            do_classifier_free_guidance=do_classifier_free_guidance,
+            negative_prompt=negative_prompt,
+            negative_prompt_2=negative_prompt_2,
+            negative_prompt_3=negative_prompt_3,
+            negative_prompt_4=negative_prompt_4,
+            max_sequence_length=max_sequence_length,
+        )))
+        return future
+
+    def encode(self, device: Union[str, torch.device] = None, future: Optional[Future] = None, **kwargs):
+        """
+        Blocking version of `submit` that also moves the embeddings to `device`. Pass a `future` returned by an
+        earlier `submit` call to collect a prompt that was encoded ahead of time.
+        """
+        future = future or self.submit(**kwargs)
+        outputs = future.result()
+        if device is not None:
+            outputs = tuple(_to_device(x, device) for x in outputs)
+        return outputs
+
+    def close(self, timeout: float = 10.0):
+        """Stops the worker process."""
+        if self._process.is_alive():
+            self._requests.put(None)
+            self._process.join(timeout)
+            if self._process.is_alive():
+                self._process.terminate()
+        self._results.put(("stopped", -1, None))
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
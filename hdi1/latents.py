@@ -0,0 +1,87 @@
+import json
+from dataclasses import dataclass, field
+from typing import List, Union
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+# On-disk precision of saved latents:
+#   bf16 - lossless for the bf16 latents the pipeline produces
+#   fp16 - same size as bf16, more mantissa, less range
+#   int8 - per-channel absmax quantization, half the size of bf16
+LATENT_STORAGE_FORMATS = ["bf16", "fp16", "int8"]
+
+LATENT_FILE_FORMAT = "hdi1-latents"
+
+
+@dataclass
+class LatentBatch:
+    """
+    Output of the denoising stage: the latents (B, C, H, W) as returned with `output_type="latent"`, plus one metadata
+    dict per item (prompt, seed, model, scheduler, size, ...) so the decode stage and re-decodes can be run anywhere.
+    """
+
+    latents: torch.Tensor
+    metadata: List[dict] = field(default_factory=list)
+
+    def __post_init__(self):
+        if not self.metadata:
+            self.metadata = [{} for _ in range(self.latents.shape[0])]
+        if len(self.metadata) != self.latents.shape[0]:
+            raise ValueError(f"Got {len(self.metadata)} metadata entries for {self.latents.shape[0]} latents")
+
+    def __len__(self):
+        return self.latents.shape[0]
+
+    def __getitem__(self, index: int) -> "LatentBatch":
+        return LatentBatch(self.latents[index:index + 1], [self.metadata[index]])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def to(self, *args, **kwargs) -> "LatentBatch":
+        return LatentBatch(self.latents.to(*args, **kwargs), self.metadata)
+
+    @staticmethod
+    def cat(batches: List["LatentBatch"]) -> "LatentBatch":
+        """Joins batches with equal latent shapes into one, e.g. to decode items from several requests together."""
+        shapes = {tuple(batch.latents.shape[1:]) for batch in batches}
+        if len(shapes) != 1:
+            raise ValueError(f"Cannot concatenate latents of different shapes: {sorted(shapes)}")
+        return LatentBatch(
+            torch.cat([batch.latents for batch in batches]),
+            [meta for batch in batches for meta in batch.metadata],
+        )
+
+
+def save_latents(batch: LatentBatch, path: str, storage: str = "bf16"):
+    """Writes `batch` to a safetensors file in the compact `storage` precision."""
+    if storage not in LATENT_STORAGE_FORMATS:
+        raise ValueError(f"Invalid latent storage: {storage}, expected one of {LATENT_STORAGE_FORMATS}")
+    latents = batch.latents.detach().to("cpu", torch.float32)
+    if storage == "int8":
+        scale = latents.abs().amax(dim=(-2, -1), keepdim=True).clamp(min=1e-8) / 127
+        tensors = {
+            "latents": torch.round(latents / scale).to(torch.int8).contiguous(),
+            "scale": scale.contiguous(),
+        }
+    else:
+        tensors = {"latents": latents.to(torch.bfloat16 if storage == "bf16" else torch.float16).contiguous()}
+    save_file(tensors, path, metadata={
+        "format": LATENT_FILE_FORMAT,
+        "storage": storage,
+        "metadata": json.dumps(batch.metadata),
+    })
+
+
+def load_latents(path: str, device: Union[str, torch.device] = "cpu", dtype: torch.dtype = torch.bfloat16) -> LatentBatch:
+    """Reads a file written by `save_latents`."""
+    with safe_open(path, framework="pt", device="cpu") as f:
+        header = f.metadata() or {}
+        if header.get("format") != LATENT_FILE_FORMAT:
+            raise ValueError(f"{path} is not a saved latent file")
+        latents = f.get_tensor("latents")
+        if header["storage"] == "int8":
+            latents = latents.to(torch.float32) * f.get_tensor("scale")
+    return LatentBatch(latents.to(device=device, dtype=dtype), json.loads(header["metadata"]))
@@ -0,0 +1,104 @@
+import csv
+import json
+import os
+import time
+from itertools import islice
+
+try:
+    from .nf4 import MODEL_CONFIGS, generate_images
+except ImportError:
+    # Fallback for direct execution
+    from hdi1.nf4 import MODEL_CONFIGS, generate_images
+
+
+def parse_res(res: str) -> tuple[int, int]:
+    width, height = (int(v) for v in str(res).lower().strip().split("x"))
+    return width, height
+
+
+def load_manifest(path: str, default_res: str = "1024x1024", default_seed: int = -1, output_dir: str = "outputs"):
+    """
+    Reads a prompt manifest. `.csv` files need a header row; anything else is read as JSON lines. Each row has a
+    `prompt` and optionally `seed`, `resolution` (`"WIDTHxHEIGHT"`) and `output`; rows without an `output` are written
+    to `output_dir/<row index>.png`.
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.lower().endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+    items = []
+    for i, row in enumerate(rows):
+        prompt = row.get("prompt")
+        if not prompt or not prompt.strip():
+            raise ValueError(f"{path}: row {i} has no prompt")
+        seed = row.get("seed")
+        items.append({
+            "index": i,
+            "prompt": prompt,
+            "seed": default_seed if seed in (None, "") else int(seed),
+            "resolution": parse_res(row.get("resolution") or default_res),
+            "output": row.get("output") or os.path.join(output_dir, f"{i:05d}.png"),
+        })
+    return items
+
+
+def iter_batches(items: list[dict], batch_size: int):
+    """Groups items by resolution (in manifest order within a group), at most `batch_size` per batch."""
+    groups = {}
+    for item in items:
+        groups.setdefault(item["resolution"], []).append(item)
+    for group in groups.values():
+        it = iter(group)
+        while batch := list(islice(it, batch_size)):
+            yield batch
+
+
+def save_image_atomic(image, path: str):
+    # Write to a sibling temp file first so an interrupted run never leaves a truncated output behind that a resumed
+    # run would mistake for a finished one.
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    root, ext = os.path.splitext(path)
+    tmp_path = f"{root}.partial{ext}"
+    image.save(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def run_manifest(pipe, model_type: str, items: list[dict], batch_size: int = 4, noise_cache=None):
+    """
+    Generates every manifest item whose output does not exist yet, `batch_size` prompts per pipeline call. Returns a
+    summary with the number of generated and skipped images and the throughput. A `NoiseCache` lets prompt sweeps
+    that repeat seeds skip regenerating their noise.
+    """
+    config = MODEL_CONFIGS[model_type]
+    todo = [item for item in items if not os.path.exists(item["output"])]
+    skipped = len(items) - len(todo)
+    if skipped:
+        print(f"⏭️ Skipping {skipped} item(s) with existing outputs")
+
+    st = time.time()
+    done = 0
+    for batch in iter_batches(todo, batch_size):
+        images, seeds = generate_images(
+            pipe,
+            [item["prompt"] for item in batch],
+            batch[0]["resolution"],
+            [item["seed"] for item in batch],
+            config["guidance_scale"],
+            config["num_inference_steps"],
+            noise_cache=noise_cache,
+        )
+        for item, image, seed in zip(batch, images, seeds):
+            save_image_atomic(image, item["output"])
+            print(f"✅ [{item['index']}] seed {seed} -> {item['output']}")
+        done += len(batch)
+        print(f"📦 {done}/{len(todo)} images, {done / (time.time() - st):.3f} images/s")
+
+    elapsed = time.time() - st
+    return {
+        "generated": done,
+        "skipped": skipped,
+        "elapsed": elapsed,
+        "images_per_second": done / elapsed if elapsed > 0 else 0.0,
+    }
@@ -6,7 +6,11 @@ try:
     from flash_attn_interface import flash_attn_func
     USE_FLASH_ATTN3 = True
 except:
-    from flash_attn import flash_attn_func
+    try:
+        from flash_attn import flash_attn_func
+    except ImportError:
+        # no flash-attn (e.g. CPU-only installs): fall back to torch's scaled_dot_product_attention
+        flash_attn_func = None
     USE_FLASH_ATTN3 = False
 
 # Copied from https://github.com/black-forest-labs/flux/blob/main/src/flux/math.py
@@ -18,7 +22,12 @@ def apply_rope(xq: torch.Tensor, xk: torch.Tensor, freqs_cis: torch.Tensor) -> t
     return xq_out.reshape(*xq.shape).type_as(xq), xk_out.reshape(*xk.shape).type_as(xk)
 
 def attention(query: torch.Tensor, key: torch.Tensor, value: torch.Tensor):
-    if USE_FLASH_ATTN3:
+    if flash_attn_func is None or not query.is_cuda:
+        # flash-attn kernels are CUDA only; SDPA takes (B, H, L, D)
+        hidden_states = torch.nn.functional.scaled_dot_product_attention(
+            query.transpose(1, 2), key.transpose(1, 2), value.transpose(1, 2)
+        ).transpose(1, 2)
+    elif USE_FLASH_ATTN3:
         hidden_states = flash_attn_func(query, key, value, causal=False, deterministic=False)[0]
     else:
         hidden_states = flash_attn_func(query, key, value, dropout_p=0., causal=False)
@@ -303,6 +303,8 @@ class HiDreamImageTransformer2DModel(
         self.max_seq = max_resolution[0] * max_resolution[1] // (patch_size * patch_size)
 
         self.gradient_checkpointing = False
+        # Set by the pipeline for the duration of a call; polled between blocks so a cancelled request stops mid-step
+        self.cancellation_token = None
 
     def _set_gradient_checkpointing(self, module, value=False):
         if hasattr(module, "gradient_checkpointing"):
@@ -435,6 +437,8 @@ class HiDreamImageTransformer2DModel(
         initial_encoder_hidden_states = torch.cat([encoder_hidden_states[-1], encoder_hidden_states[-2]], dim=1)
         initial_encoder_hidden_states_seq_len = initial_encoder_hidden_states.shape[1]
         for bid, block in enumerate(self.double_stream_blocks):
+            if self.cancellation_token is not None:
+                self.cancellation_token.raise_if_cancelled()
             cur_llama31_encoder_hidden_states = encoder_hidden_states[block_id]
             cur_encoder_hidden_states = torch.cat([initial_encoder_hidden_states, cur_llama31_encoder_hidden_states], dim=1)
             if self.training and self.gradient_checkpointing:
@@ -478,6 +482,8 @@ class HiDreamImageTransformer2DModel(
             image_tokens_masks = torch.cat([image_tokens_masks, encoder_attention_mask_ones], dim=1)
 
         for bid, block in enumerate(self.single_stream_blocks):
+            if self.cancellation_token is not None:
+                self.cancellation_token.raise_if_cancelled()
             cur_llama31_encoder_hidden_states = encoder_hidden_states[block_id]
             hidden_states = torch.cat([hidden_states, cur_llama31_encoder_hidden_states], dim=1)
             if self.training and self.gradient_checkpointing:
@@ -1,7 +1,9 @@
 import torch
-from transformers import LlamaForCausalLM, PreTrainedTokenizerFast
+from diffusers import AutoencoderKL
+from transformers import BitsAndBytesConfig, LlamaForCausalLM, PreTrainedTokenizerFast
 import sys
 import os
+from concurrent.futures import Future
 
 # Add parent directory to path for direct execution
 if __name__ == "__main__":
@@ -22,17 +24,58 @@ try:
     from . import HiDreamImageTransformer2DModel
     from .schedulers.fm_solvers_unipc import FlowUniPCMultistepScheduler
     from .schedulers.flash_flow_match import FlashFlowMatchEulerDiscreteScheduler
+    from .schedulers.registry import SCHEDULERS, make_scheduler, schedule_sigmas, scheduler_names
+    from .offload import stream_transformer_blocks
+    from .encoder_worker import PromptEncoderWorker
+    from .preview import LatentPreviewer
+    from .cancellation import GenerationCancelled
+    from .vae_decode import PipelinedDecoder, decode_latents_with_vae, vae_under_model_offload
+    from .latents import LatentBatch, save_latents
+    from .noise import NoiseCache
+    from .adaptive import AdaptiveStepController
+    from .tracing import span
 except ImportError:
     # Fallback for direct execution
     from hdi1 import HiDreamImagePipeline
     from hdi1 import HiDreamImageTransformer2DModel
     from hdi1.schedulers.fm_solvers_unipc import FlowUniPCMultistepScheduler
     from hdi1.schedulers.flash_flow_match import FlashFlowMatchEulerDiscreteScheduler
+    from hdi1.schedulers.registry import SCHEDULERS, make_scheduler, schedule_sigmas, scheduler_names
+    from hdi1.offload import stream_transformer_blocks
+    from hdi1.encoder_worker import PromptEncoderWorker
+    from hdi1.preview import LatentPreviewer
+    from hdi1.cancellation import GenerationCancelled
+    from hdi1.vae_decode import PipelinedDecoder, decode_latents_with_vae, vae_under_model_offload
+    from hdi1.latents import LatentBatch, save_latents
+    from hdi1.noise import NoiseCache
+    from hdi1.adaptive import AdaptiveStepController
+    from hdi1.tracing import span
 
 
 MODEL_PREFIX = "azaneko"
 LLAMA_MODEL_NAME = "unsloth/Meta-Llama-3.1-8B-Instruct"
 
+# Offload strategies for the transformer:
+#   sequential - accelerate sequential CPU offload for all pipeline components
+#   stream     - model CPU offload for the encoders/VAE, transformer blocks streamed with async prefetch
+OFFLOAD_MODES = ["sequential", "stream"]
+
+# Quantization of the Llama text encoder:
+#   bf16     - no quantization
+#   nf4      - bitsandbytes 4-bit NF4 (GPU)
+#   int8     - bitsandbytes LLM.int8() (GPU)
+#   cpu-int8 - torch dynamic int8 quantization of the linear layers (CPU)
+TEXT_ENCODER_QUANT_OPTIONS = ["bf16", "nf4", "int8", "cpu-int8"]
+
+# Placement of the Llama text encoder: "auto" follows the pipeline offload, "cpu" keeps it on the CPU
+TEXT_ENCODER_DEVICE_OPTIONS = ["auto", "cpu"]
+
+QUALITY_CHECK_PROMPTS = [
+    "A majestic cat wearing a crown, sitting on a throne made of books, digital art, hyperrealistic",
+    "A watercolor painting of a lighthouse on a cliff at sunset",
+    "Close-up photo of a dew-covered spider web, macro lens, shallow depth of field",
+]
+
 
 # Model configurations
 MODEL_CONFIGS = {
@@ -64,22 +107,160 @@ def log_vram(msg: str):
     print(f"{msg} (used {torch.cuda.memory_allocated() / 1024**2:.2f} MB VRAM)\n")
 
 
-def load_models(model_type: str):
+def apply_offload(pipe: HiDreamImagePipeline, transformer: HiDreamImageTransformer2DModel, offload: str, prefetch_depth: int):
+    if offload == "sequential":
+        pipe.enable_sequential_cpu_offload()
+    elif offload == "stream":
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        # the streamer places the transformer; model offload covers only the text encoders and the VAE
+        pipe.set_block_streamer(stream_transformer_blocks(transformer, device, prefetch_depth=prefetch_depth))
+        if device == "cuda":
+            pipe.enable_model_cpu_offload()
+        log_vram(f"✅ Transformer blocks streaming (prefetch depth {prefetch_depth})!")
+    else:
+        raise ValueError(f"Invalid offload mode: {offload}")
+
+
+def load_text_encoder(quant: str = "bf16", device: str = "auto", device_map=None):
+    """
+    Loads the Llama text encoder. `device_map` pins the GPU variants to explicit devices (e.g. `{"": "cuda:1"}`)
+    instead of spreading bf16 over every visible GPU and putting the bitsandbytes ones on GPU 0.
+    """
+    if quant not in TEXT_ENCODER_QUANT_OPTIONS:
+        raise ValueError(f"Invalid text encoder quantization: {quant}")
+    if device not in TEXT_ENCODER_DEVICE_OPTIONS:
+        raise ValueError(f"Invalid text encoder device: {device}")
+    if quant in ("nf4", "int8") and device == "cpu":
+        raise ValueError(f"bitsandbytes {quant} text encoder requires a GPU, use 'cpu-int8' to keep it on the CPU")
+
+    kwargs = dict(output_hidden_states=True, output_attentions=True, return_dict_in_generate=True)
+    if quant == "bf16":
+        text_encoder = LlamaForCausalLM.from_pretrained(
+            LLAMA_MODEL_NAME,
+            torch_dtype=torch.bfloat16,
+            device_map=device_map or ("auto" if device == "auto" else "cpu"),
+            **kwargs,
+        )
+    elif quant == "nf4":
+        text_encoder = LlamaForCausalLM.from_pretrained(
+            LLAMA_MODEL_NAME,
+            quantization_config=BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.bfloat16,
+            ),
+            torch_dtype=torch.bfloat16,
+            device_map=device_map or {"": 0},
+            **kwargs,
+        )
+    elif quant == "int8":
+        text_encoder = LlamaForCausalLM.from_pretrained(
+            LLAMA_MODEL_NAME,
+            quantization_config=BitsAndBytesConfig(load_in_8bit=True),
+            torch_dtype=torch.bfloat16,
+            device_map=device_map or {"": 0},
+            **kwargs,
+        )
+    else:
+        # Dynamic quantization kernels are CPU-only and expect float32 activations
+        text_encoder = LlamaForCausalLM.from_pretrained(
+            LLAMA_MODEL_NAME,
+            torch_dtype=torch.float32,
+            device_map="cpu",
+            **kwargs,
+        )
+        text_encoder = torch.ao.quantization.quantize_dynamic(text_encoder, {torch.nn.Linear}, dtype=torch.qint8)
+    text_encoder.eval()
+    return text_encoder
+
+
+@torch.inference_mode()
+def check_text_encoder_quality(quant: str, device: str = "auto", prompts: list[str] = None, min_cosine: float = 0.99):
+    """
+    Compares the hidden states of a quantized Llama encoder against the bf16 reference. The report passes when every
+    layer's mean cosine similarity reaches `min_cosine`; `text_encoder_quant` is the encoder to use, `quant` when it
+    passed and bf16 otherwise.
+    """
+    prompts = prompts or QUALITY_CHECK_PROMPTS
+    tokenizer = PreTrainedTokenizerFast.from_pretrained(LLAMA_MODEL_NAME)
+    tokenizer.pad_token = tokenizer.eos_token
+    inputs = tokenizer(prompts, padding="max_length", max_length=128, truncation=True, return_tensors="pt")
+    mask = inputs.attention_mask.bool()
+
+    def hidden_states(text_encoder):
+        encoder_device = text_encoder.device
+        outputs = text_encoder(
+            inputs.input_ids.to(encoder_device),
+            attention_mask=inputs.attention_mask.to(encoder_device),
+            output_hidden_states=True,
+        )
+        # same layers the pipeline hands to the transformer
+        return torch.stack(outputs.hidden_states[1:], dim=0).float().cpu()
+
+    reference = load_text_encoder("bf16", device)
+    expected = hidden_states(reference)
+    del reference
+    torch.cuda.empty_cache()
+
+    candidate = load_text_encoder(quant, device)
+    actual = hidden_states(candidate)
+    del candidate
+    torch.cuda.empty_cache()
+
+    cosine = torch.nn.functional.cosine_similarity(actual, expected, dim=-1)[:, mask]
+    rel_error = (actual - expected).norm(dim=-1)[:, mask] / expected.norm(dim=-1)[:, mask].clamp_min(1e-6)
+    per_layer = cosine.mean(dim=-1)
+    report = {
+        "quant": quant,
+        "mean_cosine": cosine.mean().item(),
+        "min_layer_cosine": per_layer.min().item(),
+        "worst_layer": per_layer.argmin().item(),
+        "mean_rel_error": rel_error.mean().item(),
+        "passed": per_layer.min().item() >= min_cosine,
+    }
+    report["text_encoder_quant"] = quant if report["passed"] else "bf16"
+    status = "✅" if report["passed"] else "❌"
+    print(
+        f"{status} Text encoder {quant}: mean cosine {report['mean_cosine']:.4f}, "
+        f"worst layer {report['worst_layer']} at {report['min_layer_cosine']:.4f}, "
+        f"mean relative error {report['mean_rel_error']:.4f}"
+    )
+    if not report["passed"]:
+        print(f"↩️ Below {min_cosine}; falling back to --text-encoder-quant {report['text_encoder_quant']}")
+    return report
+
+
+def load_models(
+    model_type: str,
+    offload: str = "sequential",
+    prefetch_depth: int = 1,
+    text_encoder_quant: str = "bf16",
+    text_encoder_device: str = "auto",
+    encoder_process: str = None,
+):
     config = MODEL_CONFIGS[model_type]
+    if offload not in OFFLOAD_MODES:
+        raise ValueError(f"Invalid offload mode: {offload}")
     
     tokenizer_4 = PreTrainedTokenizerFast.from_pretrained(LLAMA_MODEL_NAME)
     log_vram("✅ Tokenizer loaded!")
     
-    # Load text encoder without quantization
-    text_encoder_4 = LlamaForCausalLM.from_pretrained(
-        LLAMA_MODEL_NAME,
-        output_hidden_states=True,
-        output_attentions=True,
-        return_dict_in_generate=True,
-        torch_dtype=torch.bfloat16,
-        device_map="auto",
-    )
-    log_vram("✅ Text encoder loaded!")
+    prompt_encoder = None
+    detached_text_encoder_4 = None
+    if encoder_process is not None:
+        # All text encoders live in a worker process; the pipeline is loaded without them
+        prompt_encoder = PromptEncoderWorker(
+            model_type, device=encoder_process, text_encoder_quant=text_encoder_quant
+        ).start()
+        encoder_kwargs = dict(text_encoder=None, text_encoder_2=None, text_encoder_3=None, text_encoder_4=None)
+        log_vram(f"✅ Text encoders loaded in worker process ({encoder_process})!")
+    else:
+        text_encoder_4 = load_text_encoder(text_encoder_quant, text_encoder_device)
+        log_vram(f"✅ Text encoder loaded ({text_encoder_quant}, {text_encoder_device})!")
+        # Quantized and CPU-resident encoders are already placed; keep them away from the offload hooks
+        if text_encoder_quant != "bf16" or text_encoder_device != "auto":
+            detached_text_encoder_4, text_encoder_4 = text_encoder_4, None
+        encoder_kwargs = dict(text_encoder_4=text_encoder_4)
 
     try:
         transformer = HiDreamImageTransformer2DModel.from_pretrained(
@@ -102,12 +283,12 @@ def load_models(model_type: str):
             config["path"],
             scheduler=config["scheduler"](num_train_timesteps=1000, shift=config["shift"], use_dynamic_shifting=False),
             tokenizer_4=tokenizer_4,
-            text_encoder_4=text_encoder_4,
             torch_dtype=torch.bfloat16,
+            **encoder_kwargs,
         )
         pipe.transformer = transformer
         log_vram("✅ Pipeline loaded!")
-        pipe.enable_sequential_cpu_offload()
+        apply_offload(pipe, transformer, offload, prefetch_depth)
     except Exception as e:
         print(f"❌ Failed to load pipeline: {e}")
         # Try without torch_dtype
@@ -115,17 +296,64 @@ def load_models(model_type: str):
             config["path"],
             scheduler=config["scheduler"](num_train_timesteps=1000, shift=config["shift"], use_dynamic_shifting=False),
             tokenizer_4=tokenizer_4,
-            text_encoder_4=text_encoder_4,
+            **encoder_kwargs,
         )
         pipe.transformer = transformer
         log_vram("✅ Pipeline loaded (fallback)!")
-        pipe.enable_sequential_cpu_offload()
+        apply_offload(pipe, transformer, offload, prefetch_depth)
+    
+    if detached_text_encoder_4 is not None:
+        pipe.set_detached_text_encoder_4(detached_text_encoder_4)
+    if prompt_encoder is not None:
+        pipe.set_prompt_encoder(prompt_encoder)
     
     return pipe, config
 
 
+def load_text_encoders(model_type: str, device: str = "cpu", text_encoder_quant: str = "bf16"):
+    """Loads a pipeline that only holds the tokenizers and text encoders, e.g. inside a `PromptEncoderWorker`."""
+    config = MODEL_CONFIGS[model_type]
+    # bf16 matmuls are slow on most CPUs
+    dtype = torch.bfloat16 if torch.device(device).type == "cuda" else torch.float32
+    
+    tokenizer_4 = PreTrainedTokenizerFast.from_pretrained(LLAMA_MODEL_NAME)
+    # pinned to `device`: "auto" would spread Llama over every GPU, the denoiser's included
+    text_encoder_4 = load_text_encoder(
+        text_encoder_quant, "cpu" if device == "cpu" else "auto", device_map={"": str(torch.device(device))}
+    )
+    pipe = HiDreamImagePipeline.from_pretrained(
+        config["path"],
+        scheduler=None,
+        vae=None,
+        tokenizer_4=tokenizer_4,
+        text_encoder_4=None,
+        torch_dtype=dtype,
+    )
+    pipe.to(device)
+    pipe.set_detached_text_encoder_4(text_encoder_4)
+    log_vram(f"✅ Text encoders loaded on {device}!")
+    return pipe
+
+
+def load_vae(model_type: str, device: str = None):
+    """Loads only the VAE of `model_type`, for a decode stage that runs apart from the denoiser."""
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    dtype = torch.bfloat16 if device != "cpu" else torch.float32
+    vae = AutoencoderKL.from_pretrained(MODEL_CONFIGS[model_type]["path"], subfolder="vae", torch_dtype=dtype)
+    log_vram(f"✅ VAE loaded on {device}!")
+    return vae.to(device)
+
+
+def make_latent_batch(latents: torch.Tensor, prompts: list[str], seeds: list[int], resolution: tuple[int, int], **metadata):
+    width, height = resolution
+    return LatentBatch(latents, [
+        {"prompt": prompt, "seed": seed, "width": width, "height": height, **metadata}
+        for prompt, seed in zip(prompts, seeds)
+    ])
+
+
 @torch.inference_mode()
-def generate_image(pipe: HiDreamImagePipeline, model_type: str, prompt: str, resolution: tuple[int, int], seed: int):
+def generate_image(pipe: HiDreamImagePipeline, model_type: str, prompt: str, resolution: tuple[int, int], seed: int, output_type: str = "pil"):
     # Get configuration for current model
     config = MODEL_CONFIGS[model_type]
     guidance_scale = config["guidance_scale"]
@@ -138,10 +366,6 @@ def generate_image(pipe: HiDreamImagePipeline, model_type: str, prompt: str, res
     if seed == -1:
         seed = torch.randint(0, 1000000, (1,)).item()
     
-    # Check if CUDA is available, fallback to CPU if needed
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    generator = torch.Generator(device).manual_seed(seed)
-    
     try:
         images = pipe(
             prompt,
@@ -150,9 +374,12 @@ def generate_image(pipe: HiDreamImagePipeline, model_type: str, prompt: str, res
             guidance_scale=guidance_scale,
             num_inference_steps=num_inference_steps,
             num_images_per_prompt=1,
-            generator=generator
+            seeds=[seed],
+            output_type=output_type
         ).images
         
+        if output_type == "latent":
+            return make_latent_batch(images, [prompt], [seed], resolution, model=model_type, guidance_scale=guidance_scale, num_inference_steps=num_inference_steps), seed
         return images[0], seed
     except Exception as e:
         print(f"❌ Image generation failed: {e}")
@@ -167,10 +394,326 @@ def generate_image(pipe: HiDreamImagePipeline, model_type: str, prompt: str, res
                 guidance_scale=guidance_scale,
                 num_inference_steps=num_inference_steps,
                 num_images_per_prompt=1,
-                generator=generator
+                seeds=[seed],
+                output_type=output_type
             ).images
             
+            if output_type == "latent":
+                return make_latent_batch(images, [prompt], [seed], resolution, model=model_type, guidance_scale=guidance_scale, num_inference_steps=num_inference_steps), seed
             return images[0], seed
         except Exception as e2:
             raise RuntimeError(f"Image generation failed even with fallback: {e2}") from e2
 
+
+
+
+@torch.inference_mode()
+def generate_images(
+    pipe: HiDreamImagePipeline,
+    prompts: list[str],
+    resolution: tuple[int, int],
+    seeds: list[int],
+    guidance_scale: float,
+    num_inference_steps: int,
+    callback_on_step_end=None,
+    cancellation_token=None,
+    output_type: str = "pil",
+    noise_cache: NoiseCache = None,
+    step_controller: AdaptiveStepController = None,
+    sigmas: list[float] = None,
+    prompt_future: Future = None,
+):
+    """
+    Generates one image per prompt in a single pipeline call. Each item's initial and per-step noise is counter-based
+    Philox noise keyed by its seed, so an image doesn't depend on the batch it ran in or on the device; `noise_cache`
+    reuses the noise of seeds seen before, bit-identically. A `callback_on_step_end` may declare the tensors it needs
+    in a `tensor_inputs` attribute (see `LatentPreviewer`). A `step_controller` lets settled items finish early; the
+    steps each one skipped are in `pipe.skipped_steps` afterwards. `sigmas` replaces the scheduler's own schedule, e.g.
+    with a tuned one from the scheduler registry. `prompt_future` holds the prompts' embeddings from an earlier
+    `PromptEncoderWorker.submit` (see `PipelineRunner.prefetch`).
+    Raises `GenerationCancelled` if `cancellation_token` fires before the images are decoded. With
+    `output_type="latent"` the denoised latents are returned instead, for `pipe.decode_latents`.
+    """
+    width, height = resolution
+    seeds = [torch.randint(0, 1000000, (1,)).item() if seed == -1 else int(seed) for seed in seeds]
+    
+    images = pipe(
+        prompts,
+        height=height,
+        width=width,
+        guidance_scale=guidance_scale,
+        num_inference_steps=num_inference_steps,
+        num_images_per_prompt=1,
+        seeds=seeds,
+        callback_on_step_end=callback_on_step_end,
+        callback_on_step_end_tensor_inputs=getattr(callback_on_step_end, "tensor_inputs", ["latents"]),
+        cancellation_token=cancellation_token,
+        output_type=output_type,
+        noise_cache=noise_cache,
+        step_controller=step_controller,
+        sigmas=sigmas,
+        prompt_future=prompt_future,
+    ).images
+    return images, seeds
+
+
+def generate_latents(
+    pipe: HiDreamImagePipeline,
+    prompts: list[str],
+    resolution: tuple[int, int],
+    seeds: list[int],
+    guidance_scale: float,
+    num_inference_steps: int,
+    metadata: dict = None,
+    **kwargs,
+) -> LatentBatch:
+    """
+    First stage of the two-stage API: denoises without decoding and returns the latents with per-item metadata
+    (prompt, seed, size, sampling settings and anything in `metadata`). Decode them with `decode_latents`.
+    """
+    latents, seeds = generate_images(
+        pipe, prompts, resolution, seeds, guidance_scale, num_inference_steps, output_type="latent", **kwargs
+    )
+    return make_latent_batch(
+        latents, prompts, seeds, resolution,
+        guidance_scale=guidance_scale, num_inference_steps=num_inference_steps, **(metadata or {}),
+    )
+
+
+def decode_latents(decoder, batch, output_type: str = "pil", mode: str = "auto"):
+    """
+    Second stage of the two-stage API: decodes a `LatentBatch` (or a list of them with equal shapes) into images.
+    `decoder` is either a loaded pipeline or a bare VAE from `load_vae`, so decoding can run in its own process and be
+    batched across requests independently of denoising. `mode` only applies to a bare VAE; a pipeline uses its
+    `vae_decode_mode`.
+    """
+    if isinstance(batch, (list, tuple)):
+        batch = LatentBatch.cat(list(batch))
+    if isinstance(decoder, HiDreamImagePipeline):
+        return decoder.decode_latents(batch.latents, output_type=output_type)
+    latents = batch.latents.to(device=decoder.device, dtype=decoder.dtype)
+    return decode_latents_with_vae(decoder, latents, mode=mode, output_type=output_type)
+
+
+def validate_generation_params(prompt: str, seed: int, guidance_scale: float, num_inference_steps: int, shift: float):
+    if not prompt or len(prompt.strip()) == 0:
+        raise ValueError("Prompt cannot be empty")
+    if not isinstance(seed, (int, float)) or seed < -1:
+        raise ValueError("Seed must be -1 or a non-negative integer")
+    if num_inference_steps < 1 or num_inference_steps > 100:
+        raise ValueError("Number of inference steps must be between 1 and 100")
+    if guidance_scale < 0 or guidance_scale > 10:
+        raise ValueError("Guidance scale must be between 0 and 10")
+    if shift < 1 or shift > 10:
+        raise ValueError("Shift must be between 1 and 10")
+
+
+def record_steps(payload: dict, num_inference_steps: int, skipped_steps: int):
+    """Fills the payload's `stats` dict, if it has one, with the steps the item ran and skipped."""
+    stats = payload.get("stats")
+    if stats is not None:
+        stats["steps_run"] = num_inference_steps - skipped_steps
+        stats["skipped_steps"] = skipped_steps
+
+
+class PipelineRunner:
+    """
+    Owns the warm pipeline behind a `MicroBatchScheduler`: `runner(key, payloads)` is the scheduler's `run_batch`.
+
+    The model is loaded on first use and swapped when a batch asks for a different one. Every front end (Gradio UI,
+    HTTP API) submits through the same scheduler, so they share the loaded model. Build keys with `PipelineRunner.key`;
+    payloads are dicts with `prompt`, `seed`, an optional `on_preview(step, image)` callable that receives
+    low-resolution previews while the item denoises, an optional `latents_path` where the item's denoised latents
+    are saved for re-decoding, and an optional `stats` dict that receives the item's `steps_run` and `skipped_steps`.
+    Each result is an `(image, seed)` tuple.
+
+    Args:
+        preview_every (`int`, defaults to 1):
+            Preview interval in steps for payloads with `on_preview`.
+        vae_decode_mode (`str`, defaults to `"auto"`):
+            See `HiDreamImagePipeline.set_vae_decode_mode`.
+        pipelined_decode (`bool`, defaults to `False`):
+            Decode each batch on a background thread while the next batch denoises; the runner then returns a
+            `Future`. Ignored while the VAE is under model CPU offload, whose hooks are not safe to run concurrently.
+        latent_storage (`str`, defaults to `"bf16"`):
+            Precision of latents saved for payloads with `latents_path`, see `LATENT_STORAGE_FORMATS`.
+        noise_cache_mb (`int`, defaults to 0):
+            Size of a `NoiseCache` for the initial latents and step noise of recently used seeds; 0 disables it.
+        compile_step (`bool`, defaults to `False`):
+            Fuse the guided scheduler step into one `torch.compile`d kernel where the scheduler supports it.
+        dynamic_shift (`bool`, defaults to `False`):
+            Treat a request's shift as the shift at the native token count and scale it to the tokens actually
+            generated (see `make_scheduler`).
+        adaptive_tolerance (`float`, defaults to 0):
+            Finish items early once their prediction changes by less than this between steps (see
+            `AdaptiveStepController`); 0 always runs the full schedule.
+        adaptive_min_steps (`int`, defaults to 4):
+            Steps every item runs before it may finish early.
+        **load_kwargs:
+            Extra arguments for `load_models`, e.g. `offload` or `text_encoder_quant`.
+    """
+
+    def __init__(
+        self,
+        preview_every: int = 1,
+        vae_decode_mode: str = "auto",
+        pipelined_decode: bool = False,
+        latent_storage: str = "bf16",
+        noise_cache_mb: int = 0,
+        compile_step: bool = False,
+        dynamic_shift: bool = False,
+        adaptive_tolerance: float = 0.0,
+        adaptive_min_steps: int = 4,
+        **load_kwargs,
+    ):
+        self.preview_every = preview_every
+        self.latent_storage = latent_storage
+        self.noise_cache = NoiseCache(noise_cache_mb * 1024**2) if noise_cache_mb > 0 else None
+        self.compile_step = compile_step
+        self.dynamic_shift = dynamic_shift
+        self.adaptive_tolerance = adaptive_tolerance
+        self.adaptive_min_steps = adaptive_min_steps
+        self.vae_decode_mode = vae_decode_mode
+        self.pipelined_decode = pipelined_decode
+        self.load_kwargs = load_kwargs
+        self.pipe = None
+        self.model_type = None
+        self.decoder = None
+        self._prefetched = {}
+        self._next_prompt_key = None
+
+    def step_controller(self):
+        """A fresh `AdaptiveStepController` for one generation, or `None` when adaptive steps are off."""
+        if self.adaptive_tolerance <= 0:
+            return None
+        return AdaptiveStepController(self.adaptive_tolerance, min_steps=self.adaptive_min_steps)
+
+    @staticmethod
+    def key(model_type: str, scheduler: str, resolution: tuple[int, int], num_inference_steps: int, guidance_scale: float, shift: float):
+        if model_type not in MODEL_CONFIGS:
+            raise ValueError(f"Invalid model: {model_type}")
+        if scheduler not in scheduler_names():
+            raise ValueError(f"Invalid scheduler: {scheduler}")
+        # a tuned schedule fixes the number of steps
+        sigmas = schedule_sigmas(scheduler)
+        if sigmas is not None:
+            num_inference_steps = len(sigmas)
+        return (model_type, scheduler, tuple(resolution), int(num_inference_steps), float(guidance_scale), float(shift))
+
+    @staticmethod
+    def _prompt_key(key, payloads: list[dict]):
+        model_type, guidance_scale = key[0], key[4]
+        return model_type, guidance_scale > 1, tuple(payload["prompt"] for payload in payloads)
+
+    def prefetch(self, key, payloads: list[dict]):
+        """
+        Starts encoding the prompts of the batch expected to run next on the prompt encoder worker, so they are
+        encoded while the current batch denoises. Called by `MicroBatchScheduler`; a no-op without an encoder worker
+        or while another model is loaded. The embeddings are used only if the next batch has exactly these prompts.
+        """
+        if self.pipe is None or key[0] != self.model_type or self.pipe.prompt_encoder is None:
+            return
+        prompt_key = self._next_prompt_key = self._prompt_key(key, payloads)
+        if prompt_key in self._prefetched:
+            return
+        self._prefetched[prompt_key] = self.pipe.prompt_encoder.submit(
+            prompt=list(prompt_key[2]),
+            num_images_per_prompt=1,
+            do_classifier_free_guidance=prompt_key[1],
+        )
+
+    def load(self, model_type: str):
+        if model_type == self.model_type:
+            return self.pipe
+        if self.pipe is not None:
+            print(f"🔄 Unloading model {self.model_type}...")
+            if self.decoder is not None:
+                self.decoder.close()
+                self.decoder = None
+            self.pipe = None
+            torch.cuda.empty_cache()
+        print(f"🔄 Loading model {model_type}...")
+        self.pipe, _ = load_models(model_type, **self.load_kwargs)
+        self.pipe.set_vae_decode_mode(self.vae_decode_mode)
+        self.model_type = model_type
+        if self.pipelined_decode:
+            if vae_under_model_offload(self.pipe.vae):
+                print("⚠️ Pipelined VAE decode disabled: the VAE is under model CPU offload")
+            else:
+                self.decoder = PipelinedDecoder(self.pipe)
+        return self.pipe
+
+    def __call__(self, key, payloads: list[dict], cancellation_token=None):
+        model_type, scheduler, resolution, num_inference_steps, guidance_scale, shift = key
+        pipe = self.load(model_type)
+
+        # Set scheduler with shift for flow-matching schedulers
+        pipe.scheduler = make_scheduler(scheduler, shift, dynamic_shift=self.dynamic_shift)
+        if self.compile_step and hasattr(pipe.scheduler, "enable_compiled_step"):
+            pipe.scheduler.enable_compiled_step()
+
+        sinks = [payload.get("on_preview") for payload in payloads]
+        previewer = LatentPreviewer(sinks, every=self.preview_every) if any(sinks) else None
+
+        # Split denoise and decode only when something needs the latents
+        keep_latents = self.decoder is not None or any(payload.get("latents_path") for payload in payloads)
+        generate = generate_latents if keep_latents else generate_images
+        extra = {"metadata": {"model": model_type, "scheduler": scheduler, "shift": shift}} if keep_latents else {}
+        # the scheduler prefetches the following batch before running this one; anything older was for a batch
+        # that changed before it ran
+        prompt_future = self._prefetched.pop(self._prompt_key(key, payloads), None)
+        self._prefetched = {k: f for k, f in self._prefetched.items() if k == self._next_prompt_key}
+        self._next_prompt_key = None
+
+        try:
+            with span("batch", model=model_type, scheduler=scheduler, resolution=resolution,
+                      batch_size=len(payloads), steps=num_inference_steps):
+                output = generate(
+                    pipe,
+                    [payload["prompt"] for payload in payloads],
+                    resolution,
+                    [payload["seed"] for payload in payloads],
+                    guidance_scale,
+                    num_inference_steps,
+                    callback_on_step_end=previewer,
+                    cancellation_token=cancellation_token,
+                    noise_cache=self.noise_cache,
+                    step_controller=self.step_controller(),
+                    sigmas=schedule_sigmas(scheduler),
+                    prompt_future=prompt_future,
+                    **extra,
+                )
+        except GenerationCancelled:
+            # the activations of the aborted step are gone by now; hand their memory back right away
+            pipe.maybe_free_model_hooks()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            print(f"🛑 Cancelled batch of {len(payloads)} image(s)")
+            raise
+        except Exception as e:
+            raise RuntimeError(f"Image generation failed: {str(e)}") from e
+        for payload, skipped in zip(payloads, pipe.skipped_steps):
+            record_steps(payload, num_inference_steps, skipped)
+        if not keep_latents:
+            images, seeds = output
+            return list(zip(images, seeds))
+
+        batch = output
+        seeds = [meta["seed"] for meta in batch.metadata]
+        for item, payload in zip(batch, payloads):
+            if payload.get("latents_path"):
+                save_latents(item, payload["latents_path"], storage=self.latent_storage)
+        if self.decoder is None:
+            images = decode_latents(pipe, batch)
+            pipe.maybe_free_model_hooks()
+            return list(zip(images, seeds))
+
+        # the decode overlaps with the next batch
+        results = Future()
+        def finish(decoded):
+            try:
+                results.set_result(list(zip(decoded.result(), seeds)))
+            except Exception as e:
+                results.set_exception(RuntimeError(f"Image decoding failed: {str(e)}"))
+        self.decoder.submit(batch.latents).add_done_callback(finish)
+        return results
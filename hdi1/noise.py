@@ -0,0 +1,220 @@
+import math
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple, Union
+
+import torch
+from diffusers.utils.torch_utils import randn_tensor
+
+_MASK64 = (1 << 64) - 1
+_MASK32 = (1 << 32) - 1
+
+# Philox4x32-10 constants (Salmon et al., "Parallel random numbers: as easy as 1, 2, 3")
+PHILOX_M0, PHILOX_M1 = 0xD2511F53, 0xCD9E8D57
+PHILOX_W0, PHILOX_W1 = 0x9E3779B9, 0xBB67AE85
+PHILOX_ROUNDS = 10
+
+
+def step_seed(seed: int, step: int) -> int:
+    """Seed of the noise drawn at denoising `step` of the item seeded with `seed` (a splitmix64 mix of both)."""
+    z = (seed * 0x9E3779B97F4A7C15 + (step + 1) * 0xD1B54A32D192ED03) & _MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return (z ^ (z >> 31)) >> 1
+
+
+def _mulhilo(a: torch.Tensor, m: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    # exact 32x32 -> 64 bit product in int64 without overflow: split `a` into 16-bit halves
+    a_hi, a_lo = a >> 16, a & 0xFFFF
+    hi_part = a_hi * m
+    lo = a_lo * m + ((hi_part & 0xFFFF) << 16)
+    return (hi_part >> 16) + (lo >> 32), lo & _MASK32
+
+
+def philox4x32(counter: List[torch.Tensor], key: Tuple[int, int]) -> List[torch.Tensor]:
+    """Philox4x32-10 on int64 tensors holding 32-bit words; every counter is hashed independently."""
+    c0, c1, c2, c3 = counter
+    k0, k1 = key
+    for _ in range(PHILOX_ROUNDS):
+        hi0, lo0 = _mulhilo(c0, PHILOX_M0)
+        hi1, lo1 = _mulhilo(c2, PHILOX_M1)
+        c0, c1, c2, c3 = hi1 ^ c1 ^ k0, lo1, hi0 ^ c3 ^ k1, lo0
+        k0, k1 = (k0 + PHILOX_W0) & _MASK32, (k1 + PHILOX_W1) & _MASK32
+    return [c0, c1, c2, c3]
+
+
+def philox_randn(
+    seed: int,
+    shape: tuple,
+    dtype: torch.dtype,
+    device: Union[str, torch.device],
+    step: Optional[int] = None,
+    item: int = 0,
+) -> torch.Tensor:
+    """
+    Standard normal noise of `shape` that is a pure function of (seed, step, item): element `i` comes from the Philox
+    block at counter (i // 2, item, step + 1) under the key `seed`, so no generator state is carried between steps or
+    items and a batch, any reordering of it, or a shard of it draws exactly what single runs draw.
+
+    `step=None` is the initial latent noise. The integer stream is the same on every device; the Box-Muller transform
+    runs in float64 before rounding to `dtype`.
+    """
+    device = torch.device(device)
+    # no float64 on MPS
+    work_device = torch.device("cpu") if device.type == "mps" else device
+    numel = math.prod(shape)
+    index = torch.arange((numel + 1) // 2, device=work_device, dtype=torch.int64)
+    counter = [
+        index & _MASK32,
+        torch.full_like(index, item & _MASK32),
+        torch.full_like(index, (0 if step is None else step + 1) & _MASK32),
+        index >> 32,
+    ]
+    w0, w1, w2, w3 = philox4x32(counter, (seed & _MASK32, (seed >> 32) & _MASK32))
+
+    # 53-bit uniforms in (0, 1] and [0, 1)
+    u1 = 1.0 - ((w0 >> 5) * 67108864 + (w1 >> 6)).to(torch.float64) / 9007199254740992.0
+    u2 = ((w2 >> 5) * 67108864 + (w3 >> 6)).to(torch.float64) / 9007199254740992.0
+    radius = torch.sqrt(-2.0 * torch.log(u1))
+    theta = 2.0 * math.pi * u2
+    noise = torch.stack([radius * torch.cos(theta), radius * torch.sin(theta)], dim=-1).flatten()[:numel]
+    return noise.reshape(shape).to(device=device, dtype=dtype)
+
+
+class NoiseCache:
+    """
+    Bounded LRU cache of seeded noise, keyed on (seed, item, step, shape, dtype, device, source). Seed and prompt sweeps that
+    revisit a seed get its initial latents and per-step noise back without running the RNG again.
+
+    A hit returns exactly the tensor a miss would have drawn, so images are bit-identical with or without the cache.
+
+    Args:
+        max_bytes (`int`, defaults to 256 MiB):
+            Memory budget across all cached tensors; the least recently used are evicted first.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024**2):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, make):
+        with self._lock:
+            tensor = self._entries.get(key)
+            if tensor is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return tensor
+            self._misses += 1
+        tensor = make()
+        nbytes = tensor.numel() * tensor.element_size()
+        if nbytes > self.max_bytes:
+            return tensor
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = tensor
+                self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.numel() * evicted.element_size()
+        return tensor
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "hits": self._hits, "misses": self._misses}
+
+
+def seeded_randn(
+    seeds: Sequence[int],
+    shape: tuple,
+    dtype: torch.dtype,
+    device: Union[str, torch.device],
+    generator_device: Optional[Union[str, torch.device]] = None,
+    step: Optional[int] = None,
+    cache: Optional[NoiseCache] = None,
+    items: Optional[Sequence[int]] = None,
+) -> torch.Tensor:
+    """
+    One standard normal sample of `shape` per seed, stacked into a batch.
+
+    Without a `generator_device` the noise is `philox_randn(seed, shape, step=step, item=item)` for each seed and
+    item (all 0 by default). With one it comes from `torch.Generator`s on that device: without `step` this is what
+    `randn_tensor` draws from fresh generators seeded with `seeds`; with `step` each item's generator is seeded with
+    `step_seed(seed, step)`, so the noise of any step can be drawn (or cached) on its own.
+    """
+    device = torch.device(device)
+    source = "philox" if generator_device is None else str(torch.device(generator_device))
+    items = items or [0] * len(seeds)
+
+    def draw(seed, item):
+        if generator_device is None:
+            return philox_randn(seed, shape, dtype, device, step=step, item=item)[None]
+        generator = torch.Generator(generator_device).manual_seed(seed if step is None else step_seed(seed, step))
+        return randn_tensor((1, *shape), generator=generator, device=device, dtype=dtype)
+
+    if cache is None:
+        samples = [draw(seed, item) for seed, item in zip(seeds, items)]
+    else:
+        samples = [
+            cache.get(
+                (seed, item, step, tuple(shape), dtype, str(device), source),
+                lambda seed=seed, item=item: draw(seed, item),
+            )
+            for seed, item in zip(seeds, items)
+        ]
+    return torch.cat(samples)
+
+
+@dataclass
+class NoiseSeeds:
+    """
+    Where the noise of each batch item comes from: Philox noise for (seed, item) when `generator_device` is `None`,
+    otherwise `torch.Generator`s seeded with `seed` on that device.
+    """
+
+    seeds: List[int]
+    items: List[int]
+    generator_device: Optional[torch.device] = None
+
+    @classmethod
+    def philox(cls, seeds: Sequence[int], num_images_per_prompt: int = 1) -> "NoiseSeeds":
+        """Item `j` of the images for `seeds[i]` is keyed (seeds[i], j), so one image per seed reproduces item 0."""
+        return cls(
+            [int(seed) for seed in seeds for _ in range(num_images_per_prompt)],
+            [item for _ in seeds for item in range(num_images_per_prompt)],
+        )
+
+    @classmethod
+    def from_generator(
+        cls,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]],
+        batch_size: int,
+    ) -> Optional["NoiseSeeds"]:
+        """
+        Per-item seeds of the generators passed to the pipeline, or `None` if the items can't be told apart (no
+        generator, or one generator for several items).
+        """
+        if isinstance(generator, torch.Generator):
+            generator = [generator] if batch_size == 1 else None
+        if not generator or len(generator) != batch_size:
+            return None
+        return cls([g.initial_seed() for g in generator], [0] * batch_size, generator[0].device)
+
+    def randn(
+        self,
+        shape: tuple,
+        dtype: torch.dtype,
+        device: Union[str, torch.device],
+        step: Optional[int] = None,
+        cache: Optional[NoiseCache] = None,
+    ) -> torch.Tensor:
+        return seeded_randn(self.seeds, shape, dtype, device, self.generator_device, step, cache, self.items)
@@ -0,0 +1,184 @@
+import torch
+from torch import nn
+from typing import List, Optional, Union
+
+
+class BlockStreamer:
+    """
+    Streams a sequence of transformer blocks between host memory and the compute device.
+
+    Every block keeps its weights in (pinned) host buffers. Right before a block runs, its weights are swapped in from
+    a device copy that was started ahead of time on a dedicated copy stream; right after it runs, the device copy is
+    dropped again. While block `i` computes, the copies of the next `prefetch_depth` blocks are already in flight, so
+    transfer time hides behind compute instead of adding to it. The prefetch window wraps around from the last block to
+    the first one, which keeps the pipeline full across denoising steps.
+
+    When `device` is a CPU device the streamer runs in simulated mode: copies are synchronous clones into fresh
+    buffers, but the residency bookkeeping and the statistics are identical, which makes the executor usable on
+    machines without an accelerator.
+
+    Args:
+        blocks (`List[nn.Module]`):
+            The blocks to stream, in execution order.
+        device (`str` or `torch.device`):
+            The compute device.
+        prefetch_depth (`int`, defaults to 1):
+            How many upcoming blocks to keep in flight. `0` disables prefetching (load on demand).
+        pin_memory (`bool`, *optional*):
+            Whether to pin the host buffers. Defaults to `True` on CUDA devices.
+    """
+
+    def __init__(
+        self,
+        blocks: List[nn.Module],
+        device: Union[str, torch.device],
+        prefetch_depth: int = 1,
+        pin_memory: Optional[bool] = None,
+    ):
+        if prefetch_depth < 0:
+            raise ValueError(f"`prefetch_depth` must be >= 0, got {prefetch_depth}")
+        if prefetch_depth >= len(blocks):
+            prefetch_depth = max(len(blocks) - 1, 0)
+
+        self.blocks = list(blocks)
+        self.device = torch.device(device)
+        self.prefetch_depth = prefetch_depth
+        self.pin_memory = self.device.type == "cuda" if pin_memory is None else pin_memory
+        self.copy_stream = torch.cuda.Stream(device=self.device) if self.device.type == "cuda" else None
+
+        self._slots = [self._collect_slots(block) for block in self.blocks]
+        self._host = [None] * len(self.blocks)
+        self._resident: List[Optional[List[torch.Tensor]]] = [None] * len(self.blocks)
+        self._events = [None] * len(self.blocks)
+        self._handles = []
+        self.stats = {"loads": 0, "prefetch_hits": 0, "stalls": 0, "bytes_transferred": 0}
+
+    @staticmethod
+    def _collect_slots(block: nn.Module):
+        slots = []
+        for module in block.modules():
+            for name, param in module._parameters.items():
+                if param is not None:
+                    slots.append((module, name, True))
+            for name, buf in module._buffers.items():
+                if buf is not None:
+                    slots.append((module, name, False))
+        return slots
+
+    @staticmethod
+    def _get(slot):
+        module, name, is_param = slot
+        return module._parameters[name] if is_param else module._buffers[name]
+
+    @staticmethod
+    def _set(slot, tensor):
+        module, name, is_param = slot
+        if is_param:
+            module._parameters[name].data = tensor
+        else:
+            module._buffers[name] = tensor
+
+    def attach(self):
+        """Moves the block weights into host buffers and installs the streaming hooks."""
+        if self._handles:
+            return self
+        for i, slots in enumerate(self._slots):
+            host = []
+            for slot in slots:
+                tensor = self._get(slot)
+                quant_state = getattr(tensor, "quant_state", None)
+                if quant_state is not None:
+                    # bitsandbytes quantization statistics are small; keep them resident on the device.
+                    quant_state.to(self.device)
+                data = tensor.data.to("cpu")
+                if self.pin_memory:
+                    data = data.pin_memory()
+                self._set(slot, data)
+                host.append(data)
+            self._host[i] = host
+            self._handles.append(self.blocks[i].register_forward_pre_hook(self._make_pre_hook(i)))
+            self._handles.append(self.blocks[i].register_forward_hook(self._make_post_hook(i)))
+        if self.device.type == "cuda":
+            torch.cuda.empty_cache()
+        return self
+
+    def detach(self):
+        """Removes the streaming hooks. The blocks stay in host memory."""
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        for i in range(len(self.blocks)):
+            self._release(i)
+
+    def _load(self, i: int):
+        if self._resident[i] is not None:
+            return
+        host = self._host[i]
+        if self.copy_stream is not None:
+            with torch.cuda.stream(self.copy_stream):
+                tensors = [torch.empty_like(t, device=self.device).copy_(t, non_blocking=True) for t in host]
+                event = torch.cuda.Event()
+                event.record(self.copy_stream)
+            self._events[i] = event
+        else:
+            tensors = [torch.empty_like(t, device=self.device).copy_(t) for t in host]
+        self._resident[i] = tensors
+        self.stats["loads"] += 1
+        self.stats["bytes_transferred"] += sum(t.numel() * t.element_size() for t in host)
+
+    def _release(self, i: int):
+        if self._resident[i] is None:
+            return
+        for slot, data in zip(self._slots[i], self._host[i]):
+            self._set(slot, data)
+        self._resident[i] = None
+        self._events[i] = None
+
+    def _make_pre_hook(self, i: int):
+        def hook(module, args):
+            if self._resident[i] is None:
+                self.stats["stalls"] += 1
+                self._load(i)
+            else:
+                self.stats["prefetch_hits"] += 1
+
+            tensors = self._resident[i]
+            if self._events[i] is not None:
+                compute_stream = torch.cuda.current_stream(self.device)
+                compute_stream.wait_event(self._events[i])
+                for t in tensors:
+                    # the copy stream owns the allocation; keep it alive until compute is done with it
+                    t.record_stream(compute_stream)
+            for slot, t in zip(self._slots[i], tensors):
+                self._set(slot, t)
+
+            for k in range(1, self.prefetch_depth + 1):
+                self._load((i + k) % len(self.blocks))
+        return hook
+
+    def _make_post_hook(self, i: int):
+        def hook(module, args, output):
+            self._release(i)
+        return hook
+
+
+def stream_transformer_blocks(transformer: nn.Module, device: Union[str, torch.device], prefetch_depth: int = 1):
+    """
+    Keeps the non-block parts of `transformer` resident on `device` and streams `double_stream_blocks` and
+    `single_stream_blocks` through a [`BlockStreamer`].
+    """
+    blocks = list(transformer.double_stream_blocks) + list(transformer.single_stream_blocks)
+    streamed = {id(p) for block in blocks for p in block.parameters()}
+    streamed.update(id(b) for block in blocks for b in block.buffers())
+
+    for module in transformer.modules():
+        for name, param in module._parameters.items():
+            if param is not None and id(param) not in streamed:
+                if getattr(param, "quant_state", None) is not None:
+                    param.quant_state.to(device)
+                param.data = param.data.to(device)
+        for name, buf in module._buffers.items():
+            if buf is not None and id(buf) not in streamed:
+                module._buffers[name] = buf.to(device)
+
+    return BlockStreamer(blocks, device, prefetch_depth=prefetch_depth).attach()
@@ -0,0 +1,142 @@
+import glob
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class OutputFileManager:
+    """
+    Hands out paths for generated files and remembers them in an in-memory index, oldest first. A background thread
+    deletes files older than `max_age` seconds or beyond the newest `max_files`, so the request path never scans a
+    directory.
+
+    Files left over by a previous run (`<prefix>*` in `directory`) are adopted once at start-up, on the background
+    thread, and expire like the others.
+
+    Args:
+        directory (`str`, *optional*):
+            Where the files live. Defaults to the system temp directory.
+        prefix (`str`, defaults to `"hdi1_"`):
+            File name prefix, also used to find leftovers from a previous run.
+        max_age (`float`, *optional*, defaults to 3600):
+            Seconds a file is kept. `None` keeps files regardless of age.
+        max_files (`int`, *optional*, defaults to 64):
+            Number of files kept. `None` keeps any number.
+        sweep_interval (`float`, defaults to 60):
+            Seconds between background expiry passes.
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        prefix: str = "hdi1_",
+        max_age: Optional[float] = 3600,
+        max_files: Optional[int] = 64,
+        sweep_interval: float = 60,
+    ):
+        self.directory = directory or tempfile.gettempdir()
+        self.prefix = prefix
+        self.max_age = max_age
+        self.max_files = max_files
+        self.sweep_interval = sweep_interval
+        self._files = OrderedDict()  # path -> creation time, oldest first
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._deleted = 0
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="hdi1-output-files", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def new_path(self, name: str) -> str:
+        """Returns `<directory>/<prefix><name>` and starts tracking it; the caller writes the file."""
+        path = os.path.join(self.directory, f"{self.prefix}{name}")
+        with self._lock:
+            self._files[path] = time.time()
+            self._files.move_to_end(path)
+        return path
+
+    def _adopt_existing(self):
+        leftovers = []
+        for path in glob.glob(os.path.join(self.directory, f"{glob.escape(self.prefix)}*")):
+            try:
+                leftovers.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+        with self._lock:
+            entries = [(t, p) for t, p in leftovers if p not in self._files]
+            entries += [(t, p) for p, t in self._files.items()]
+            self._files = OrderedDict((p, t) for t, p in sorted(entries))
+
+    def _expired(self, now: float) -> List[str]:
+        with self._lock:
+            expired = []
+            while self._files:
+                path, created = next(iter(self._files.items()))
+                too_old = self.max_age is not None and now - created > self.max_age
+                too_many = self.max_files is not None and len(self._files) > self.max_files
+                if not (too_old or too_many):
+                    break
+                self._files.popitem(last=False)
+                expired.append(path)
+            return expired
+
+    def _delete(self, paths: List[str]) -> int:
+        deleted = 0
+        for path in paths:
+            try:
+                os.remove(path)
+                deleted += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Failed to delete {path}: {e}")
+        with self._lock:
+            self._deleted += deleted
+        return deleted
+
+    def sweep(self) -> int:
+        """Deletes the files that are over the age or count budget. Returns how many were deleted."""
+        return self._delete(self._expired(time.time()))
+
+    def clear(self) -> List[str]:
+        """Deletes every tracked file. Returns the paths that were deleted."""
+        with self._lock:
+            paths = list(self._files)
+            self._files.clear()
+        return [path for path in paths if self._delete([path]) > 0]
+
+    def _loop(self):
+        try:
+            self._adopt_existing()
+        except Exception as e:
+            logger.warning(f"Failed to index leftover files in {self.directory}: {e}")
+        while True:
+            self.sweep()
+            if self._stop.wait(self.sweep_interval):
+                break
+
+    def metrics(self) -> dict:
+        with self._lock:
+            oldest = next(iter(self._files.values()), None)
+            return {
+                "tracked_files": len(self._files),
+                "deleted_files": self._deleted,
+                "oldest_age_s": time.time() - oldest if oldest is not None else 0.0,
+            }
@@ -1,4 +1,5 @@
 import inspect
+from concurrent.futures import Future
 from typing import Any, Callable, Dict, List, Optional, Union
 import math
 import einops
@@ -26,6 +27,11 @@ from diffusers.pipelines.pipeline_utils import DiffusionPipeline
 from .pipeline_output import HiDreamImagePipelineOutput
 from ...models.transformers.transformer_hidream_image import HiDreamImageTransformer2DModel
 from ...schedulers.fm_solvers_unipc import FlowUniPCMultistepScheduler
+from ...cancellation import CancellationToken, GenerationCancelled
+from ...vae_decode import VAE_DECODE_MODES, decode_latents_with_vae
+from ...noise import NoiseCache, NoiseSeeds
+from ...adaptive import AdaptiveStepController
+from ...tracing import span
 
 if is_torch_xla_available():
     import torch_xla.core.xla_model as xm
@@ -111,7 +117,11 @@ def retrieve_timesteps(
 class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
     model_cpu_offload_seq = "text_encoder->text_encoder_2->text_encoder_3->text_encoder_4->image_encoder->transformer->vae"
     _optional_components = ["image_encoder", "feature_extractor"]
-    _callback_tensor_inputs = ["latents", "prompt_embeds"]
+    _callback_tensor_inputs = ["latents", "prompt_embeds", "denoised"]
+    _detached_text_encoder_4 = None
+    _prompt_encoder = None
+    block_streamer = None
+    vae_decode_mode = "auto"
 
     def __init__(
         self,
@@ -149,6 +159,45 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
         self.default_sample_size = 128
         self.tokenizer_4.pad_token = self.tokenizer_4.eos_token
 
+    def set_detached_text_encoder_4(self, text_encoder_4: Optional[LlamaForCausalLM]):
+        r"""
+        Uses `text_encoder_4` for the Llama prompt embeddings without registering it as a pipeline component, so the
+        offload hooks never move it. Meant for quantized encoders and for encoders that should stay on the CPU while
+        the transformer runs on the GPU. `text_encoder_4` should be `None` when loading the pipeline in that case.
+        """
+        self._detached_text_encoder_4 = text_encoder_4
+
+    def set_prompt_encoder(self, prompt_encoder):
+        r"""
+        Delegates `encode_prompt` to `prompt_encoder`, e.g. a [`~encoder_worker.PromptEncoderWorker`] that runs the
+        text encoders in a separate process. The pipeline can then be loaded without text encoders.
+        """
+        self._prompt_encoder = prompt_encoder
+
+    @property
+    def prompt_encoder(self):
+        return self._prompt_encoder
+
+    def set_block_streamer(self, block_streamer):
+        r"""
+        Marks the transformer as streamed by `block_streamer` (see `offload.stream_transformer_blocks`), which alone
+        decides where its blocks live. Call it before `enable_model_cpu_offload`: the transformer is dropped from the
+        offload sequence, whose hook would move the whole transformer to the device on every forward and peak at the
+        full model size, so model offload covers only the text encoders and the VAE.
+        """
+        self.block_streamer = block_streamer
+        self.model_cpu_offload_seq = "->".join(
+            name for name in type(self).model_cpu_offload_seq.split("->") if name != "transformer"
+        )
+
+    @staticmethod
+    def _text_encoder_device(text_encoder, device):
+        # Encoders driven by offload hooks have their weights on `meta` and follow the execution device; encoders
+        # placed by the caller run where their weights live.
+        if hasattr(text_encoder, "_hf_hook") or text_encoder.device.type == "meta":
+            return device
+        return text_encoder.device
+
     def _get_t5_prompt_embeds(
         self,
         prompt: Union[str, List[str]] = None,
@@ -163,17 +212,18 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
         prompt = [prompt] if isinstance(prompt, str) else prompt
         batch_size = len(prompt)
 
-        text_inputs = self.tokenizer_3(
-            prompt,
-            padding="max_length",
-            max_length=min(max_sequence_length, self.tokenizer_3.model_max_length),
-            truncation=True,
-            add_special_tokens=True,
-            return_tensors="pt",
-        )
-        text_input_ids = text_inputs.input_ids
-        attention_mask = text_inputs.attention_mask
-        untruncated_ids = self.tokenizer_3(prompt, padding="longest", return_tensors="pt").input_ids
+        with span("tokenize", encoder="t5", batch_size=batch_size):
+            text_inputs = self.tokenizer_3(
+                prompt,
+                padding="max_length",
+                max_length=min(max_sequence_length, self.tokenizer_3.model_max_length),
+                truncation=True,
+                add_special_tokens=True,
+                return_tensors="pt",
+            )
+            text_input_ids = text_inputs.input_ids
+            attention_mask = text_inputs.attention_mask
+            untruncated_ids = self.tokenizer_3(prompt, padding="longest", return_tensors="pt").input_ids
 
         if untruncated_ids.shape[-1] >= text_input_ids.shape[-1] and not torch.equal(text_input_ids, untruncated_ids):
             removed_text = self.tokenizer_3.batch_decode(untruncated_ids[:, min(max_sequence_length, self.tokenizer_3.model_max_length) - 1 : -1])
@@ -182,7 +232,8 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
                 f" {min(max_sequence_length, self.tokenizer_3.model_max_length)} tokens: {removed_text}"
             )
 
-        prompt_embeds = self.text_encoder_3(text_input_ids.to(device), attention_mask=attention_mask.to(device))[0]
+        with span("text_encoder", encoder="t5", batch_size=batch_size):
+            prompt_embeds = self.text_encoder_3(text_input_ids.to(device), attention_mask=attention_mask.to(device))[0]
         prompt_embeds = prompt_embeds.to(dtype=dtype, device=device)
         _, seq_len, _ = prompt_embeds.shape
 
@@ -207,23 +258,26 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
         prompt = [prompt] if isinstance(prompt, str) else prompt
         batch_size = len(prompt)
 
-        text_inputs = tokenizer(
-            prompt,
-            padding="max_length",
-            max_length=min(max_sequence_length, 218),
-            truncation=True,
-            return_tensors="pt",
-        )
+        encoder = "clip_l" if text_encoder is self.text_encoder else "clip_g"
+        with span("tokenize", encoder=encoder, batch_size=batch_size):
+            text_inputs = tokenizer(
+                prompt,
+                padding="max_length",
+                max_length=min(max_sequence_length, 218),
+                truncation=True,
+                return_tensors="pt",
+            )
 
-        text_input_ids = text_inputs.input_ids
-        untruncated_ids = tokenizer(prompt, padding="longest", return_tensors="pt").input_ids
+            text_input_ids = text_inputs.input_ids
+            untruncated_ids = tokenizer(prompt, padding="longest", return_tensors="pt").input_ids
         if untruncated_ids.shape[-1] >= text_input_ids.shape[-1] and not torch.equal(text_input_ids, untruncated_ids):
             removed_text = tokenizer.batch_decode(untruncated_ids[:, 218 - 1 : -1])
             logger.warning(
                 "The following part of your input was truncated because CLIP can only handle sequences up to"
                 f" {218} tokens: {removed_text}"
             )
-        prompt_embeds = text_encoder(text_input_ids.to(device), output_hidden_states=True)
+        with span("text_encoder", encoder=encoder, batch_size=batch_size):
+            prompt_embeds = text_encoder(text_input_ids.to(device), output_hidden_states=True)
 
         # Use pooled output of CLIPTextModel
         prompt_embeds = prompt_embeds[0]
@@ -244,22 +298,25 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
         dtype: Optional[torch.dtype] = None,
     ):
         device = device or self._execution_device
-        dtype = dtype or self.text_encoder_4.dtype
+        text_encoder = self.text_encoder_4 if self.text_encoder_4 is not None else self._detached_text_encoder_4
+        dtype = dtype or text_encoder.dtype
+        encoder_device = self._text_encoder_device(text_encoder, device)
 
         prompt = [prompt] if isinstance(prompt, str) else prompt
         batch_size = len(prompt)
 
-        text_inputs = self.tokenizer_4(
-            prompt,
-            padding="max_length",
-            max_length=min(max_sequence_length, self.tokenizer_4.model_max_length),
-            truncation=True,
-            add_special_tokens=True,
-            return_tensors="pt",
-        )
-        text_input_ids = text_inputs.input_ids
-        attention_mask = text_inputs.attention_mask
-        untruncated_ids = self.tokenizer_4(prompt, padding="longest", return_tensors="pt").input_ids
+        with span("tokenize", encoder="llama", batch_size=batch_size):
+            text_inputs = self.tokenizer_4(
+                prompt,
+                padding="max_length",
+                max_length=min(max_sequence_length, self.tokenizer_4.model_max_length),
+                truncation=True,
+                add_special_tokens=True,
+                return_tensors="pt",
+            )
+            text_input_ids = text_inputs.input_ids
+            attention_mask = text_inputs.attention_mask
+            untruncated_ids = self.tokenizer_4(prompt, padding="longest", return_tensors="pt").input_ids
 
         if untruncated_ids.shape[-1] >= text_input_ids.shape[-1] and not torch.equal(text_input_ids, untruncated_ids):
             removed_text = self.tokenizer_4.batch_decode(untruncated_ids[:, min(max_sequence_length, self.tokenizer_4.model_max_length) - 1 : -1])
@@ -268,15 +325,16 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
                 f" {min(max_sequence_length, self.tokenizer_4.model_max_length)} tokens: {removed_text}"
             )
 
-        outputs = self.text_encoder_4(
-            text_input_ids.to(device), 
-            attention_mask=attention_mask.to(device), 
-            output_hidden_states=True,
-            output_attentions=True
-        )
+        with span("text_encoder", encoder="llama", batch_size=batch_size):
+            outputs = text_encoder(
+                text_input_ids.to(encoder_device), 
+                attention_mask=attention_mask.to(encoder_device), 
+                output_hidden_states=True,
+                output_attentions=True
+            )
 
         prompt_embeds = outputs.hidden_states[1:]
-        prompt_embeds = torch.stack(prompt_embeds, dim=0)
+        prompt_embeds = torch.stack(prompt_embeds, dim=0).to(dtype=dtype, device=device)
         _, _, seq_len, dim = prompt_embeds.shape
 
         # duplicate text embeddings and attention mask for each generation per prompt, using mps friendly method
@@ -304,12 +362,35 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
         negative_pooled_prompt_embeds: Optional[torch.FloatTensor] = None,
         max_sequence_length: int = 128,
         lora_scale: Optional[float] = None,
+        future: Optional[Future] = None,
     ):
+        r"""
+        `future` is a result of `prompt_encoder.submit` for these prompts, collected instead of encoding them again so
+        that a batch's prompts can be encoded while the previous batch is still denoising.
+        """
         prompt = [prompt] if isinstance(prompt, str) else prompt
         if prompt is not None:
             batch_size = len(prompt)
         else:
-            batch_size = prompt_embeds.shape[0]
+            # `prompt_embeds` is a [T5, Llama] list; the pooled embeddings carry the batch dimension
+            batch_size = pooled_prompt_embeds.shape[0]
+
+        if self._prompt_encoder is not None and prompt_embeds is None:
+            return self._prompt_encoder.encode(
+                prompt=prompt,
+                prompt_2=prompt_2,
+                prompt_3=prompt_3,
+                prompt_4=prompt_4,
+                num_images_per_prompt=num_images_per_prompt,
+                do_classifier_free_guidance=do_classifier_free_guidance,
+                negative_prompt=negative_prompt,
+                negative_prompt_2=negative_prompt_2,
+                negative_prompt_3=negative_prompt_3,
+                negative_prompt_4=negative_prompt_4,
+                max_sequence_length=max_sequence_length,
+                device=device or self._execution_device,
+                future=future,
+            )
 
         prompt_embeds, pooled_prompt_embeds = self._encode_prompt(
             prompt = prompt,
@@ -422,12 +503,13 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
                 device = device,
                 dtype = dtype
             )
+            # quantized or CPU-resident Llama encoders may compute in float32; match the T5 embeddings
             llama3_prompt_embeds = self._get_llama3_prompt_embeds(
                 prompt = prompt_4,
                 num_images_per_prompt = num_images_per_prompt,
                 max_sequence_length = max_sequence_length,
                 device = device,
-                dtype = dtype
+                dtype = dtype or t5_prompt_embeds.dtype
             )
             prompt_embeds = [t5_prompt_embeds, llama3_prompt_embeds]
 
@@ -462,6 +544,23 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
         """
         self.vae.disable_tiling()
 
+    def set_vae_decode_mode(self, mode: str):
+        r"""
+        Selects how `decode_latents` runs the VAE: `"auto"` (default) picks full, sliced or tiled decoding from the batch
+        size, resolution and free memory at decode time; `"full"`, `"sliced"` and `"tiled"` force a strategy.
+        """
+        if mode not in VAE_DECODE_MODES:
+            raise ValueError(f"Invalid VAE decode mode: {mode}, expected one of {VAE_DECODE_MODES}")
+        self.vae_decode_mode = mode
+
+    def decode_latents(self, latents: torch.Tensor, output_type: str = "pil"):
+        r"""
+        Decodes denoised latents (as returned with `output_type="latent"`) into images of `output_type`.
+        """
+        return decode_latents_with_vae(
+            self.vae, latents, mode=self.vae_decode_mode, output_type=output_type, image_processor=self.image_processor
+        )
+
     def prepare_latents(
         self,
         batch_size,
@@ -472,6 +571,8 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
         device,
         generator,
         latents=None,
+        noise_seeds: Optional[NoiseSeeds] = None,
+        noise_cache: Optional[NoiseCache] = None,
     ):
         # VAE applies 8x compression on images but we must also account for packing which requires
         # latent height and width to be divisible by 2.
@@ -480,7 +581,9 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
 
         shape = (batch_size, num_channels_latents, height, width)
 
-        if latents is None:
+        if latents is None and noise_seeds is not None:
+            latents = noise_seeds.randn(shape[1:], dtype, device, cache=noise_cache)
+        elif latents is None:
             latents = randn_tensor(shape, generator=generator, device=device, dtype=dtype)
         else:
             if latents.shape != shape:
@@ -488,6 +591,138 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
             latents = latents.to(device)
         return latents
     
+    def sample_size(self, height: Optional[int] = None, width: Optional[int] = None):
+        """The (height, width) actually generated for a requested size: same aspect ratio, the model's native area."""
+        height = height or self.default_sample_size * self.vae_scale_factor
+        width = width or self.default_sample_size * self.vae_scale_factor
+
+        division = self.vae_scale_factor * 2
+        S_max = (self.default_sample_size * self.vae_scale_factor) ** 2
+        scale = S_max / (width * height)
+        scale = math.sqrt(scale)
+        width, height = int(width * scale // division * division), int(height * scale // division * division)
+        return height, width
+
+    def image_seq_len(self, latents: torch.Tensor) -> int:
+        """Number of image tokens the transformer sees for `latents` (before padding to `max_seq`)."""
+        patch_size = self.transformer.config.patch_size
+        return (latents.shape[-2] // patch_size) * (latents.shape[-1] // patch_size)
+
+    def shift_kwargs(self, scheduler, image_seq_len: int, sigmas: Optional[List[float]] = None) -> Dict[str, Any]:
+        """
+        Arguments of `scheduler.set_timesteps` that shift its schedule for an image of `image_seq_len` tokens. A
+        scheduler with `use_dynamic_shifting` picks the shift from the token count itself; otherwise UniPC runs with
+        `exp(calculate_shift(image_seq_len))` and the Euler schedulers keep their configured `shift`. Custom `sigmas`
+        (e.g. a tuned schedule) are passed along and shifted the same way as the scheduler's own: by `mu` derived from
+        `image_seq_len` under `use_dynamic_shifting` (see `shifted_flow_sigmas`), otherwise by the configured `shift`.
+        """
+        if scheduler.config.use_dynamic_shifting:
+            kwargs = {"image_seq_len": image_seq_len}
+        elif sigmas is not None:
+            kwargs = {}
+        elif isinstance(scheduler, FlowUniPCMultistepScheduler):
+            kwargs = {"shift": math.exp(calculate_shift(image_seq_len))}
+        else:
+            kwargs = {"mu": calculate_shift(image_seq_len)}
+        if sigmas is not None:
+            kwargs["sigmas"] = sigmas
+        return kwargs
+
+    def prepare_image_ids(self, latents: torch.Tensor, do_classifier_free_guidance: bool):
+        """Patch grid sizes and position ids for non-square `latents`, repeated for guidance; `(None, None)` if square."""
+        if latents.shape[-2] == latents.shape[-1]:
+            return None, None
+        B, C, H, W = latents.shape
+        pH, pW = H // self.transformer.config.patch_size, W // self.transformer.config.patch_size
+
+        img_sizes = torch.tensor([pH, pW], dtype=torch.int64).reshape(-1)
+        img_ids = torch.zeros(pH, pW, 3)
+        img_ids[..., 1] = img_ids[..., 1] + torch.arange(pH)[:, None]
+        img_ids[..., 2] = img_ids[..., 2] + torch.arange(pW)[None, :]
+        img_ids = img_ids.reshape(pH * pW, -1)
+        img_ids_pad = torch.zeros(self.transformer.max_seq, 3)
+        img_ids_pad[:pH*pW, :] = img_ids
+
+        img_sizes = img_sizes.unsqueeze(0).to(latents.device) 
+        img_ids = img_ids_pad.unsqueeze(0).to(latents.device) 
+        if do_classifier_free_guidance:
+            img_sizes = img_sizes.repeat(2 * B, 1)
+            img_ids = img_ids.repeat(2 * B, 1, 1)
+        return img_sizes, img_ids
+
+    def transformer_output(
+        self,
+        latents: torch.Tensor,
+        timesteps: torch.Tensor,
+        prompt_embeds: List[torch.Tensor],
+        pooled_prompt_embeds: torch.Tensor,
+        img_sizes: Optional[torch.Tensor] = None,
+        img_ids: Optional[torch.Tensor] = None,
+        do_classifier_free_guidance: Optional[bool] = None,
+    ) -> torch.Tensor:
+        """
+        One transformer forward for every item of `latents` at its own entry of `timesteps` (B,), on the unconditional
+        and conditional halves when `do_classifier_free_guidance`. The embeddings hold the negative half first, as
+        built by `__call__`. Returns the raw output, i.e. the negated noise prediction, unconditional half first.
+        """
+        if do_classifier_free_guidance is None:
+            do_classifier_free_guidance = self.do_classifier_free_guidance
+
+        # expand the latents if we are doing classifier free guidance
+        latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
+        timestep = torch.cat([timesteps] * 2) if do_classifier_free_guidance else timesteps
+
+        if latent_model_input.shape[-2] != latent_model_input.shape[-1]:
+            B, C, H, W = latent_model_input.shape
+            patch_size = self.transformer.config.patch_size
+            pH, pW = H // patch_size, W // patch_size
+            out = torch.zeros(
+                (B, C, self.transformer.max_seq, patch_size * patch_size), 
+                dtype=latent_model_input.dtype, 
+                device=latent_model_input.device
+            )
+            latent_model_input = einops.rearrange(latent_model_input, 'B C (H p1) (W p2) -> B C (H W) (p1 p2)', p1=patch_size, p2=patch_size)
+            out[:, :, 0:pH*pW] = latent_model_input
+            latent_model_input = out
+
+        noise_pred = self.transformer(
+            hidden_states = latent_model_input,
+            timesteps = timestep,
+            encoder_hidden_states = prompt_embeds,
+            pooled_embeds = pooled_prompt_embeds,
+            img_sizes = img_sizes,
+            img_ids = img_ids,
+            return_dict = False,
+        )[0]
+        return noise_pred
+
+    def predict_noise(
+        self,
+        latents: torch.Tensor,
+        timesteps: torch.Tensor,
+        prompt_embeds: List[torch.Tensor],
+        pooled_prompt_embeds: torch.Tensor,
+        img_sizes: Optional[torch.Tensor] = None,
+        img_ids: Optional[torch.Tensor] = None,
+        guidance_scale: Optional[float] = None,
+    ) -> torch.Tensor:
+        """
+        `transformer_output` followed by classifier-free guidance when `guidance_scale > 1`. Returns the guided noise
+        prediction the schedulers step with.
+        """
+        guidance_scale = self.guidance_scale if guidance_scale is None else guidance_scale
+        do_classifier_free_guidance = guidance_scale > 1
+        noise_pred = self.transformer_output(
+            latents, timesteps, prompt_embeds, pooled_prompt_embeds, img_sizes, img_ids, do_classifier_free_guidance
+        )
+        noise_pred = -noise_pred
+
+        # perform guidance
+        if do_classifier_free_guidance:
+            noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+            noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+        return noise_pred
+
     @property
     def guidance_scale(self):
         return self._guidance_scale
@@ -504,6 +739,11 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
     def num_timesteps(self):
         return self._num_timesteps
 
+    @property
+    def skipped_steps(self):
+        """Per image of the last call, the steps its `step_controller` skipped (all 0 without one)."""
+        return self._skipped_steps
+
     @property
     def interrupt(self):
         return self._interrupt
@@ -537,15 +777,13 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
         callback_on_step_end: Optional[Callable[[int, int, Dict], None]] = None,
         callback_on_step_end_tensor_inputs: List[str] = ["latents"],
         max_sequence_length: int = 128,
+        cancellation_token: Optional[CancellationToken] = None,
+        seeds: Optional[List[int]] = None,
+        noise_cache: Optional[NoiseCache] = None,
+        step_controller: Optional[AdaptiveStepController] = None,
+        prompt_future: Optional[Future] = None,
     ):
-        height = height or self.default_sample_size * self.vae_scale_factor
-        width = width or self.default_sample_size * self.vae_scale_factor
-
-        division = self.vae_scale_factor * 2
-        S_max = (self.default_sample_size * self.vae_scale_factor) ** 2
-        scale = S_max / (width * height)
-        scale = math.sqrt(scale)
-        width, height = int(width * scale // division * division), int(height * scale // division * division)
+        height, width = self.sample_size(height, width)
 
         self._guidance_scale = guidance_scale
         self._joint_attention_kwargs = joint_attention_kwargs
@@ -557,37 +795,43 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
         elif prompt is not None and isinstance(prompt, list):
             batch_size = len(prompt)
         else:
-            batch_size = prompt_embeds.shape[0]
+            batch_size = pooled_prompt_embeds.shape[0]
 
         device = self._execution_device
 
         lora_scale = (
             self.joint_attention_kwargs.get("scale", None) if self.joint_attention_kwargs is not None else None
         )
-        (
-            prompt_embeds,
-            negative_prompt_embeds,
-            pooled_prompt_embeds,
-            negative_pooled_prompt_embeds,
-        ) = self.encode_prompt(
-            prompt=prompt,
-            prompt_2=prompt_2,
-            prompt_3=prompt_3,
-            prompt_4=prompt_4,
-            negative_prompt=negative_prompt,
-            negative_prompt_2=negative_prompt_2,
-            negative_prompt_3=negative_prompt_3,
-            negative_prompt_4=negative_prompt_4,
-            do_classifier_free_guidance=self.do_classifier_free_guidance,
-            prompt_embeds=prompt_embeds,
-            negative_prompt_embeds=negative_prompt_embeds,
-            pooled_prompt_embeds=pooled_prompt_embeds,
-            negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
-            device=device,
-            num_images_per_prompt=num_images_per_prompt,
-            max_sequence_length=max_sequence_length,
-            lora_scale=lora_scale,
-        )
+        with span("encode_prompt", batch_size=batch_size):
+            (
+                prompt_embeds,
+                negative_prompt_embeds,
+                pooled_prompt_embeds,
+                negative_pooled_prompt_embeds,
+            ) = self.encode_prompt(
+                prompt=prompt,
+                prompt_2=prompt_2,
+                prompt_3=prompt_3,
+                prompt_4=prompt_4,
+                negative_prompt=negative_prompt,
+                negative_prompt_2=negative_prompt_2,
+                negative_prompt_3=negative_prompt_3,
+                negative_prompt_4=negative_prompt_4,
+                do_classifier_free_guidance=self.do_classifier_free_guidance,
+                prompt_embeds=prompt_embeds,
+                negative_prompt_embeds=negative_prompt_embeds,
+                pooled_prompt_embeds=pooled_prompt_embeds,
+                negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
+                device=device,
+                num_images_per_prompt=num_images_per_prompt,
+                max_sequence_length=max_sequence_length,
+                lora_scale=lora_scale,
+                future=prompt_future,
+            )
+        if self.block_streamer is not None:
+            # without the transformer in the offload chain nothing would evict the last text encoder before the VAE runs
+            for hook in getattr(self, "_all_hooks", []):
+                hook.offload()
 
         if self.do_classifier_free_guidance:
             prompt_embeds_arr = []
@@ -599,99 +843,124 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
             prompt_embeds = prompt_embeds_arr
             pooled_prompt_embeds = torch.cat([negative_pooled_prompt_embeds, pooled_prompt_embeds], dim=0)
 
+        # Per-item noise: counter-based Philox noise keyed by (seed, step, item) when `seeds` are given, so batching,
+        # reordering and sharding don't change any image; otherwise seeded from the per-item generators
+        if seeds is not None:
+            if len(seeds) != batch_size:
+                raise ValueError(f"Got {len(seeds)} seeds for {batch_size} prompts")
+            noise_seeds = NoiseSeeds.philox(seeds, num_images_per_prompt)
+        else:
+            noise_seeds = NoiseSeeds.from_generator(generator, batch_size * num_images_per_prompt)
+
         # 4. Prepare latent variables
         num_channels_latents = self.transformer.config.in_channels
-        latents = self.prepare_latents(
-            batch_size * num_images_per_prompt,
-            num_channels_latents,
-            height,
-            width,
-            pooled_prompt_embeds.dtype,
-            device,
-            generator,
-            latents,
-        )
+        with span("prepare_latents", batch_size=batch_size * num_images_per_prompt):
+            latents = self.prepare_latents(
+                batch_size * num_images_per_prompt,
+                num_channels_latents,
+                height,
+                width,
+                pooled_prompt_embeds.dtype,
+                device,
+                generator,
+                latents,
+                # a caller's generator is only bypassed for the cache; its state may have been advanced
+                noise_seeds=noise_seeds if seeds is not None or noise_cache is not None else None,
+                noise_cache=noise_cache,
+            )
 
-        if latents.shape[-2] != latents.shape[-1]:
-            B, C, H, W = latents.shape
-            pH, pW = H // self.transformer.config.patch_size, W // self.transformer.config.patch_size
-
-            img_sizes = torch.tensor([pH, pW], dtype=torch.int64).reshape(-1)
-            img_ids = torch.zeros(pH, pW, 3)
-            img_ids[..., 1] = img_ids[..., 1] + torch.arange(pH)[:, None]
-            img_ids[..., 2] = img_ids[..., 2] + torch.arange(pW)[None, :]
-            img_ids = img_ids.reshape(pH * pW, -1)
-            img_ids_pad = torch.zeros(self.transformer.max_seq, 3)
-            img_ids_pad[:pH*pW, :] = img_ids
-
-            img_sizes = img_sizes.unsqueeze(0).to(latents.device) 
-            img_ids = img_ids_pad.unsqueeze(0).to(latents.device) 
-            if self.do_classifier_free_guidance:
-                img_sizes = img_sizes.repeat(2 * B, 1)
-                img_ids = img_ids.repeat(2 * B, 1, 1)
-        else:
-            img_sizes = img_ids = None
+        img_sizes, img_ids = self.prepare_image_ids(latents, self.do_classifier_free_guidance)
 
         # 5. Prepare timesteps
-        mu = calculate_shift(self.transformer.max_seq)
-        scheduler_kwargs = {"mu": mu}
+        # the shift follows the tokens actually generated, not the transformer's maximum
+        scheduler_kwargs = self.shift_kwargs(self.scheduler, self.image_seq_len(latents), sigmas=sigmas)
         if isinstance(self.scheduler, FlowUniPCMultistepScheduler):
-            self.scheduler.set_timesteps(num_inference_steps, device=device, shift=math.exp(mu))
+            self.scheduler.set_timesteps(num_inference_steps, device=device, **scheduler_kwargs)
             timesteps = self.scheduler.timesteps
+            num_inference_steps = len(timesteps)
         else:
             timesteps, num_inference_steps = retrieve_timesteps(
                 self.scheduler,
                 num_inference_steps,
                 device,
-                sigmas=sigmas,
                 **scheduler_kwargs,
             )
-        num_warmup_steps = max(len(timesteps) - num_inference_steps * self.scheduler.order, 0)
+        # progress is counted in solver steps: a second-order scheduler (Heun) evaluates the model twice per step and
+        # `timesteps` holds both evaluations, so N steps are 2N - 1 timesteps
+        num_solver_steps = math.ceil(len(timesteps) / self.scheduler.order)
+        num_warmup_steps = max(len(timesteps) - num_solver_steps * self.scheduler.order, 0)
+        solver_steps_done = 0
         self._num_timesteps = len(timesteps)
 
+        # Stochastic schedulers get their per-step noise from the item seeds too, so a seed reproduces its image and the
+        # noise of every step can come from `noise_cache`
+        step_takes_noise = "noise" in inspect.signature(self.scheduler.step).parameters
+        # Schedulers with a `step_guided` take the raw transformer halves and fold guidance into their update, unless a
+        # callback needs the guided prediction
+        needs_noise_pred = callback_on_step_end is not None and "denoised" in callback_on_step_end_tensor_inputs
+        # A `step_controller` watches `denoised` and finishes settled items early: their final latents are frozen at
+        # that step's `denoised`, and the loop stops once every item has finished. Finished rows stay in the batch, so
+        # the transformer only runs less once the last row has settled. It counts in solver steps, like the progress
+        # bar and `skipped_steps`; both evaluations of a two-stage step share one step index
+        if step_controller is not None:
+            step_controller.reset()
+            needs_noise_pred = True
+            finished = torch.zeros(latents.shape[0], dtype=torch.bool, device=latents.device)
+            finished_latents = torch.empty_like(latents)
+        self._skipped_steps = [0] * latents.shape[0]
+        fused_step = hasattr(self.scheduler, "step_guided") and not needs_noise_pred
+
         # 6. Denoising loop
-        with self.progress_bar(total=num_inference_steps) as progress_bar:
+        # The transformer polls the token between blocks, so a cancel lands within one block instead of one step. It is
+        # set on every call, so a token from an earlier call that raised out of the transformer never leaks into this one.
+        self.transformer.cancellation_token = cancellation_token
+        with self.progress_bar(total=num_solver_steps) as progress_bar, span("denoise", steps=len(timesteps)):
             for i, t in enumerate(timesteps):
-                if self.interrupt:
-                    continue
+                if self.interrupt or (cancellation_token is not None and cancellation_token.cancelled):
+                    break
 
-                # expand the latents if we are doing classifier free guidance
-                latent_model_input = torch.cat([latents] * 2) if self.do_classifier_free_guidance else latents
                 # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
-                timestep = t.expand(latent_model_input.shape[0])
-
-                if latent_model_input.shape[-2] != latent_model_input.shape[-1]:
-                    B, C, H, W = latent_model_input.shape
-                    patch_size = self.transformer.config.patch_size
-                    pH, pW = H // patch_size, W // patch_size
-                    out = torch.zeros(
-                        (B, C, self.transformer.max_seq, patch_size * patch_size), 
-                        dtype=latent_model_input.dtype, 
-                        device=latent_model_input.device
-                    )
-                    latent_model_input = einops.rearrange(latent_model_input, 'B C (H p1) (W p2) -> B C (H W) (p1 p2)', p1=patch_size, p2=patch_size)
-                    out[:, :, 0:pH*pW] = latent_model_input
-                    latent_model_input = out
-
-                noise_pred = self.transformer(
-                    hidden_states = latent_model_input,
-                    timesteps = timestep,
-                    encoder_hidden_states = prompt_embeds,
-                    pooled_embeds = pooled_prompt_embeds,
-                    img_sizes = img_sizes,
-                    img_ids = img_ids,
-                    return_dict = False,
-                )[0]
-                noise_pred = -noise_pred
-
-                # perform guidance
-                if self.do_classifier_free_guidance:
-                    noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                    noise_pred = noise_pred_uncond + self.guidance_scale * (noise_pred_text - noise_pred_uncond)
+                timestep = t.expand(latents.shape[0])
+                step_kwargs = {}
+                if step_takes_noise and noise_seeds is not None and i < len(timesteps) - 1:
+                    step_kwargs["noise"] = noise_seeds.randn(latents.shape[1:], torch.float32, latents.device, step=i, cache=noise_cache)
 
                 # compute the previous noisy sample x_t -> x_t-1
                 latents_dtype = latents.dtype
-                latents = self.scheduler.step(noise_pred, t, latents, return_dict=False)[0]
+                if fused_step:
+                    with span("transformer", step=i):
+                        model_output = self.transformer_output(
+                            latents, timestep, prompt_embeds, pooled_prompt_embeds, img_sizes, img_ids
+                        )
+                    if self.do_classifier_free_guidance:
+                        model_output_uncond, model_output_text = model_output.chunk(2)
+                    else:
+                        model_output_uncond, model_output_text = model_output, None
+                    with span("scheduler", step=i):
+                        latents = self.scheduler.step_guided(
+                            model_output_uncond, model_output_text, self.guidance_scale, t, latents,
+                            output_scale=-1.0, return_dict=False, **step_kwargs,
+                        )[0]
+                else:
+                    with span("transformer", step=i):
+                        noise_pred = self.predict_noise(
+                            latents, timestep, prompt_embeds, pooled_prompt_embeds, img_sizes, img_ids
+                        )
+
+                    # the x0 estimate is only materialized when a step callback asks for it, e.g. for previews
+                    if needs_noise_pred:
+                        denoised = latents - t / self.scheduler.config.num_train_timesteps * noise_pred
+
+                    if step_controller is not None:
+                        solver_step = i // self.scheduler.order
+                        settled = step_controller.update(denoised, solver_step, num_solver_steps) & ~finished
+                        for row in settled.nonzero().flatten().tolist():
+                            finished_latents[row] = denoised[row]
+                            self._skipped_steps[row] = step_controller.skipped_steps(solver_step, num_solver_steps)
+                        finished |= settled
+
+                    with span("scheduler", step=i):
+                        latents = self.scheduler.step(noise_pred, t, latents, return_dict=False, **step_kwargs)[0]
 
                 if latents.dtype != latents_dtype:
                     if torch.backends.mps.is_available():
@@ -711,18 +980,28 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
                 # call the callback, if provided
                 if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0):
                     progress_bar.update()
+                    solver_steps_done += 1
 
                 if XLA_AVAILABLE:
                     xm.mark_step()
 
+                if step_controller is not None and bool(finished.all()):
+                    progress_bar.update(num_solver_steps - solver_steps_done)
+                    break
+        self.transformer.cancellation_token = None
+        if step_controller is not None:
+            latents = torch.where(finished.view(-1, 1, 1, 1), finished_latents, latents)
+
+        if self.interrupt or (cancellation_token is not None and cancellation_token.cancelled):
+            # don't spend a VAE decode on an abandoned generation
+            self.maybe_free_model_hooks()
+            raise GenerationCancelled("Generation was cancelled")
+
         if output_type == "latent":
             image = latents
 
         else:
-            latents = (latents / self.vae.config.scaling_factor) + self.vae.config.shift_factor
-
-            image = self.vae.decode(latents, return_dict=False)[0]
-            image = self.image_processor.postprocess(image, output_type=output_type)
+            image = self.decode_latents(latents, output_type=output_type)
 
         # Offload all models
         self.maybe_free_model_hooks()
@@ -0,0 +1,77 @@
+from typing import Callable, List, Optional
+
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+# Linear least-squares fit from the 16 channels of the FLUX VAE latent space (which HiDream uses) to RGB in [-1, 1].
+LATENT_RGB_FACTORS = [
+    [-0.0346, 0.0244, 0.0681],
+    [0.0034, 0.0210, 0.0687],
+    [0.0275, -0.0668, -0.0433],
+    [-0.0174, 0.0160, 0.0617],
+    [0.0859, 0.0721, 0.0329],
+    [0.0004, 0.0383, 0.0115],
+    [0.0405, 0.0861, 0.0915],
+    [-0.0236, -0.0185, -0.0259],
+    [-0.0245, 0.0250, 0.1180],
+    [0.1008, 0.0755, -0.0421],
+    [-0.0515, 0.0201, 0.0011],
+    [0.0428, -0.0012, -0.0036],
+    [0.0817, 0.0765, 0.0749],
+    [-0.1264, -0.0522, -0.1103],
+    [-0.0280, -0.0881, -0.0499],
+    [-0.1262, -0.0982, -0.0778],
+]
+LATENT_RGB_BIAS = [-0.0329, -0.0718, -0.0851]
+
+
+def latents_to_rgb(latents: torch.Tensor, max_size: int = 384) -> List[Image.Image]:
+    """
+    Approximates the VAE decode of `latents` (B, 16, H, W) with a per-pixel linear projection. Runs on the latents'
+    device and only copies the small uint8 previews back to the host. The longest side of each preview is resized to
+    `max_size` pixels.
+    """
+    factors = torch.tensor(LATENT_RGB_FACTORS, device=latents.device, dtype=torch.float32)
+    bias = torch.tensor(LATENT_RGB_BIAS, device=latents.device, dtype=torch.float32)
+    rgb = torch.einsum("bchw,cr->brhw", latents.float(), factors) + bias[None, :, None, None]
+
+    scale = max_size / max(rgb.shape[-2:])
+    if scale != 1:
+        rgb = F.interpolate(rgb, scale_factor=scale, mode="bilinear", align_corners=False)
+    rgb = ((rgb + 1) / 2).clamp(0, 1).mul(255).to(torch.uint8)
+    rgb = rgb.permute(0, 2, 3, 1).cpu().numpy()
+    return [Image.fromarray(image) for image in rgb]
+
+
+class LatentPreviewer:
+    """
+    A `callback_on_step_end` that turns the pipeline's denoised estimate into cheap RGB previews.
+
+    Pass it as `callback_on_step_end` together with `callback_on_step_end_tensor_inputs=LatentPreviewer.tensor_inputs`.
+    Every `every` steps, `sinks[i](step, image)` receives the preview of batch item `i`; items whose sink is `None` are
+    skipped.
+
+    Args:
+        sinks (`List[Optional[Callable[[int, Image.Image], None]]]`):
+            One preview consumer per batch item.
+        every (`int`, defaults to 1):
+            Preview interval in steps.
+        max_size (`int`, defaults to 384):
+            Longest side of the previews in pixels.
+    """
+
+    tensor_inputs = ["denoised"]
+
+    def __init__(self, sinks: List[Optional[Callable[[int, Image.Image], None]]], every: int = 1, max_size: int = 384):
+        self.sinks = sinks
+        self.every = every
+        self.max_size = max_size
+
+    def __call__(self, pipe, step: int, timestep, callback_kwargs: dict):
+        if (step + 1) % self.every == 0 and any(self.sinks):
+            images = latents_to_rgb(callback_kwargs["denoised"], self.max_size)
+            for sink, image in zip(self.sinks, images):
+                if sink is not None:
+                    sink(step, image)
+        return {}
@@ -0,0 +1,290 @@
+"""
+Batched variants of the flow-matching schedulers for heterogeneous batches.
+
+The schedulers in this package keep one scalar `_step_index` and one sigma schedule, so every item of a batch must
+share its step count, shift and position in the schedule. The classes here keep a sigma table and a step index per
+batch row instead, so a single `step()` advances rows that are at different points of different schedules, and rows
+can be added and removed between steps (continuous batching).
+
+Each row's schedule is computed by the wrapped scalar scheduler's own `set_timesteps`, so it is exactly the schedule a
+single run would use.
+"""
+
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence, Union
+
+import torch
+from diffusers.schedulers.scheduling_utils import SchedulerOutput
+from diffusers.utils.torch_utils import randn_tensor
+
+from .flash_flow_match import FlashFlowMatchEulerDiscreteScheduler, FlashFlowMatchEulerDiscreteSchedulerOutput
+from .fm_solvers_unipc import FlowUniPCMultistepScheduler, UniPCTables
+
+
+@dataclass
+class _Row:
+    sigmas: torch.Tensor  # (num_inference_steps + 1,) float32, CPU
+    timesteps: torch.Tensor  # (num_inference_steps,), CPU
+    step_index: int = 0
+    # UniPC only
+    lower_order_nums: int = 0
+    this_order: int = 1
+    has_last_sample: bool = False
+    disable_corrector: List[int] = field(default_factory=list)
+    tables: Optional[UniPCTables] = None
+
+    @property
+    def num_inference_steps(self) -> int:
+        return len(self.timesteps)
+
+
+def _row_view(values: torch.Tensor, sample: torch.Tensor) -> torch.Tensor:
+    """(B,) -> (B, 1, ..., 1) for broadcasting against `sample`."""
+    return values.view(-1, *([1] * (sample.ndim - 1)))
+
+
+class _BatchedScheduler:
+    scheduler_class = None
+
+    def __init__(self, scheduler):
+        if not isinstance(scheduler, self.scheduler_class):
+            raise TypeError(f"{type(self).__name__} wraps a {self.scheduler_class.__name__}, got {type(scheduler).__name__}")
+        self.scheduler = scheduler
+        self.rows: List[_Row] = []
+
+    @property
+    def config(self):
+        return self.scheduler.config
+
+    @property
+    def batch_size(self) -> int:
+        return len(self.rows)
+
+    def _schedule(self, num_inference_steps: int, scheduler=None, **kwargs):
+        scheduler = scheduler or self.scheduler
+        if type(scheduler) is not type(self.scheduler):
+            raise TypeError(f"Rows of {type(self).__name__} need a {type(self.scheduler).__name__}, got {type(scheduler).__name__}")
+        scheduler.set_timesteps(num_inference_steps, device="cpu", **kwargs)
+        return scheduler.sigmas.to("cpu", torch.float32).clone(), scheduler.timesteps.to("cpu").clone()
+
+    def add(self, num_inference_steps: int, scheduler=None, **kwargs) -> int:
+        """
+        Appends a row that starts at the first step of the schedule `set_timesteps(num_inference_steps, **kwargs)` of
+        the wrapped scheduler (e.g. `mu`, `sigmas` or `shift`), or of `scheduler`, a differently configured instance of
+        the same class (e.g. another `shift`). Returns the row index.
+        """
+        sigmas, timesteps = self._schedule(num_inference_steps, scheduler, **kwargs)
+        self.rows.append(_Row(sigmas, timesteps))
+        return len(self.rows) - 1
+
+    def remove(self, rows: Sequence[int]):
+        """Drops `rows`; the remaining rows keep their order and state."""
+        drop = set(rows)
+        self.rows = [row for i, row in enumerate(self.rows) if i not in drop]
+
+    @property
+    def step_index(self) -> torch.Tensor:
+        """Per-row index of the next step, shape (B,)."""
+        return torch.tensor([row.step_index for row in self.rows], dtype=torch.int64)
+
+    @property
+    def sigmas(self) -> torch.Tensor:
+        """Per-row sigma tables, padded with the final sigma, shape (B, max_steps + 1)."""
+        width = max(len(row.sigmas) for row in self.rows)
+        return torch.stack([torch.cat([row.sigmas, row.sigmas[-1:].expand(width - len(row.sigmas))]) for row in self.rows])
+
+    def timesteps(self, device: Union[str, torch.device] = None) -> torch.Tensor:
+        """Current timestep of every row, shape (B,), for the transformer."""
+        return torch.stack([row.timesteps[row.step_index] for row in self.rows]).to(device)
+
+    @property
+    def finished(self) -> List[bool]:
+        return [row.step_index >= row.num_inference_steps for row in self.rows]
+
+    def _sigma_pair(self, offset: int, device) -> torch.Tensor:
+        # (B, 2) of sigmas[step_index + offset], sigmas[step_index + offset + 1]
+        index = self.step_index + offset
+        table = self.sigmas
+        rows = torch.arange(len(self.rows))
+        return torch.stack([table[rows, index], table[rows, index + 1]], dim=1).to(device)
+
+
+class BatchedFlashFlowMatchEulerDiscreteScheduler(_BatchedScheduler):
+    """
+    Batched `FlashFlowMatchEulerDiscreteScheduler`: every row denoises, then is re-noised to its own next sigma. For a
+    row, `step` computes exactly what the wrapped scheduler computes for that item alone.
+
+    Args:
+        scheduler (`FlashFlowMatchEulerDiscreteScheduler`):
+            Configured scheduler whose `set_timesteps` builds each row's schedule.
+    """
+
+    scheduler_class = FlashFlowMatchEulerDiscreteScheduler
+    order = 1
+
+    def step(
+        self,
+        model_output: torch.FloatTensor,
+        sample: torch.FloatTensor,
+        noise: Optional[torch.FloatTensor] = None,
+        generator: Optional[torch.Generator] = None,
+        return_dict: bool = True,
+    ):
+        if len(self.rows) != model_output.shape[0]:
+            raise ValueError(f"Got {model_output.shape[0]} model outputs for {len(self.rows)} rows")
+        sigma, sigma_next = self._sigma_pair(0, model_output.device).unbind(1)
+        last = torch.tensor([row.step_index >= row.num_inference_steps - 1 for row in self.rows], device=sample.device)
+
+        sample = sample.to(torch.float32)
+        if not bool(last.all()):
+            # same rounding as the scalar scheduler, where a 0-dim float32 sigma keeps the product in the output dtype
+            denoised = sample - (model_output.to(torch.float32) * _row_view(sigma, sample)).to(model_output.dtype)
+            if noise is None:
+                noise = randn_tensor(model_output.shape, generator=generator, device=model_output.device, dtype=denoised.dtype)
+            sigma_next = _row_view(sigma_next, sample)
+            renoised = sigma_next * noise + (1.0 - sigma_next) * denoised
+            # like the scalar scheduler, a row's final step returns its sample unchanged
+            sample = torch.where(_row_view(last, sample), sample, renoised)
+
+        for row in self.rows:
+            row.step_index += 1
+        prev_sample = sample.to(model_output.dtype)
+
+        if not return_dict:
+            return (prev_sample,)
+        return FlashFlowMatchEulerDiscreteSchedulerOutput(prev_sample=prev_sample)
+
+
+class BatchedFlowUniPCMultistepScheduler(_BatchedScheduler):
+    """
+    Batched `FlowUniPCMultistepScheduler` (data prediction, flow targets, no `solver_p`). Every row keeps its own
+    history of converted model outputs, warm-up order and corrector state, so rows that joined at different steps or
+    run different schedules are predicted and corrected together.
+
+    Every row reads its coefficients from the same cached `UniPCTables` as the scalar scheduler. Each update is
+    combined in float32 and rounded once, so rows match the scalar scheduler exactly for float32 samples and to a few
+    ulps for bf16 ones, where the scalar scheduler rounds every intermediate.
+
+    Args:
+        scheduler (`FlowUniPCMultistepScheduler`):
+            Configured scheduler whose `set_timesteps` builds each row's schedule.
+    """
+
+    scheduler_class = FlowUniPCMultistepScheduler
+    order = 1
+
+    def __init__(self, scheduler):
+        super().__init__(scheduler)
+        if not scheduler.predict_x0 or scheduler.solver_p is not None:
+            raise ValueError(f"{type(self).__name__} supports predict_x0=True without solver_p only")
+        self.model_outputs = None  # (B, solver_order, ...), newest last
+        self.last_sample = None  # (B, ...)
+
+    def add(self, num_inference_steps: int, scheduler=None, **kwargs) -> int:
+        index = super().add(num_inference_steps, scheduler, **kwargs)
+        scheduler = scheduler or self.scheduler
+        self.rows[index].disable_corrector = list(scheduler.disable_corrector)
+        self.rows[index].tables = scheduler._tables
+        if self.model_outputs is not None:
+            self.model_outputs = torch.cat([self.model_outputs, torch.zeros_like(self.model_outputs[:1])])
+            self.last_sample = torch.cat([self.last_sample, torch.zeros_like(self.last_sample[:1])])
+        return index
+
+    def remove(self, rows: Sequence[int]):
+        keep = [i for i in range(len(self.rows)) if i not in set(rows)]
+        super().remove(rows)
+        if self.model_outputs is not None:
+            self.model_outputs = self.model_outputs[keep]
+            self.last_sample = self.last_sample[keep]
+
+    def _coefficients(self, corrector: bool, use=None) -> torch.Tensor:
+        # (B, solver_order + 2) rows of the `UniPCTables`; rows with `use[i]` False get the identity update
+        identity = torch.zeros(self.scheduler.config.solver_order + 2)
+        identity[0] = 1.0
+        coefficients = []
+        for i, row in enumerate(self.rows):
+            if use is not None and not use[i]:
+                coefficients.append(identity)
+            elif corrector:
+                coefficients.append(row.tables.corrector[row.step_index - 1, row.this_order - 1])
+            else:
+                coefficients.append(row.tables.predictor[row.step_index, row.this_order - 1])
+        return torch.stack(coefficients)
+
+    def _combine(self, coefficients, x, history, model_t=None):
+        coefficients = coefficients.to(x.device)
+        x_coef, m0_coef, t_coef = coefficients[:, 0], coefficients[:, 1], coefficients[:, -1]
+        K = history.shape[1] - 1
+        # column 2 + k weighs the (k + 1)-th newest output, history is oldest first
+        d_coefs = coefficients[:, 2:2 + K].flip(1)
+
+        m0 = history[:, -1].to(torch.float32)
+        out = _row_view(x_coef, x) * x.to(torch.float32) - _row_view(m0_coef, x) * m0
+        if K > 0:
+            diffs = history[:, :-1].to(torch.float32) - m0[:, None]
+            out = out - torch.einsum("bk,bk...->b...", d_coefs, diffs)
+        if model_t is not None:
+            out = out - _row_view(t_coef, x) * (model_t.to(torch.float32) - m0)
+        return out.to(x.dtype)
+
+    def step(self, model_output: torch.Tensor, sample: torch.Tensor, return_dict: bool = True):
+        if len(self.rows) != model_output.shape[0]:
+            raise ValueError(f"Got {model_output.shape[0]} model outputs for {len(self.rows)} rows")
+        config = self.scheduler.config
+        sigma = self._sigma_pair(0, model_output.device)[:, 0]
+
+        x0_pred = sample - (model_output.to(torch.float32) * _row_view(sigma, sample)).to(model_output.dtype)
+        if config.thresholding:
+            x0_pred = self.scheduler._threshold_sample(x0_pred)
+        if self.model_outputs is None:
+            self.model_outputs = torch.zeros(
+                (len(self.rows), config.solver_order, *sample.shape[1:]), dtype=x0_pred.dtype, device=sample.device
+            )
+            self.last_sample = torch.zeros_like(sample)
+
+        # UniC: correct the rows whose previous step left a predictor result
+        use_corrector = [
+            row.step_index > 0 and row.step_index - 1 not in row.disable_corrector and row.has_last_sample
+            for row in self.rows
+        ]
+        if any(use_corrector):
+            coefficients = self._coefficients(corrector=True, use=use_corrector)
+            corrected = self._combine(coefficients, self.last_sample, self.model_outputs, model_t=x0_pred)
+            mask = torch.tensor(use_corrector, device=sample.device)
+            sample = torch.where(_row_view(mask, sample), corrected.to(sample.dtype), sample)
+
+        self.model_outputs = torch.cat([self.model_outputs[:, 1:], x0_pred[:, None]], dim=1)
+
+        for row in self.rows:
+            if config.lower_order_final:
+                this_order = min(config.solver_order, row.num_inference_steps - row.step_index)
+            else:
+                this_order = config.solver_order
+            row.this_order = min(this_order, row.lower_order_nums + 1)
+
+        self.last_sample = sample
+        coefficients = self._coefficients(corrector=False)
+        prev_sample = self._combine(coefficients, sample, self.model_outputs)
+
+        for row in self.rows:
+            row.has_last_sample = True
+            if row.lower_order_nums < config.solver_order:
+                row.lower_order_nums += 1
+            row.step_index += 1
+
+        if not return_dict:
+            return (prev_sample,)
+        return SchedulerOutput(prev_sample=prev_sample)
+
+
+BATCHED_SCHEDULERS = {
+    FlashFlowMatchEulerDiscreteScheduler: BatchedFlashFlowMatchEulerDiscreteScheduler,
+    FlowUniPCMultistepScheduler: BatchedFlowUniPCMultistepScheduler,
+}
+
+
+def batched_scheduler(scheduler):
+    """Wraps a configured scalar scheduler in its batched variant."""
+    if type(scheduler) not in BATCHED_SCHEDULERS:
+        raise ValueError(f"No batched variant of {type(scheduler).__name__}")
+    return BATCHED_SCHEDULERS[type(scheduler)](scheduler)
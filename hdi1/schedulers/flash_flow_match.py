@@ -43,6 +43,24 @@ class FlashFlowMatchEulerDiscreteSchedulerOutput(BaseOutput):
     prev_sample: torch.FloatTensor
 
 
+def _guided_euler_step(
+        sample: torch.Tensor,
+        uncond: torch.Tensor,
+        text: Optional[torch.Tensor],
+        noise: torch.Tensor,
+        sigma: torch.Tensor,
+        sigma_next: torch.Tensor,
+        guidance_scale: float,
+        output_scale: float,
+) -> torch.Tensor:
+    # functional form of `step_guided` for `torch.compile`, which fuses it into a single pass over the latents
+    model_output = uncond.float()
+    if text is not None:
+        model_output = model_output + guidance_scale * (text.float() - model_output)
+    denoised = sample.float() - (output_scale * sigma) * model_output
+    return (sigma_next * noise + (1.0 - sigma_next) * denoised).to(sample.dtype)
+
+
 class FlashFlowMatchEulerDiscreteScheduler(SchedulerMixin, ConfigMixin):
     """
     Euler scheduler.
@@ -58,6 +76,8 @@ class FlashFlowMatchEulerDiscreteScheduler(SchedulerMixin, ConfigMixin):
             Sample Steps are Flawed](https://huggingface.co/papers/2305.08891) for more information.
         shift (`float`, defaults to 1.0):
             The shift value for the timestep schedule.
+        use_dynamic_shifting (`bool`, defaults to `False`):
+            Ignore `shift` and derive the shift from `mu`, or from the image's token count (see `resolution_mu`).
     """
 
     _compatibles = []
@@ -96,6 +116,10 @@ class FlashFlowMatchEulerDiscreteScheduler(SchedulerMixin, ConfigMixin):
 
         self._step_index = None
         self._begin_index = None
+        self._host_sigmas = None
+        self._state = None
+        self._scratch = None
+        self._compiled_step = None
 
         self.sigmas = sigmas.to("cpu")  # to avoid too much CPU/GPU communication
         self.sigma_min = self.sigmas[-1].item()
@@ -180,12 +204,22 @@ class FlashFlowMatchEulerDiscreteScheduler(SchedulerMixin, ConfigMixin):
     def time_shift(self, mu: float, sigma: float, t: torch.Tensor):
         return math.exp(mu) / (math.exp(mu) + (1 / t - 1) ** sigma)
 
+    def resolution_mu(self, image_seq_len: int) -> float:
+        """
+        Log-shift for an image of `image_seq_len` tokens: linear from `base_shift` at `base_image_seq_len` tokens to
+        `max_shift` at `max_image_seq_len`, so larger images spend more steps at high noise.
+        """
+        m = (self.config.max_shift - self.config.base_shift) / (
+                self.config.max_image_seq_len - self.config.base_image_seq_len)
+        return self.config.base_shift + m * (image_seq_len - self.config.base_image_seq_len)
+
     def set_timesteps(
             self,
             num_inference_steps: int = None,
             device: Union[str, torch.device] = None,
             sigmas: Optional[List[float]] = None,
             mu: Optional[float] = None,
+            image_seq_len: Optional[int] = None,
     ):
         """
         Sets the discrete timesteps used for the diffusion chain (to be run before inference).
@@ -195,9 +229,14 @@ class FlashFlowMatchEulerDiscreteScheduler(SchedulerMixin, ConfigMixin):
                 The number of diffusion steps used when generating samples with a pre-trained model.
             device (`str` or `torch.device`, *optional*):
                 The device to which the timesteps should be moved to. If `None`, the timesteps are not moved.
+            image_seq_len (`int`, *optional*):
+                Number of image tokens being generated; with `use_dynamic_shifting` and no `mu`, the shift follows it
+                (see `resolution_mu`).
         """
+        if self.config.use_dynamic_shifting and mu is None and image_seq_len is not None:
+            mu = self.resolution_mu(image_seq_len)
         if self.config.use_dynamic_shifting and mu is None:
-            raise ValueError(" you have a pass a value for `mu` when `use_dynamic_shifting` is set to be `True`")
+            raise ValueError(" you have a pass a value for `mu` or `image_seq_len` when `use_dynamic_shifting` is set to be `True`")
 
         if sigmas is None:
             timesteps = np.linspace(
@@ -236,6 +275,7 @@ class FlashFlowMatchEulerDiscreteScheduler(SchedulerMixin, ConfigMixin):
 
         self.timesteps = timesteps.to(device=device)
         self.sigmas = sigmas
+        self._host_sigmas = None
         self._step_index = None
         self._begin_index = None
 
@@ -272,6 +312,7 @@ class FlashFlowMatchEulerDiscreteScheduler(SchedulerMixin, ConfigMixin):
             s_noise: float = 1.0,
             generator: Optional[torch.Generator] = None,
             return_dict: bool = True,
+            noise: Optional[torch.FloatTensor] = None,
     ) -> Union[FlashFlowMatchEulerDiscreteSchedulerOutput, Tuple]:
         """
         Predict the sample from the previous timestep by reversing the SDE. This function propagates the diffusion
@@ -294,6 +335,8 @@ class FlashFlowMatchEulerDiscreteScheduler(SchedulerMixin, ConfigMixin):
             return_dict (`bool`):
                 Whether or not to return a [`~schedulers.scheduling_euler_discrete.EulerDiscreteSchedulerOutput`] or
                 tuple.
+            noise (`torch.FloatTensor`, *optional*):
+                Noise to re-noise the sample with instead of drawing it from `generator`, e.g. seeded per item and step.
 
         Returns:
             [`~schedulers.scheduling_euler_discrete.EulerDiscreteSchedulerOutput`] or `tuple`:
@@ -328,12 +371,13 @@ class FlashFlowMatchEulerDiscreteScheduler(SchedulerMixin, ConfigMixin):
 
         if self.step_index < self.num_inference_steps - 1:
             sigma_next = self.sigmas[self.step_index + 1]
-            noise = randn_tensor(
-                model_output.shape,
-                generator=generator,
-                device=model_output.device,
-                dtype=denoised.dtype,
-            )
+            if noise is None:
+                noise = randn_tensor(
+                    model_output.shape,
+                    generator=generator,
+                    device=model_output.device,
+                    dtype=denoised.dtype,
+                )
             sample = sigma_next * noise + (1.0 - sigma_next) * denoised
 
         self._step_index += 1
@@ -344,6 +388,103 @@ class FlashFlowMatchEulerDiscreteScheduler(SchedulerMixin, ConfigMixin):
 
         return FlashFlowMatchEulerDiscreteSchedulerOutput(prev_sample=sample)
 
+    def enable_compiled_step(self, **compile_kwargs):
+        r"""
+        Runs `step_guided` through `torch.compile`, which fuses guidance, denoising and re-noising into one kernel that
+        reads each input once. `compile_kwargs` go to `torch.compile`.
+        """
+        self._compiled_step = torch.compile(_guided_euler_step, **compile_kwargs)
+
+    def disable_compiled_step(self):
+        self._compiled_step = None
+
+    def _buffer(self, name: str, like: torch.Tensor) -> torch.Tensor:
+        buffer = getattr(self, name)
+        if buffer is None or buffer.shape != like.shape or buffer.device != like.device:
+            buffer = torch.empty(like.shape, dtype=torch.float32, device=like.device)
+            setattr(self, name, buffer)
+        return buffer
+
+    def step_guided(
+            self,
+            model_output_uncond: torch.FloatTensor,
+            model_output_text: Optional[torch.FloatTensor],
+            guidance_scale: float,
+            timestep: Union[float, torch.FloatTensor],
+            sample: torch.FloatTensor,
+            output_scale: float = 1.0,
+            generator: Optional[torch.Generator] = None,
+            return_dict: bool = True,
+            noise: Optional[torch.FloatTensor] = None,
+    ) -> Union[FlashFlowMatchEulerDiscreteSchedulerOutput, Tuple]:
+        """
+        `step` with classifier-free guidance folded in: the model output is
+        `output_scale * (model_output_uncond + guidance_scale * (model_output_text - model_output_uncond))`, or
+        `output_scale * model_output_uncond` without `model_output_text`.
+
+        The guidance combine, denoise and re-noise are accumulated in place in a float32 buffer kept across steps, so
+        the only full-size allocation is the returned sample (see `enable_compiled_step` for a single fused kernel).
+        As in `step`, the final step returns `sample` unchanged.
+
+        Args:
+            model_output_uncond (`torch.FloatTensor`):
+                Unconditional half of the model output, or the whole output without guidance.
+            model_output_text (`torch.FloatTensor`, *optional*):
+                Text-conditioned half of the model output.
+            guidance_scale (`float`):
+                Classifier-free guidance scale.
+            output_scale (`float`, defaults to 1.0):
+                Scale of the model output, e.g. -1 for a transformer that predicts the negated flow.
+        """
+        if self.step_index is None:
+            self._init_step_index(timestep)
+
+        if self.step_index >= self.num_inference_steps - 1:
+            # the final denoise is discarded, as in `step`
+            self._step_index += 1
+            sample = sample.to(model_output_uncond.dtype)
+            return (sample,) if not return_dict else FlashFlowMatchEulerDiscreteSchedulerOutput(prev_sample=sample)
+
+        if noise is None:
+            noise = randn_tensor(
+                model_output_uncond.shape,
+                generator=generator,
+                device=model_output_uncond.device,
+                dtype=torch.float32,
+            )
+
+        if self._compiled_step is not None:
+            sigma, sigma_next = self.sigmas[self.step_index], self.sigmas[self.step_index + 1]
+            prev_sample = self._compiled_step(
+                sample, model_output_uncond, model_output_text, noise,
+                sigma.to(sample.device), sigma_next.to(sample.device), guidance_scale, output_scale,
+            ).to(model_output_uncond.dtype)
+        else:
+            if self._host_sigmas is None:
+                self._host_sigmas = self.sigmas.cpu().tolist()
+            sigma, sigma_next = self._host_sigmas[self.step_index], self._host_sigmas[self.step_index + 1]
+            # prev = (1 - sigma_next) * (sample - output_scale * sigma * (u + g * (t - u))) + sigma_next * noise
+            keep = 1.0 - sigma_next
+            scale = -keep * output_scale * sigma
+            state = self._buffer("_state", sample)
+            # upcast before any arithmetic: an `out=` float32 tensor doesn't stop bf16 inputs being computed in bf16
+            state.copy_(sample).mul_(keep)
+            if model_output_text is None:
+                state.add_(model_output_uncond, alpha=scale)
+            else:
+                scratch = self._buffer("_scratch", sample)
+                scratch.copy_(model_output_text).sub_(model_output_uncond)
+                state.add_(model_output_uncond, alpha=scale).add_(scratch, alpha=scale * guidance_scale)
+            state.add_(noise, alpha=sigma_next)
+            prev_sample = state.to(model_output_uncond.dtype, copy=True)
+
+        self._step_index += 1
+
+        if not return_dict:
+            return (prev_sample,)
+
+        return FlashFlowMatchEulerDiscreteSchedulerOutput(prev_sample=prev_sample)
+
     # Copied from diffusers.schedulers.scheduling_euler_discrete.EulerDiscreteScheduler._convert_to_karras
     def _convert_to_karras(self, in_sigmas: torch.Tensor, num_inference_steps) -> torch.Tensor:
         """Constructs the noise schedule of Karras et al. (2022)."""
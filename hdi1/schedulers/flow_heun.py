@@ -0,0 +1,227 @@
+# Two-stage Runge-Kutta sampling (Heun, midpoint) of the flow-matching ODE dx/dsigma = v(x, sigma)
+
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+from diffusers.configuration_utils import ConfigMixin, register_to_config
+from diffusers.schedulers.scheduling_utils import SchedulerMixin, SchedulerOutput
+
+from .fm_solvers_dpm import resolution_mu, shifted_flow_sigmas
+
+
+class FlowHeunDiscreteScheduler(SchedulerMixin, ConfigMixin):
+    """
+    Heun's method or the explicit midpoint method on the flow-matching ODE `dx/dsigma = v`. Every step between two
+    sigmas takes two model evaluations, so `timesteps` interleaves them (`order = 2`) as in diffusers'
+    `HeunDiscreteScheduler`; the final step into sigma 0 is a single Euler evaluation. `num_inference_steps` steps thus
+    cost `2 * num_inference_steps - 1` evaluations.
+
+    `step` returns the intermediate sample after the first stage of a step and the next sample after the second, so
+    the sampling loop stays the usual one evaluation per `step` call.
+
+    This model inherits from [`SchedulerMixin`] and [`ConfigMixin`]. Check the superclass documentation for the generic
+    methods the library implements for all schedulers such as loading and saving.
+
+    Args:
+        num_train_timesteps (`int`, defaults to 1000):
+            The number of diffusion steps to train the model.
+        shift (`float`, defaults to 1.0):
+            The shift value for the timestep schedule.
+        use_dynamic_shifting (`bool`, defaults to `False`):
+            Ignore `shift` and derive the shift from `mu`, or from the image's token count (see `resolution_mu`).
+        solver_type (`str`, defaults to `"heun"`):
+            `"heun"` averages the velocities at both ends of a step (trapezoidal); `"midpoint"` evaluates once at the
+            middle sigma and steps with that velocity.
+        base_shift (`float`, defaults to 0.5), max_shift (`float`, defaults to 1.15):
+            Log-shift (`mu`) at `base_image_seq_len` and `max_image_seq_len` image tokens, for `use_dynamic_shifting`
+            with an `image_seq_len`.
+        base_image_seq_len (`int`, defaults to 256), max_image_seq_len (`int`, defaults to 4096):
+            Token counts the two shifts are anchored at.
+    """
+
+    _compatibles = []
+    order = 2
+
+    @register_to_config
+    def __init__(
+            self,
+            num_train_timesteps: int = 1000,
+            shift: Optional[float] = 1.0,
+            use_dynamic_shifting: bool = False,
+            solver_type: str = "heun",
+            base_shift: float = 0.5,
+            max_shift: float = 1.15,
+            base_image_seq_len: int = 256,
+            max_image_seq_len: int = 4096,
+    ):
+        if solver_type not in ["heun", "midpoint"]:
+            raise NotImplementedError(f"{solver_type} is not implemented for {self.__class__}")
+
+        alphas = np.linspace(1, 1 / num_train_timesteps, num_train_timesteps)[::-1].copy()
+        sigmas = torch.from_numpy(1.0 - alphas).to(dtype=torch.float32)
+        if not use_dynamic_shifting:
+            # when use_dynamic_shifting is True, we apply the timestep shifting on the fly based on the image resolution
+            sigmas = shift * sigmas / (1 + (shift - 1) * sigmas)
+
+        self.sigmas = sigmas
+        self.timesteps = sigmas * num_train_timesteps
+        self.sigma_min = self.sigmas[-1].item()
+        self.sigma_max = self.sigmas[0].item()
+
+        self.num_inference_steps = None
+        self._step_sigmas = None
+        self._sample = None
+        self._velocity = None
+        self._step_index = None
+        self._begin_index = None
+
+    @property
+    def step_index(self):
+        """
+        The index counter for current timestep. It will increase 1 after each scheduler step.
+        """
+        return self._step_index
+
+    @property
+    def begin_index(self):
+        """
+        The index for the first timestep. It should be set from pipeline with `set_begin_index` method.
+        """
+        return self._begin_index
+
+    def set_begin_index(self, begin_index: int = 0):
+        """
+        Sets the begin index for the scheduler. This function should be run from pipeline before the inference.
+
+        Args:
+            begin_index (`int`):
+                The begin index for the scheduler.
+        """
+        self._begin_index = begin_index
+
+    @property
+    def state_in_first_order(self):
+        """Whether the next `step` starts a step (first stage) rather than completing one."""
+        return self._sample is None
+
+    def resolution_mu(self, image_seq_len: int) -> float:
+        """
+        Log-shift for an image of `image_seq_len` tokens: linear from `base_shift` at `base_image_seq_len` tokens to
+        `max_shift` at `max_image_seq_len`, so larger images spend more steps at high noise.
+        """
+        return resolution_mu(self.config, image_seq_len)
+
+    def set_timesteps(
+        self,
+        num_inference_steps: Optional[int] = None,
+        device: Union[str, torch.device] = None,
+        sigmas: Optional[List[float]] = None,
+        mu: Optional[float] = None,
+        shift: Optional[float] = None,
+        image_seq_len: Optional[int] = None,
+    ):
+        """
+        Sets the discrete timesteps used for the diffusion chain (to be run before inference).
+
+        Args:
+            num_inference_steps (`int`):
+                Number of steps between sigmas; the schedule has `2 * num_inference_steps - 1` timesteps.
+            device (`str` or `torch.device`, *optional*):
+                The device to which the timesteps should be moved to. If `None`, the timesteps are not moved.
+            sigmas (`List[float]`, *optional*):
+                Unshifted sigmas to use instead of `num_inference_steps` evenly spaced ones.
+            image_seq_len (`int`, *optional*):
+                Number of image tokens being generated; with `use_dynamic_shifting` and no `mu`, the shift follows it.
+        """
+        step_sigmas = shifted_flow_sigmas(
+            self.config, self.sigma_max, self.sigma_min, num_inference_steps, sigmas, mu, shift, image_seq_len
+        ).tolist() + [0.0]
+        self._step_sigmas = step_sigmas
+        self.num_inference_steps = len(step_sigmas) - 1
+
+        # sigma of every evaluation: both stages of each step, then the final Euler evaluation
+        evaluations = []
+        for i in range(self.num_inference_steps - 1):
+            second = step_sigmas[i + 1]
+            if self.config.solver_type == "midpoint":
+                second = 0.5 * (step_sigmas[i] + step_sigmas[i + 1])
+            evaluations += [step_sigmas[i], second]
+        evaluations.append(step_sigmas[-2])
+
+        self.sigmas = torch.tensor(evaluations + [0.0], dtype=torch.float32)
+        self.timesteps = (self.sigmas[:-1] * self.config.num_train_timesteps).to(device=device)
+
+        self._sample = None
+        self._velocity = None
+        self._step_index = None
+        self._begin_index = None
+
+    def step(
+        self,
+        model_output: torch.Tensor,
+        timestep: Union[float, torch.Tensor],
+        sample: torch.Tensor,
+        return_dict: bool = True,
+        generator=None,
+    ) -> Union[SchedulerOutput, Tuple]:
+        """
+        Advances one stage: from the start of a step to its intermediate sample, or from there to the next step.
+
+        Args:
+            model_output (`torch.Tensor`):
+                The velocity predicted by the flow model for `sample`.
+            timestep (`float`):
+                The current discrete timestep in the diffusion chain.
+            sample (`torch.Tensor`):
+                A current instance of a sample created by the diffusion process.
+            return_dict (`bool`):
+                Whether or not to return a [`~schedulers.scheduling_utils.SchedulerOutput`] or `tuple`.
+
+        Returns:
+            [`~schedulers.scheduling_utils.SchedulerOutput`] or `tuple`:
+                If return_dict is `True`, [`~schedulers.scheduling_utils.SchedulerOutput`] is returned, otherwise a
+                tuple is returned where the first element is the sample tensor.
+        """
+        if self.num_inference_steps is None:
+            raise ValueError(
+                "Number of inference steps is 'None', you need to run 'set_timesteps' after creating the scheduler"
+            )
+        if self._step_index is None:
+            # timesteps repeat, so they can't be looked up; a run starts at `begin_index`
+            self._step_index = self._begin_index or 0
+
+        step = self._step_index // 2
+        sigma, sigma_next = self._step_sigmas[step], self._step_sigmas[step + 1]
+        velocity = model_output.float()
+
+        if self._step_index == len(self.timesteps) - 1:
+            # final Euler step into sigma 0
+            prev_sample = sample.float() + (sigma_next - sigma) * velocity
+        elif self.state_in_first_order:
+            self._sample, self._velocity = sample.float(), velocity
+            target = self.sigmas[self._step_index + 1].item()
+            prev_sample = self._sample + (target - sigma) * velocity
+        else:
+            if self.config.solver_type == "heun":
+                velocity = 0.5 * (self._velocity + velocity)
+            prev_sample = self._sample + (sigma_next - sigma) * velocity
+            self._sample, self._velocity = None, None
+
+        prev_sample = prev_sample.to(model_output.dtype)
+        self._step_index += 1
+
+        if not return_dict:
+            return (prev_sample,)
+
+        return SchedulerOutput(prev_sample=prev_sample)
+
+    def scale_model_input(self, sample: torch.Tensor, *args, **kwargs) -> torch.Tensor:
+        """
+        Ensures interchangeability with schedulers that need to scale the denoising model input depending on the
+        current timestep.
+        """
+        return sample
+
+    def __len__(self):
+        return self.config.num_train_timesteps
@@ -0,0 +1,365 @@
+# DPM-Solver++ multistep sampling for flow matching, following the conventions of fm_solvers_unipc
+# (x_t = (1 - sigma) * x_0 + sigma * noise, flow_prediction outputs with x_0 = x_t - sigma * v)
+
+import math
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+from diffusers.configuration_utils import ConfigMixin, register_to_config
+from diffusers.schedulers.scheduling_utils import SchedulerMixin, SchedulerOutput
+
+from .fm_solvers_unipc import _flow_sigmas
+
+ALGORITHM_TYPES = ["dpmsolver++", "deis"]
+
+# Gauss-Legendre nodes for the exponentially weighted integrals of the "deis" updates; the integrands are e^lambda
+# times a polynomial of degree < 4, which 16 nodes integrate to float64 precision over any step
+_QUADRATURE = np.polynomial.legendre.leggauss(16)
+
+
+def resolution_mu(config, image_seq_len: int) -> float:
+    """Log-shift for `image_seq_len` tokens from the `base_*`/`max_*` entries of a flow scheduler `config`."""
+    m = (config.max_shift - config.base_shift) / (config.max_image_seq_len - config.base_image_seq_len)
+    return config.base_shift + m * (image_seq_len - config.base_image_seq_len)
+
+
+def shifted_flow_sigmas(
+    config,
+    sigma_max: float,
+    sigma_min: float,
+    num_inference_steps: Optional[int],
+    sigmas: Optional[List[float]],
+    mu: Optional[float],
+    shift: Optional[float],
+    image_seq_len: Optional[int],
+) -> np.ndarray:
+    """
+    The float64 sigmas (without the final 0) that `FlowUniPCMultistepScheduler.set_timesteps` would use for the same
+    arguments: `num_inference_steps` linearly spaced or the given `sigmas`, shifted by `shift` (defaulting to
+    `config.shift`), or by `mu` or `image_seq_len` under `use_dynamic_shifting`.
+    """
+    if config.use_dynamic_shifting and mu is None and image_seq_len is not None:
+        mu = resolution_mu(config, image_seq_len)
+    if config.use_dynamic_shifting and mu is None:
+        raise ValueError(
+            " you have to pass a value for `mu` or `image_seq_len` when `use_dynamic_shifting` is set to be `True`"
+        )
+    if shift is None:
+        shift = config.shift
+    if sigmas is None:
+        return np.array(_flow_sigmas(
+            num_inference_steps, sigma_max, sigma_min,
+            None if config.use_dynamic_shifting else float(shift),
+            float(mu) if config.use_dynamic_shifting else None,
+        ))
+    sigmas = np.asarray(sigmas, dtype=np.float64)
+    if config.use_dynamic_shifting:
+        return math.exp(mu) / (math.exp(mu) + (1 / sigmas - 1))
+    return shift * sigmas / (1 + (shift - 1) * sigmas)
+
+
+def _lambda(sigma: float) -> float:
+    # half log-SNR of the flow schedule, alpha = 1 - sigma
+    return math.log(1 - sigma) - math.log(sigma)
+
+
+class FlowDPMSolverMultistepScheduler(SchedulerMixin, ConfigMixin):
+    """
+    DPM-Solver++ for flow matching: the multistep exponential integrator of the probability-flow ODE in data
+    prediction, `x_t = (sigma_t / sigma_s) x_s + sigma_t * integral e^lambda x_0(lambda) dlambda` with
+    `lambda = log((1 - sigma) / sigma)`, which is exact for the linear part and only approximates `x_0` along the step.
+
+    `solver_order=2` is DPM-Solver++(2M) and `solver_order=3` DPM-Solver++(3M), both using the model's last outputs;
+    the first steps warm up at lower orders and the final step into sigma 0 is first order.
+
+    This model inherits from [`SchedulerMixin`] and [`ConfigMixin`]. Check the superclass documentation for the generic
+    methods the library implements for all schedulers such as loading and saving.
+
+    Args:
+        num_train_timesteps (`int`, defaults to 1000):
+            The number of diffusion steps to train the model.
+        solver_order (`int`, defaults to 2):
+            Number of model outputs each update uses, 1 to 3. 2 is recommended for guided sampling.
+        prediction_type (`str`, defaults to `"flow_prediction"`):
+            Must be `flow_prediction`: the model predicts the velocity `noise - x_0`.
+        shift (`float`, defaults to 1.0):
+            The shift value for the timestep schedule.
+        use_dynamic_shifting (`bool`, defaults to `False`):
+            Ignore `shift` and derive the shift from `mu`, or from the image's token count (see `resolution_mu`).
+        algorithm_type (`str`, defaults to `"dpmsolver++"`):
+            How `x_0` is approximated along a step. `"dpmsolver++"` uses the finite differences of DPM-Solver++;
+            `"deis"` integrates the Lagrange polynomial through the last `solver_order` outputs in `lambda` exactly
+            (the exponential integrator of DEIS), which differs from DPM-Solver++ on uneven step sizes.
+        solver_type (`str`, defaults to `"midpoint"`):
+            Second-order `"dpmsolver++"` variant, `"midpoint"` or `"heun"`. The third order and `"deis"` ignore it.
+        lower_order_final (`bool`, defaults to `True`):
+            Drop to second order for the last two steps of schedules shorter than 15 steps, which stabilizes them.
+        base_shift (`float`, defaults to 0.5), max_shift (`float`, defaults to 1.15):
+            Log-shift (`mu`) at `base_image_seq_len` and `max_image_seq_len` image tokens, for `use_dynamic_shifting`
+            with an `image_seq_len`.
+        base_image_seq_len (`int`, defaults to 256), max_image_seq_len (`int`, defaults to 4096):
+            Token counts the two shifts are anchored at.
+    """
+
+    _compatibles = []
+    order = 1
+
+    @register_to_config
+    def __init__(
+            self,
+            num_train_timesteps: int = 1000,
+            solver_order: int = 2,
+            prediction_type: str = "flow_prediction",
+            shift: Optional[float] = 1.0,
+            use_dynamic_shifting: bool = False,
+            algorithm_type: str = "dpmsolver++",
+            solver_type: str = "midpoint",
+            lower_order_final: bool = True,
+            base_shift: float = 0.5,
+            max_shift: float = 1.15,
+            base_image_seq_len: int = 256,
+            max_image_seq_len: int = 4096,
+    ):
+        if algorithm_type not in ALGORITHM_TYPES:
+            raise NotImplementedError(f"{algorithm_type} is not implemented for {self.__class__}")
+        if solver_type not in ["midpoint", "heun"]:
+            raise NotImplementedError(f"{solver_type} is not implemented for {self.__class__}")
+        if solver_order not in [1, 2, 3]:
+            raise ValueError(f"`solver_order` must be 1, 2 or 3, but got {solver_order}")
+        if prediction_type != "flow_prediction":
+            raise ValueError(f"`prediction_type` must be `flow_prediction` for {self.__class__}")
+
+        alphas = np.linspace(1, 1 / num_train_timesteps, num_train_timesteps)[::-1].copy()
+        sigmas = torch.from_numpy(1.0 - alphas).to(dtype=torch.float32)
+        if not use_dynamic_shifting:
+            # when use_dynamic_shifting is True, we apply the timestep shifting on the fly based on the image resolution
+            sigmas = shift * sigmas / (1 + (shift - 1) * sigmas)
+
+        self.sigmas = sigmas
+        self.timesteps = sigmas * num_train_timesteps
+        self.sigma_min = self.sigmas[-1].item()
+        self.sigma_max = self.sigmas[0].item()
+
+        self.num_inference_steps = None
+        self.model_outputs = [None] * solver_order
+        self.lower_order_nums = 0
+        self._schedule = None
+        self._step_index = None
+        self._begin_index = None
+
+    @property
+    def step_index(self):
+        """
+        The index counter for current timestep. It will increase 1 after each scheduler step.
+        """
+        return self._step_index
+
+    @property
+    def begin_index(self):
+        """
+        The index for the first timestep. It should be set from pipeline with `set_begin_index` method.
+        """
+        return self._begin_index
+
+    def set_begin_index(self, begin_index: int = 0):
+        """
+        Sets the begin index for the scheduler. This function should be run from pipeline before the inference.
+
+        Args:
+            begin_index (`int`):
+                The begin index for the scheduler.
+        """
+        self._begin_index = begin_index
+
+    def resolution_mu(self, image_seq_len: int) -> float:
+        """
+        Log-shift for an image of `image_seq_len` tokens: linear from `base_shift` at `base_image_seq_len` tokens to
+        `max_shift` at `max_image_seq_len`, so larger images spend more steps at high noise.
+        """
+        return resolution_mu(self.config, image_seq_len)
+
+    def set_timesteps(
+        self,
+        num_inference_steps: Optional[int] = None,
+        device: Union[str, torch.device] = None,
+        sigmas: Optional[List[float]] = None,
+        mu: Optional[float] = None,
+        shift: Optional[float] = None,
+        image_seq_len: Optional[int] = None,
+    ):
+        """
+        Sets the discrete timesteps used for the diffusion chain (to be run before inference).
+
+        Args:
+            num_inference_steps (`int`):
+                Total number of the spacing of the time steps.
+            device (`str` or `torch.device`, *optional*):
+                The device to which the timesteps should be moved to. If `None`, the timesteps are not moved.
+            sigmas (`List[float]`, *optional*):
+                Unshifted sigmas to use instead of `num_inference_steps` evenly spaced ones.
+            image_seq_len (`int`, *optional*):
+                Number of image tokens being generated; with `use_dynamic_shifting` and no `mu`, the shift follows it.
+        """
+        sigmas = shifted_flow_sigmas(
+            self.config, self.sigma_max, self.sigma_min, num_inference_steps, sigmas, mu, shift, image_seq_len
+        )
+        timesteps = sigmas * self.config.num_train_timesteps
+        # the solver works on the float64 schedule; `sigmas` is the usual float32 view ending at 0
+        self._schedule = sigmas.tolist() + [0.0]
+        self.sigmas = torch.tensor(self._schedule, dtype=torch.float32)
+        self.timesteps = torch.from_numpy(timesteps).to(device=device, dtype=torch.float32)
+
+        self.num_inference_steps = len(timesteps)
+        self.model_outputs = [None] * self.config.solver_order
+        self.lower_order_nums = 0
+        self._step_index = None
+        self._begin_index = None
+
+    def convert_model_output(self, model_output: torch.Tensor, sample: torch.Tensor) -> torch.Tensor:
+        """The data prediction `x_0 = x_t - sigma_t * v` of a flow model output, in float32."""
+        sigma_t = self._schedule[self.step_index]
+        return sample.float() - sigma_t * model_output.float()
+
+    def update_coefficients(self, step_index: int, order: int) -> Tuple[float, List[float]]:
+        """
+        The update from step `step_index` to the next as `x_t = c_x * x_s + sum_k c_k * m_k`, where `m_k` is the data
+        prediction of step `step_index - k`. Computed in float64 from the schedule.
+        """
+        sigma_s0, sigma_t = self._schedule[step_index], self._schedule[step_index + 1]
+        alpha_s0, alpha_t = 1 - sigma_s0, 1 - sigma_t
+        x_coef = sigma_t / sigma_s0
+        # alpha_t * (1 - e^{-h}), written without lambda_t so that sigma_t = 0 is fine
+        first = alpha_t - x_coef * alpha_s0
+        if order == 1:
+            return x_coef, [first]
+
+        lambdas = [_lambda(self._schedule[step_index - k]) for k in range(order)]
+        lambda_t = _lambda(sigma_t)
+        h = lambda_t - lambdas[0]
+
+        if self.config.algorithm_type == "deis":
+            # sigma_t * integral_{lambda_s0}^{lambda_t} e^lambda L_k(lambda) dlambda for the Lagrange basis L_k
+            nodes, weights = _QUADRATURE
+            lam = lambdas[0] + (nodes + 1) * (h / 2)
+            coefs = []
+            for k in range(order):
+                basis = np.ones_like(lam)
+                for j in range(order):
+                    if j != k:
+                        basis *= (lam - lambdas[j]) / (lambdas[k] - lambdas[j])
+                coefs.append(float(sigma_t * (h / 2) * np.sum(weights * np.exp(lam) * basis)))
+            return x_coef, coefs
+
+        # DPM-Solver++ in the basis of the model outputs: m[k] is the unit vector of m_k
+        m = np.eye(order)
+        phi_1 = math.expm1(-h)
+        r0 = (lambdas[0] - lambdas[1]) / h
+        d1_0 = (m[0] - m[1]) / r0
+        if order == 2:
+            if self.config.solver_type == "midpoint":
+                combination = first * m[0] - 0.5 * (alpha_t * phi_1) * d1_0
+            else:
+                combination = first * m[0] + (alpha_t * (phi_1 / h + 1.0)) * d1_0
+        else:
+            r1 = (lambdas[1] - lambdas[2]) / h
+            d1_1 = (m[1] - m[2]) / r1
+            d1 = d1_0 + (r0 / (r0 + r1)) * (d1_0 - d1_1)
+            d2 = (d1_0 - d1_1) / (r0 + r1)
+            combination = (
+                first * m[0]
+                + (alpha_t * (phi_1 / h + 1.0)) * d1
+                - (alpha_t * ((phi_1 + h) / h**2 - 0.5)) * d2
+            )
+        return x_coef, combination.tolist()
+
+    def index_for_timestep(self, timestep, schedule_timesteps=None):
+        if schedule_timesteps is None:
+            schedule_timesteps = self.timesteps
+
+        indices = (schedule_timesteps == timestep).nonzero()
+        pos = 1 if len(indices) > 1 else 0
+        return indices[pos].item()
+
+    def _init_step_index(self, timestep):
+        """
+        Initialize the step_index counter for the scheduler.
+        """
+        if self.begin_index is None:
+            if isinstance(timestep, torch.Tensor):
+                timestep = timestep.to(self.timesteps.device)
+            self._step_index = self.index_for_timestep(timestep)
+        else:
+            self._step_index = self._begin_index
+
+    def step(
+        self,
+        model_output: torch.Tensor,
+        timestep: Union[int, torch.Tensor],
+        sample: torch.Tensor,
+        return_dict: bool = True,
+        generator=None,
+    ) -> Union[SchedulerOutput, Tuple]:
+        """
+        Predict the sample from the previous timestep with the multistep DPM-Solver++ (or DEIS) update.
+
+        Args:
+            model_output (`torch.Tensor`):
+                The direct output from learned diffusion model.
+            timestep (`int`):
+                The current discrete timestep in the diffusion chain.
+            sample (`torch.Tensor`):
+                A current instance of a sample created by the diffusion process.
+            return_dict (`bool`):
+                Whether or not to return a [`~schedulers.scheduling_utils.SchedulerOutput`] or `tuple`.
+
+        Returns:
+            [`~schedulers.scheduling_utils.SchedulerOutput`] or `tuple`:
+                If return_dict is `True`, [`~schedulers.scheduling_utils.SchedulerOutput`] is returned, otherwise a
+                tuple is returned where the first element is the sample tensor.
+        """
+        if self.num_inference_steps is None:
+            raise ValueError(
+                "Number of inference steps is 'None', you need to run 'set_timesteps' after creating the scheduler"
+            )
+        if self.step_index is None:
+            self._init_step_index(timestep)
+
+        # the last step lands on sigma = 0 and is first order; short schedules also ease into it
+        final = self.step_index == self.num_inference_steps - 1
+        second_to_last = (
+            self.step_index == self.num_inference_steps - 2
+            and self.config.lower_order_final
+            and self.num_inference_steps < 15
+        )
+
+        self.model_outputs = [self.convert_model_output(model_output, sample)] + self.model_outputs[:-1]
+        order = min(self.config.solver_order, self.lower_order_nums + 1)
+        if final:
+            order = 1
+        elif second_to_last:
+            order = min(order, 2)
+
+        x_coef, coefs = self.update_coefficients(self.step_index, order)
+        prev_sample = x_coef * sample.float()
+        for coef, output in zip(coefs, self.model_outputs):
+            prev_sample = prev_sample.add_(output, alpha=coef)
+        prev_sample = prev_sample.to(model_output.dtype)
+
+        self.lower_order_nums = min(self.lower_order_nums + 1, self.config.solver_order)
+        self._step_index += 1
+
+        if not return_dict:
+            return (prev_sample,)
+
+        return SchedulerOutput(prev_sample=prev_sample)
+
+    def scale_model_input(self, sample: torch.Tensor, *args, **kwargs) -> torch.Tensor:
+        """
+        Ensures interchangeability with schedulers that need to scale the denoising model input depending on the
+        current timestep.
+        """
+        return sample
+
+    def __len__(self):
+        return self.config.num_train_timesteps
@@ -2,7 +2,9 @@
 # Convert unipc for flow matching
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
 
+import functools
 import math
+from dataclasses import dataclass
 from typing import List, Optional, Tuple, Union
 
 import numpy as np
@@ -17,6 +19,112 @@ if is_scipy_available():
     import scipy.stats
 
 
+@functools.lru_cache(maxsize=64)
+def _flow_sigmas(
+    num_inference_steps: int,
+    sigma_max: float,
+    sigma_min: float,
+    shift: Optional[float],
+    mu: Optional[float],
+) -> Tuple[float, ...]:
+    # the shifted float64 sigmas of `set_timesteps`; `mu` selects the dynamic (resolution) shift, else `shift`
+    sigmas = np.linspace(sigma_max, sigma_min, num_inference_steps + 1).copy()[:-1]
+    if mu is not None:
+        sigmas = math.exp(mu) / (math.exp(mu) + (1 / sigmas - 1)**1.0)
+    else:
+        sigmas = shift * sigmas / (1 + (shift - 1) * sigmas)
+    return tuple(sigmas.tolist())
+
+
+def _uni_bh_coefficients(sigmas: torch.Tensor, s: int, order: int, solver_type: str, predict_x0: bool, corrector: bool):
+    # UniP (`corrector=False`) or UniC update from sigma index `s` to `s + 1` as one linear combination:
+    #   x_t = c[0] * x - c[1] * m0 - sum_k c[1 + k] * (m_k - m0) - c[-1] * (model_t - m0)
+    # where `m0` is the newest converted model output, `m_k` the k-th older one and `model_t` the output at x_t (UniC).
+    # Same float32 operations as the per-step updates, with D1s = (m_k - m0) / r_k folded into the coefficients.
+    alpha_t, sigma_t = 1 - sigmas[s + 1], sigmas[s + 1]
+    alpha_s0, sigma_s0 = 1 - sigmas[s], sigmas[s]
+    lambda_t = torch.log(alpha_t) - torch.log(sigma_t)
+    lambda_s0 = torch.log(alpha_s0) - torch.log(sigma_s0)
+    h = lambda_t - lambda_s0
+
+    rks = []
+    for i in range(1, order):
+        alpha_si, sigma_si = 1 - sigmas[s - i], sigmas[s - i]
+        lambda_si = torch.log(alpha_si) - torch.log(sigma_si)
+        rks.append((lambda_si - lambda_s0) / h)
+    rks.append(1.0)
+    rks = torch.tensor(rks)
+
+    hh = -h if predict_x0 else h
+    h_phi_1 = torch.expm1(hh)  # h\phi_1(h) = e^h - 1
+    h_phi_k = h_phi_1 / hh - 1
+    factorial_i = 1
+    B_h = hh if solver_type == "bh1" else torch.expm1(hh)
+    R, b = [], []
+    for i in range(1, order + 1):
+        R.append(torch.pow(rks, i - 1))
+        b.append(h_phi_k * factorial_i / B_h)
+        factorial_i *= i + 1
+        h_phi_k = h_phi_k / hh - 1 / factorial_i
+    R = torch.stack(R)
+    b = torch.tensor(b)
+
+    if corrector:
+        rhos = torch.tensor([0.5]) if order == 1 else torch.linalg.solve(R, b)
+    elif order == 1:
+        rhos = torch.zeros(0)
+    elif order == 2:
+        rhos = torch.tensor([0.5])
+    else:
+        rhos = torch.linalg.solve(R[:-1, :-1], b[:-1])
+
+    if predict_x0:
+        x_coef, m0_coef, scale = sigma_t / sigma_s0, alpha_t * h_phi_1, alpha_t * B_h
+    else:
+        x_coef, m0_coef, scale = alpha_t / alpha_s0, sigma_t * h_phi_1, sigma_t * B_h
+    d_coefs = [scale * rhos[k] / rks[k] for k in range(order - 1)]
+    t_coef = scale * rhos[-1] if corrector else torch.tensor(0.0)
+    return [x_coef, m0_coef, *d_coefs, t_coef]
+
+
+@dataclass(frozen=True)
+class UniPCTables:
+    """
+    Coefficients of every UniP and UniC update of one sigma schedule, float32 on the CPU.
+
+    `predictor[s, p - 1]` is the order-`p` update from step `s` to `s + 1` and `corrector[s, p - 1]` the order-`p`
+    correction of its result. Each row is `[x, m0, d_1, ..., d_{solver_order - 1}, t]` (see `_uni_bh_coefficients`);
+    the `d` of older outputs an order doesn't use are 0, and orders a step can't reach (not enough history, singular
+    systems) are NaN.
+    """
+
+    predictor: torch.Tensor  # (num_inference_steps, solver_order, solver_order + 2)
+    corrector: torch.Tensor  # (num_inference_steps, solver_order, solver_order + 2)
+
+
+@functools.lru_cache(maxsize=64)
+def unipc_tables(sigmas: Tuple[float, ...], solver_order: int, solver_type: str, predict_x0: bool) -> UniPCTables:
+    """UniPC coefficient tables for `sigmas` (including the final sigma), cached across schedulers and requests."""
+    sigmas = torch.tensor(sigmas, dtype=torch.float32)
+    num_steps = len(sigmas) - 1
+    tables = {}
+    for corrector in (False, True):
+        table = torch.full((num_steps, solver_order, solver_order + 2), float("nan"))
+        for s in range(num_steps):
+            for order in range(1, min(solver_order, s + 1) + 1):
+                try:
+                    coefs = _uni_bh_coefficients(sigmas, s, order, solver_type, predict_x0, corrector)
+                except RuntimeError:
+                    # singular system, e.g. a higher order into sigma = 0 without `lower_order_final`
+                    continue
+                row = table[s, order - 1]
+                row.zero_()
+                row[0], row[1], row[-1] = coefs[0], coefs[1], coefs[-1]
+                row[2:2 + order - 1] = torch.stack(coefs[2:-1]) if order > 1 else row[2:2]
+        tables[corrector] = table
+    return UniPCTables(predictor=tables[False], corrector=tables[True])
+
+
 class FlowUniPCMultistepScheduler(SchedulerMixin, ConfigMixin):
     """
     `UniPCMultistepScheduler` is a training-free framework designed for the fast sampling of diffusion models.
@@ -68,6 +176,11 @@ class FlowUniPCMultistepScheduler(SchedulerMixin, ConfigMixin):
         final_sigmas_type (`str`, defaults to `"zero"`):
             The final `sigma` value for the noise schedule during the sampling process. If `"sigma_min"`, the final
             sigma is the same as the last sigma in the training schedule. If `zero`, the final sigma is set to 0.
+        base_shift (`float`, defaults to 0.5), max_shift (`float`, defaults to 1.15):
+            Log-shift (`mu`) at `base_image_seq_len` and `max_image_seq_len` image tokens, for `use_dynamic_shifting`
+            with an `image_seq_len` (see `resolution_mu`).
+        base_image_seq_len (`int`, defaults to 256), max_image_seq_len (`int`, defaults to 4096):
+            Token counts the two shifts are anchored at.
     """
 
     _compatibles = [e.name for e in KarrasDiffusionSchedulers]
@@ -92,6 +205,10 @@ class FlowUniPCMultistepScheduler(SchedulerMixin, ConfigMixin):
             timestep_spacing: str = "linspace",
             steps_offset: int = 0,
             final_sigmas_type: Optional[str] = "zero",  # "zero", "sigma_min"
+            base_shift: float = 0.5,
+            max_shift: float = 1.15,
+            base_image_seq_len: int = 256,
+            max_image_seq_len: int = 4096,
     ):
 
         if solver_type not in ["bh1", "bh2"]:
@@ -117,14 +234,15 @@ class FlowUniPCMultistepScheduler(SchedulerMixin, ConfigMixin):
         self.sigmas = sigmas
         self.timesteps = sigmas * num_train_timesteps
 
-        self.model_outputs = [None] * solver_order
-        self.timestep_list = [None] * solver_order
+        self._reset_history()
         self.lower_order_nums = 0
         self.disable_corrector = disable_corrector
         self.solver_p = solver_p
         self.last_sample = None
         self._step_index = None
         self._begin_index = None
+        self._tables = None
+        self._device_tables = None
 
         self.sigmas = self.sigmas.to(
             "cpu")  # to avoid too much CPU/GPU communication
@@ -164,6 +282,7 @@ class FlowUniPCMultistepScheduler(SchedulerMixin, ConfigMixin):
         sigmas: Optional[List[float]] = None,
         mu: Optional[Union[float, None]] = None,
         shift: Optional[Union[float, None]] = None,
+        image_seq_len: Optional[int] = None,
     ):
         """
         Sets the discrete timesteps used for the diffusion chain (to be run before inference).
@@ -172,26 +291,17 @@ class FlowUniPCMultistepScheduler(SchedulerMixin, ConfigMixin):
                 Total number of the spacing of the time steps.
             device (`str` or `torch.device`, *optional*):
                 The device to which the timesteps should be moved to. If `None`, the timesteps are not moved.
+            image_seq_len (`int`, *optional*):
+                Number of image tokens being generated; with `use_dynamic_shifting` and no `mu`, the shift follows it.
         """
 
+        if self.config.use_dynamic_shifting and mu is None and image_seq_len is not None:
+            mu = self.resolution_mu(image_seq_len)
         if self.config.use_dynamic_shifting and mu is None:
             raise ValueError(
-                " you have to pass a value for `mu` when `use_dynamic_shifting` is set to be `True`"
+                " you have to pass a value for `mu` or `image_seq_len` when `use_dynamic_shifting` is set to be `True`"
             )
 
-        if sigmas is None:
-            sigmas = np.linspace(self.sigma_max, self.sigma_min,
-                                 num_inference_steps +
-                                 1).copy()[:-1]  # pyright: ignore
-
-        if self.config.use_dynamic_shifting:
-            sigmas = self.time_shift(mu, 1.0, sigmas)  # pyright: ignore
-        else:
-            if shift is None:
-                shift = self.config.shift
-            sigmas = shift * sigmas / (1 +
-                                       (shift - 1) * sigmas)  # pyright: ignore
-
         if self.config.final_sigmas_type == "sigma_min":
             sigma_last = ((1 - self.alphas_cumprod[0]) /
                           self.alphas_cumprod[0])**0.5
@@ -202,6 +312,22 @@ class FlowUniPCMultistepScheduler(SchedulerMixin, ConfigMixin):
                 f"`final_sigmas_type` must be one of 'zero', or 'sigma_min', but got {self.config.final_sigmas_type}"
             )
 
+        if shift is None:
+            shift = self.config.shift
+        if sigmas is None:
+            # the default schedules only depend on these scalars; they are built once and shared across requests
+            sigmas = np.array(_flow_sigmas(
+                num_inference_steps, self.sigma_max, self.sigma_min,
+                None if self.config.use_dynamic_shifting else float(shift),
+                float(mu) if self.config.use_dynamic_shifting else None,
+            ))
+        elif self.config.use_dynamic_shifting:
+            sigmas = self.time_shift(mu, 1.0, np.asarray(sigmas))  # pyright: ignore
+        else:
+            sigmas = np.asarray(sigmas)
+            sigmas = shift * sigmas / (1 +
+                                       (shift - 1) * sigmas)  # pyright: ignore
+
         timesteps = sigmas * self.config.num_train_timesteps
         sigmas = np.concatenate([sigmas, [sigma_last]
                                 ]).astype(np.float32)  # pyright: ignore
@@ -211,10 +337,11 @@ class FlowUniPCMultistepScheduler(SchedulerMixin, ConfigMixin):
             device=device, dtype=torch.int64)
 
         self.num_inference_steps = len(timesteps)
+        self._tables = unipc_tables(
+            tuple(sigmas.tolist()), self.config.solver_order, self.config.solver_type, self.predict_x0)
+        self._device_tables = None
 
-        self.model_outputs = [
-            None,
-        ] * self.config.solver_order
+        self._reset_history()
         self.lower_order_nums = 0
         self.last_sample = None
         if self.solver_p:
@@ -276,6 +403,15 @@ class FlowUniPCMultistepScheduler(SchedulerMixin, ConfigMixin):
     def time_shift(self, mu: float, sigma: float, t: torch.Tensor):
         return math.exp(mu) / (math.exp(mu) + (1 / t - 1)**sigma)
 
+    def resolution_mu(self, image_seq_len: int) -> float:
+        """
+        Log-shift for an image of `image_seq_len` tokens: linear from `base_shift` at `base_image_seq_len` tokens to
+        `max_shift` at `max_image_seq_len`, so larger images spend more steps at high noise.
+        """
+        m = (self.config.max_shift - self.config.base_shift) / (
+            self.config.max_image_seq_len - self.config.base_image_seq_len)
+        return self.config.base_shift + m * (image_seq_len - self.config.base_image_seq_len)
+
     def convert_model_output(
         self,
         model_output: torch.Tensor,
@@ -347,6 +483,68 @@ class FlowUniPCMultistepScheduler(SchedulerMixin, ConfigMixin):
 
             return epsilon
 
+    def _reset_history(self):
+        # ring buffer of the last `solver_order` converted model outputs, float32, allocated on the first step and
+        # reused across steps and schedules of the same shape; `_head` is the slot of the newest output
+        if getattr(self, "_history", None) is not None:
+            self._history.zero_()
+        else:
+            self._history = None
+        self._timestep_ring = [None] * self.config.solver_order
+        self._head = -1
+        self._num_outputs = 0
+
+    def _push_model_output(self, model_output: torch.Tensor, timestep):
+        order = self.config.solver_order
+        shape = (order, *model_output.shape)
+        if self._history is None or self._history.shape != shape or self._history.device != model_output.device:
+            self._history = torch.zeros(shape, dtype=torch.float32, device=model_output.device)
+        self._head = (self._head + 1) % order
+        self._history[self._head].copy_(model_output)
+        self._timestep_ring[self._head] = timestep
+        self._num_outputs = min(self._num_outputs + 1, order)
+
+    def _ordered(self, ring: list) -> list:
+        # oldest first, unfilled slots as None
+        order = self.config.solver_order
+        items = [ring[(self._head - age) % order] if age < self._num_outputs else None for age in range(order)]
+        return items[::-1]
+
+    @property
+    def model_outputs(self) -> List[Optional[torch.Tensor]]:
+        """The last `solver_order` converted model outputs (float32), oldest first; `None` where not yet filled."""
+        if self._history is None:
+            return [None] * self.config.solver_order
+        return self._ordered(list(self._history.unbind(0)))
+
+    @property
+    def timestep_list(self) -> list:
+        return self._ordered(self._timestep_ring)
+
+    def _fused_update(self, coefs: torch.Tensor, x: torch.Tensor, model_t: Optional[torch.Tensor] = None):
+        # x_t = c0 * x - c1 * m0 - sum_k d_k * (m_k - m0) - t * (model_t - m0), regrouped per model output into one
+        # weighted sum over the history ring: weight(m0) = c1 - sum_k d_k - t, weight(m_k) = d_k
+        order = self.config.solver_order
+        d = coefs[2:order + 1]
+        m0_weight = coefs[1] - d.sum()
+        if model_t is not None:
+            m0_weight = m0_weight - coefs[-1]
+        by_age = torch.cat([m0_weight[None], d])  # newest first
+        # slot i holds the output of age (head - i) mod order
+        weights = torch.roll(by_age.flip(0), self._head + 1)
+        x_t = torch.tensordot(weights, self._history, dims=1)
+        x_t = torch.sub(x.to(torch.float32) * coefs[0], x_t)
+        if model_t is not None:
+            x_t = x_t.sub_(model_t.to(torch.float32) * coefs[-1])
+        return x_t.to(x.dtype)
+
+    def _coefficient_tables(self, device: torch.device) -> UniPCTables:
+        # uploaded once per schedule, so a step only indexes device tensors
+        if self._device_tables is None or self._device_tables.predictor.device != device:
+            self._device_tables = UniPCTables(
+                predictor=self._tables.predictor.to(device), corrector=self._tables.corrector.to(device))
+        return self._device_tables
+
     def multistep_uni_p_bh_update(
         self,
         model_output: torch.Tensor,
@@ -392,96 +590,15 @@ class FlowUniPCMultistepScheduler(SchedulerMixin, ConfigMixin):
                 "1.0.0",
                 "Passing `prev_timestep` is deprecated and has no effect as model output conversion is now handled via an internal counter `self.step_index`",
             )
-        model_output_list = self.model_outputs
-
-        s0 = self.timestep_list[-1]
-        m0 = model_output_list[-1]
         x = sample
 
         if self.solver_p:
+            s0 = self._timestep_ring[self._head]
             x_t = self.solver_p.step(model_output, s0, x).prev_sample
             return x_t
 
-        sigma_t, sigma_s0 = self.sigmas[self.step_index + 1], self.sigmas[
-            self.step_index]  # pyright: ignore
-        alpha_t, sigma_t = self._sigma_to_alpha_sigma_t(sigma_t)
-        alpha_s0, sigma_s0 = self._sigma_to_alpha_sigma_t(sigma_s0)
-
-        lambda_t = torch.log(alpha_t) - torch.log(sigma_t)
-        lambda_s0 = torch.log(alpha_s0) - torch.log(sigma_s0)
-
-        h = lambda_t - lambda_s0
-        device = sample.device
-
-        rks = []
-        D1s = []
-        for i in range(1, order):
-            si = self.step_index - i  # pyright: ignore
-            mi = model_output_list[-(i + 1)]
-            alpha_si, sigma_si = self._sigma_to_alpha_sigma_t(self.sigmas[si])
-            lambda_si = torch.log(alpha_si) - torch.log(sigma_si)
-            rk = (lambda_si - lambda_s0) / h
-            rks.append(rk)
-            D1s.append((mi - m0) / rk)  # pyright: ignore
-
-        rks.append(1.0)
-        rks = torch.tensor(rks, device=device)
-
-        R = []
-        b = []
-
-        hh = -h if self.predict_x0 else h
-        h_phi_1 = torch.expm1(hh)  # h\phi_1(h) = e^h - 1
-        h_phi_k = h_phi_1 / hh - 1
-
-        factorial_i = 1
-
-        if self.config.solver_type == "bh1":
-            B_h = hh
-        elif self.config.solver_type == "bh2":
-            B_h = torch.expm1(hh)
-        else:
-            raise NotImplementedError()
-
-        for i in range(1, order + 1):
-            R.append(torch.pow(rks, i - 1))
-            b.append(h_phi_k * factorial_i / B_h)
-            factorial_i *= i + 1
-            h_phi_k = h_phi_k / hh - 1 / factorial_i
-
-        R = torch.stack(R)
-        b = torch.tensor(b, device=device)
-
-        if len(D1s) > 0:
-            D1s = torch.stack(D1s, dim=1)  # (B, K)
-            # for order 2, we use a simplified version
-            if order == 2:
-                rhos_p = torch.tensor([0.5], dtype=x.dtype, device=device)
-            else:
-                rhos_p = torch.linalg.solve(R[:-1, :-1],
-                                            b[:-1]).to(device).to(x.dtype)
-        else:
-            D1s = None
-
-        if self.predict_x0:
-            x_t_ = sigma_t / sigma_s0 * x - alpha_t * h_phi_1 * m0
-            if D1s is not None:
-                pred_res = torch.einsum("k,bkc...->bc...", rhos_p,
-                                        D1s)  # pyright: ignore
-            else:
-                pred_res = 0
-            x_t = x_t_ - alpha_t * B_h * pred_res
-        else:
-            x_t_ = alpha_t / alpha_s0 * x - sigma_t * h_phi_1 * m0
-            if D1s is not None:
-                pred_res = torch.einsum("k,bkc...->bc...", rhos_p,
-                                        D1s)  # pyright: ignore
-            else:
-                pred_res = 0
-            x_t = x_t_ - sigma_t * B_h * pred_res
-
-        x_t = x_t.to(x.dtype)
-        return x_t
+        coefs = self._coefficient_tables(x.device).predictor[self.step_index, order - 1]
+        return self._fused_update(coefs, x)
 
     def multistep_uni_c_bh_update(
         self,
@@ -538,92 +655,11 @@ class FlowUniPCMultistepScheduler(SchedulerMixin, ConfigMixin):
                 "Passing `this_timestep` is deprecated and has no effect as model output conversion is now handled via an internal counter `self.step_index`",
             )
 
-        model_output_list = self.model_outputs
-
-        m0 = model_output_list[-1]
         x = last_sample
-        x_t = this_sample
         model_t = this_model_output
 
-        sigma_t, sigma_s0 = self.sigmas[self.step_index], self.sigmas[
-            self.step_index - 1]  # pyright: ignore
-        alpha_t, sigma_t = self._sigma_to_alpha_sigma_t(sigma_t)
-        alpha_s0, sigma_s0 = self._sigma_to_alpha_sigma_t(sigma_s0)
-
-        lambda_t = torch.log(alpha_t) - torch.log(sigma_t)
-        lambda_s0 = torch.log(alpha_s0) - torch.log(sigma_s0)
-
-        h = lambda_t - lambda_s0
-        device = this_sample.device
-
-        rks = []
-        D1s = []
-        for i in range(1, order):
-            si = self.step_index - (i + 1)  # pyright: ignore
-            mi = model_output_list[-(i + 1)]
-            alpha_si, sigma_si = self._sigma_to_alpha_sigma_t(self.sigmas[si])
-            lambda_si = torch.log(alpha_si) - torch.log(sigma_si)
-            rk = (lambda_si - lambda_s0) / h
-            rks.append(rk)
-            D1s.append((mi - m0) / rk)  # pyright: ignore
-
-        rks.append(1.0)
-        rks = torch.tensor(rks, device=device)
-
-        R = []
-        b = []
-
-        hh = -h if self.predict_x0 else h
-        h_phi_1 = torch.expm1(hh)  # h\phi_1(h) = e^h - 1
-        h_phi_k = h_phi_1 / hh - 1
-
-        factorial_i = 1
-
-        if self.config.solver_type == "bh1":
-            B_h = hh
-        elif self.config.solver_type == "bh2":
-            B_h = torch.expm1(hh)
-        else:
-            raise NotImplementedError()
-
-        for i in range(1, order + 1):
-            R.append(torch.pow(rks, i - 1))
-            b.append(h_phi_k * factorial_i / B_h)
-            factorial_i *= i + 1
-            h_phi_k = h_phi_k / hh - 1 / factorial_i
-
-        R = torch.stack(R)
-        b = torch.tensor(b, device=device)
-
-        if len(D1s) > 0:
-            D1s = torch.stack(D1s, dim=1)
-        else:
-            D1s = None
-
-        # for order 1, we use a simplified version
-        if order == 1:
-            rhos_c = torch.tensor([0.5], dtype=x.dtype, device=device)
-        else:
-            rhos_c = torch.linalg.solve(R, b).to(device).to(x.dtype)
-
-        if self.predict_x0:
-            x_t_ = sigma_t / sigma_s0 * x - alpha_t * h_phi_1 * m0
-            if D1s is not None:
-                corr_res = torch.einsum("k,bkc...->bc...", rhos_c[:-1], D1s)
-            else:
-                corr_res = 0
-            D1_t = model_t - m0
-            x_t = x_t_ - alpha_t * B_h * (corr_res + rhos_c[-1] * D1_t)
-        else:
-            x_t_ = alpha_t / alpha_s0 * x - sigma_t * h_phi_1 * m0
-            if D1s is not None:
-                corr_res = torch.einsum("k,bkc...->bc...", rhos_c[:-1], D1s)
-            else:
-                corr_res = 0
-            D1_t = model_t - m0
-            x_t = x_t_ - sigma_t * B_h * (corr_res + rhos_c[-1] * D1_t)
-        x_t = x_t.to(x.dtype)
-        return x_t
+        coefs = self._coefficient_tables(x.device).corrector[self.step_index - 1, order - 1]
+        return self._fused_update(coefs, x, model_t=model_t)
 
     def index_for_timestep(self, timestep, schedule_timesteps=None):
         if schedule_timesteps is None:
@@ -702,12 +738,7 @@ class FlowUniPCMultistepScheduler(SchedulerMixin, ConfigMixin):
                 order=self.this_order,
             )
 
-        for i in range(self.config.solver_order - 1):
-            self.model_outputs[i] = self.model_outputs[i + 1]
-            self.timestep_list[i] = self.timestep_list[i + 1]
-
-        self.model_outputs[-1] = model_output_convert
-        self.timestep_list[-1] = timestep  # pyright: ignore
+        self._push_model_output(model_output_convert, timestep)
 
         if self.config.lower_order_final:
             this_order = min(self.config.solver_order,
@@ -0,0 +1,187 @@
+"""
+Named schedulers: the scheduler classes, presets of them with a fixed configuration, and tuned sigma schedules.
+
+A tuned schedule is a small JSON file, e.g. a hand-tuned or searched few-step schedule:
+
+    {
+        "name": "fast-8",
+        "scheduler": "FlashFlowMatchEulerDiscreteScheduler",
+        "sigmas": [0.999, 0.97, 0.92, 0.84, 0.72, 0.55, 0.34, 0.12],
+        "shift": 1.0,
+        "description": "8 steps for the fast model"
+    }
+
+`scheduler` is a class or preset name. The `sigmas` go through the scheduler's `set_timesteps(sigmas=...)` (the
+pipeline's `sigmas` argument), which shifts them by `shift` like its own schedule; store the final sigmas with
+`"shift": 1.0`, or leave `shift` out to use the request's shift. The number of steps is `len(sigmas)`. Sigmas lie
+strictly between 0 and 1: shifting leaves 1 unchanged, and at sigma 1 the log-SNR the multistep solvers (DPM-Solver++,
+DEIS, UniPC) work in is -inf.
+"""
+
+import json
+import math
+import os
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from .flash_flow_match import FlashFlowMatchEulerDiscreteScheduler
+from .flow_heun import FlowHeunDiscreteScheduler
+from .fm_solvers_dpm import FlowDPMSolverMultistepScheduler
+from .fm_solvers_unipc import FlowUniPCMultistepScheduler
+
+# Token count of the native 1024 x 1024 area every request is rescaled to
+NATIVE_IMAGE_SEQ_LEN = 4096
+
+# Largest sigma a tuned schedule may start at, see the module docstring
+MAX_SCHEDULE_SIGMA = 0.9999
+
+# Scheduler classes by name
+SCHEDULERS = {
+    "FlashFlowMatchEulerDiscreteScheduler": FlashFlowMatchEulerDiscreteScheduler,
+    "FlowUniPCMultistepScheduler": FlowUniPCMultistepScheduler,
+    "FlowDPMSolverMultistepScheduler": FlowDPMSolverMultistepScheduler,
+    "FlowHeunDiscreteScheduler": FlowHeunDiscreteScheduler,
+}
+
+# name -> (scheduler class name, config overrides)
+PRESETS = {
+    "dpm++2m": ("FlowDPMSolverMultistepScheduler", {"solver_order": 2}),
+    "dpm++3m": ("FlowDPMSolverMultistepScheduler", {"solver_order": 3}),
+    "deis": ("FlowDPMSolverMultistepScheduler", {"solver_order": 3, "algorithm_type": "deis"}),
+    "unipc-bh1": ("FlowUniPCMultistepScheduler", {"solver_type": "bh1"}),
+    "heun": ("FlowHeunDiscreteScheduler", {"solver_type": "heun"}),
+    "midpoint": ("FlowHeunDiscreteScheduler", {"solver_type": "midpoint"}),
+}
+
+
+@dataclass
+class SigmaSchedule:
+    """A tuned sigma schedule for the scheduler or preset `scheduler`, see the module docstring."""
+
+    name: str
+    scheduler: str
+    sigmas: List[float]
+    shift: Optional[float] = None
+    config: Dict = field(default_factory=dict)
+    description: str = ""
+
+    def __post_init__(self):
+        if self.scheduler not in SCHEDULERS and self.scheduler not in PRESETS:
+            raise ValueError(f"Schedule {self.name!r}: unknown scheduler {self.scheduler!r}")
+        self.sigmas = [float(sigma) for sigma in self.sigmas]
+        if not self.sigmas:
+            raise ValueError(f"Schedule {self.name!r} has no sigmas")
+        if any(not 0 < sigma < 1 for sigma in self.sigmas):
+            raise ValueError(f"Schedule {self.name!r}: sigmas must be in (0, 1), got {self.sigmas}")
+        if any(a <= b for a, b in zip(self.sigmas, self.sigmas[1:])):
+            raise ValueError(f"Schedule {self.name!r}: sigmas must be strictly decreasing")
+
+    @property
+    def num_inference_steps(self) -> int:
+        return len(self.sigmas)
+
+    @classmethod
+    def from_scheduler(cls, name: str, scheduler_name: str, scheduler, description: str = ""):
+        """
+        Captures the schedule `scheduler` (an instance of `scheduler_name`) was last set to, e.g. after tuning its
+        timesteps, as final sigmas (`shift` 1). A leading sigma of 1 is captured as `MAX_SCHEDULE_SIGMA`. Two-stage
+        schedulers interleave their stages in `sigmas` and can't be captured this way.
+        """
+        if scheduler.order != 1:
+            raise ValueError(f"Can't capture the schedule of {type(scheduler).__name__} (order {scheduler.order})")
+        sigmas = [min(sigma, MAX_SCHEDULE_SIGMA) for sigma in scheduler.sigmas.tolist() if sigma > 0]
+        return cls(name=name, scheduler=scheduler_name, sigmas=sigmas, shift=1.0, description=description)
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(asdict(self), f, indent=2)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        data.setdefault("name", os.path.splitext(os.path.basename(path))[0])
+        return cls(**data)
+
+
+# Tuned schedules by name, filled by `register_schedule` / `load_schedules`
+SCHEDULES: Dict[str, SigmaSchedule] = {}
+
+
+def register_schedule(schedule: SigmaSchedule):
+    if schedule.name in SCHEDULERS or schedule.name in PRESETS:
+        raise ValueError(f"Schedule name {schedule.name!r} is taken by a scheduler")
+    SCHEDULES[schedule.name] = schedule
+
+
+def load_schedules(paths: List[str]) -> List[str]:
+    """Registers the schedules in `paths`, JSON files or directories of them. Returns their names."""
+    names = []
+    for path in paths:
+        files = [path]
+        if os.path.isdir(path):
+            files = [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(".json")]
+        for file in files:
+            schedule = SigmaSchedule.load(file)
+            register_schedule(schedule)
+            names.append(schedule.name)
+    return names
+
+
+def scheduler_names() -> List[str]:
+    """Every name `make_scheduler` accepts: classes, presets and registered schedules."""
+    return list(SCHEDULERS) + list(PRESETS) + list(SCHEDULES)
+
+
+def resolve(name: str) -> Tuple[type, dict, Optional[SigmaSchedule]]:
+    """The class, config overrides and tuned schedule (if any) behind a scheduler `name`."""
+    schedule = SCHEDULES.get(name)
+    if schedule is not None:
+        scheduler_class, config, _ = resolve(schedule.scheduler)
+        return scheduler_class, {**config, **schedule.config}, schedule
+    if name in PRESETS:
+        class_name, config = PRESETS[name]
+        return SCHEDULERS[class_name], dict(config), None
+    if name in SCHEDULERS:
+        return SCHEDULERS[name], {}, None
+    raise ValueError(f"Invalid scheduler: {name}")
+
+
+def schedule_sigmas(name: str) -> Optional[List[float]]:
+    """The tuned sigmas of scheduler `name`, for the pipeline's `sigmas`, or `None` for its own schedule."""
+    schedule = SCHEDULES.get(name)
+    return None if schedule is None else list(schedule.sigmas)
+
+
+def model_evaluations(name: str, num_inference_steps: int) -> int:
+    """
+    Transformer evaluations scheduler `name` spends on `num_inference_steps` steps. Second-order schedulers (`heun`,
+    `midpoint`) evaluate twice per step but once for the last, so a step count costs almost twice the time it does
+    with the other schedulers.
+    """
+    scheduler_class = resolve(name)[0]
+    return scheduler_class.order * num_inference_steps - (scheduler_class.order - 1)
+
+
+def make_scheduler(name: str, shift: float, dynamic_shift: bool = False):
+    """
+    Scheduler `name` with a fixed `shift` (a tuned schedule's own `shift` takes precedence). With `dynamic_shift` the
+    shift follows the image's token count instead: it is `shift` at `NATIVE_IMAGE_SEQ_LEN` tokens and falls with the
+    slope of `calculate_shift` for fewer tokens.
+    """
+    scheduler_class, config, schedule = resolve(name)
+    if schedule is not None and schedule.shift is not None:
+        shift = schedule.shift
+    if not dynamic_shift:
+        return scheduler_class(num_train_timesteps=1000, shift=shift, use_dynamic_shifting=False, **config)
+    max_shift = math.log(shift)
+    return scheduler_class(
+        num_train_timesteps=1000,
+        shift=shift,
+        use_dynamic_shifting=True,
+        base_shift=max_shift - (1.15 - 0.5),
+        max_shift=max_shift,
+        base_image_seq_len=256,
+        max_image_seq_len=NATIVE_IMAGE_SEQ_LEN,
+        **config,
+    )
@@ -0,0 +1,266 @@
+"""
+Per-stage latency spans for the pipeline and the serving stack.
+
+Stages are wrapped in `with span("name", **attributes):`. Nothing is recorded until a `Tracer` is installed with
+`set_tracer`; until then `span` returns a shared no-op context manager, so the instrumentation costs a function call
+per stage. An installed tracer keeps the most recent `max_spans` spans and exports them as
+
+    json    - a flat list of spans with durations in milliseconds
+    chrome  - Chrome trace events, for chrome://tracing or https://ui.perfetto.dev
+    otlp    - OpenTelemetry OTLP/JSON (`resourceSpans`), e.g. to POST to a collector's `/v1/traces`
+
+Spans nest per thread: a span opened inside another becomes its child and shares its trace. CUDA kernels run
+asynchronously, so without `sync_cuda` a span measures the time to launch its work; with it, every span boundary
+synchronizes the device and spans measure the work itself, at the cost of the overlap between host and device.
+"""
+
+import json
+import os
+import secrets
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+import torch
+
+# Export formats of `Tracer.export`
+TRACE_FORMATS = ["json", "chrome", "otlp"]
+
+
+class _NullSpan:
+    """What `span` returns while tracing is off."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """One timed stage. Use it as a context manager; `set` adds attributes while it is open."""
+
+    __slots__ = ("tracer", "name", "attributes", "trace_id", "span_id", "parent_id", "thread_id", "thread_name",
+                 "start_ns", "end_ns")
+
+    def __init__(self, tracer: "Tracer", name: str, attributes: dict):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.trace_id = None
+        self.span_id = None
+        self.parent_id = None
+        self.thread_id = None
+        self.thread_name = None
+        self.start_ns = None
+        self.end_ns = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.tracer._open(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        self.tracer._close(self)
+        return False
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e6
+
+
+class Tracer:
+    """
+    Collects the spans of every thread.
+
+    Args:
+        max_spans (`int`, defaults to 100000):
+            Finished spans kept; older ones are dropped first, so a long-running server stays bounded.
+        sync_cuda (`bool`, defaults to `False`):
+            Synchronize CUDA at every span boundary so spans measure device work (see the module docstring).
+        service_name (`str`, defaults to `"hdi1"`):
+            `service.name` of the OTLP export.
+    """
+
+    def __init__(self, max_spans: int = 100000, sync_cuda: bool = False, service_name: str = "hdi1"):
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.service_name = service_name
+        self._spans = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # perf_counter_ns is monotonic but has no epoch; exports are in wall-clock time
+        self._epoch_offset_ns = time.time_ns() - time.perf_counter_ns()
+
+    def span(self, name: str, **attributes) -> Span:
+        return Span(self, name, attributes)
+
+    def _stack(self) -> list:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _open(self, span: Span):
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        span.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        span.parent_id = parent.span_id if parent else None
+        span.span_id = secrets.token_hex(8)
+        current = threading.current_thread()
+        span.thread_id, span.thread_name = current.ident, current.name
+        stack.append(span)
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        span.start_ns = time.perf_counter_ns()
+
+    def _close(self, span: Span):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        span.end_ns = time.perf_counter_ns()
+        stack = self._stack()
+        if stack and stack[-1] is span:
+            stack.pop()
+        with self._lock:
+            self._spans.append(span)
+
+    @property
+    def spans(self) -> List[Span]:
+        """Finished spans, in the order they ended."""
+        with self._lock:
+            return list(self._spans)
+
+    def clear(self):
+        with self._lock:
+            self._spans.clear()
+
+    def summary(self) -> Dict[str, dict]:
+        """Count, total and mean milliseconds per span name, the largest total first."""
+        totals = {}
+        for span in self.spans:
+            entry = totals.setdefault(span.name, {"count": 0, "total_ms": 0.0})
+            entry["count"] += 1
+            entry["total_ms"] += span.duration_ms
+        for entry in totals.values():
+            entry["mean_ms"] = entry["total_ms"] / entry["count"]
+        return dict(sorted(totals.items(), key=lambda item: -item[1]["total_ms"]))
+
+    def to_json(self) -> dict:
+        return {"spans": [
+            {
+                "name": span.name,
+                "trace_id": span.trace_id,
+                "span_id": span.span_id,
+                "parent_id": span.parent_id,
+                "start_unix_ns": span.start_ns + self._epoch_offset_ns,
+                "duration_ms": span.duration_ms,
+                "thread": span.thread_name,
+                "attributes": _jsonable(span.attributes),
+            }
+            for span in self.spans
+        ]}
+
+    def to_chrome_trace(self) -> dict:
+        spans = self.spans
+        pid = os.getpid()
+        events = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+            for tid, name in {span.thread_id: span.thread_name for span in spans}.items()
+        ]
+        events += [
+            {
+                "name": span.name,
+                "cat": "hdi1",
+                "ph": "X",
+                "ts": (span.start_ns + self._epoch_offset_ns) / 1e3,
+                "dur": (span.end_ns - span.start_ns) / 1e3,
+                "pid": pid,
+                "tid": span.thread_id,
+                "args": _jsonable(span.attributes),
+            }
+            for span in spans
+        ]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def to_otlp(self) -> dict:
+        spans = [
+            {
+                "traceId": span.trace_id,
+                "spanId": span.span_id,
+                **({"parentSpanId": span.parent_id} if span.parent_id else {}),
+                "name": span.name,
+                "kind": 1,  # SPAN_KIND_INTERNAL
+                "startTimeUnixNano": str(span.start_ns + self._epoch_offset_ns),
+                "endTimeUnixNano": str(span.end_ns + self._epoch_offset_ns),
+                "attributes": _otlp_attributes({**span.attributes, "thread.name": span.thread_name}),
+            }
+            for span in self.spans
+        ]
+        return {"resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": self.service_name})},
+            "scopeSpans": [{"scope": {"name": "hdi1.tracing"}, "spans": spans}],
+        }]}
+
+    def export(self, format: str = "json") -> dict:
+        if format == "json":
+            return self.to_json()
+        if format == "chrome":
+            return self.to_chrome_trace()
+        if format == "otlp":
+            return self.to_otlp()
+        raise ValueError(f"Unknown trace format: {format}")
+
+    def save(self, path: str, format: str = "json"):
+        with open(path, "w") as f:
+            json.dump(self.export(format), f, default=str)
+
+
+def _jsonable(attributes: dict) -> dict:
+    return {key: value if isinstance(value, (bool, int, float, str)) or value is None else str(value)
+            for key, value in attributes.items()}
+
+
+def _otlp_attributes(attributes: dict) -> list:
+    def value(v):
+        if isinstance(v, bool):
+            return {"boolValue": v}
+        if isinstance(v, int):
+            return {"intValue": str(v)}
+        if isinstance(v, float):
+            return {"doubleValue": v}
+        return {"stringValue": str(v)}
+    return [{"key": key, "value": value(v)} for key, v in attributes.items() if v is not None]
+
+
+_tracer: Optional[Tracer] = None
+
+
+def set_tracer(tracer: Optional[Tracer]) -> Optional[Tracer]:
+    """Installs `tracer` process-wide (`None` turns tracing off). Returns the previous one."""
+    global _tracer
+    previous, _tracer = _tracer, tracer
+    return previous
+
+
+def get_tracer() -> Optional[Tracer]:
+    return _tracer
+
+
+def span(name: str, **attributes):
+    """A span of the installed tracer, or a no-op one while tracing is off."""
+    tracer = _tracer
+    if tracer is None:
+        return _NULL_SPAN
+    return Span(tracer, name, attributes)
@@ -0,0 +1,195 @@
+import queue
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Optional, Union
+
+import torch
+from diffusers.image_processor import VaeImageProcessor
+
+try:
+    from .tracing import span
+except ImportError:
+    # Fallback for direct execution
+    from hdi1.tracing import span
+
+VAE_DECODE_MODES = ["auto", "full", "sliced", "tiled"]
+
+# Peak number of live decoder activations per output pixel. The FLUX VAE decoder runs 128/256-channel resnets at full
+# resolution; this is a conservative upper bound for them, measured in elements of the VAE dtype.
+DECODE_ELEMENTS_PER_PIXEL = 1024
+
+# Fraction of the free device memory the decode may plan to use
+DECODE_MEMORY_HEADROOM = 0.8
+
+# Candidate tile sizes in pixels, largest first. Tiles overlap by the VAE's `tile_overlap_factor` (25%) and the seams
+# are blended linearly.
+DECODE_TILE_SIZES = [1024, 768, 512, 384, 256]
+
+
+@dataclass
+class DecodePlan:
+    mode: str
+    tile_size: Optional[int] = None
+    estimated_bytes: int = 0
+
+
+def free_device_memory(device: Union[str, torch.device]) -> Optional[int]:
+    """Free memory on `device` in bytes, counting memory cached by the allocator but not in use. `None` off CUDA."""
+    device = torch.device(device)
+    if device.type != "cuda":
+        return None
+    free, _ = torch.cuda.mem_get_info(device)
+    return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+
+
+def plan_vae_decode(
+    latent_shape: tuple,
+    vae_scale_factor: int,
+    dtype: torch.dtype,
+    free_bytes: Optional[int],
+) -> DecodePlan:
+    """
+    Picks the cheapest decode that fits in `free_bytes`: the whole batch at once, one image at a time (sliced), or one
+    image at a time in overlapping tiles of the largest size that fits. Without a memory limit (`None`, e.g. on the
+    CPU) the batch is decoded at once.
+    """
+    batch_size, _, height, width = latent_shape
+    height, width = height * vae_scale_factor, width * vae_scale_factor
+    bytes_per_pixel = DECODE_ELEMENTS_PER_PIXEL * torch.empty((), dtype=dtype).element_size()
+    per_image = height * width * bytes_per_pixel
+
+    if free_bytes is None or batch_size * per_image <= free_bytes * DECODE_MEMORY_HEADROOM:
+        return DecodePlan("full", estimated_bytes=batch_size * per_image)
+    budget = free_bytes * DECODE_MEMORY_HEADROOM
+    if per_image <= budget:
+        return DecodePlan("sliced", estimated_bytes=per_image)
+    for tile_size in DECODE_TILE_SIZES:
+        if tile_size < max(height, width) and tile_size * tile_size * bytes_per_pixel <= budget:
+            return DecodePlan("tiled", tile_size, tile_size * tile_size * bytes_per_pixel)
+    tile_size = DECODE_TILE_SIZES[-1]
+    return DecodePlan("tiled", tile_size, tile_size * tile_size * bytes_per_pixel)
+
+
+@contextmanager
+def vae_decode_plan(vae, plan: DecodePlan, vae_scale_factor: int):
+    """Temporarily configures the diffusers `AutoencoderKL` slicing/tiling switches for `plan`."""
+    saved = (vae.use_slicing, vae.use_tiling, vae.tile_sample_min_size, vae.tile_latent_min_size)
+    vae.use_slicing = plan.mode in ("sliced", "tiled")
+    vae.use_tiling = plan.mode == "tiled"
+    if plan.tile_size is not None:
+        vae.tile_sample_min_size = plan.tile_size
+        vae.tile_latent_min_size = plan.tile_size // vae_scale_factor
+    try:
+        yield
+    finally:
+        vae.use_slicing, vae.use_tiling, vae.tile_sample_min_size, vae.tile_latent_min_size = saved
+
+
+def vae_decode(vae, latents: torch.Tensor, mode: str = "auto", vae_scale_factor: int = 8, tile_size: int = 512):
+    """
+    Decodes (already unscaled) `latents` with `vae`. `mode="auto"` plans the decode from the batch size, resolution and
+    the memory that is free right now; `"full"`, `"sliced"` and `"tiled"` force a strategy.
+    """
+    if mode not in VAE_DECODE_MODES:
+        raise ValueError(f"Invalid VAE decode mode: {mode}, expected one of {VAE_DECODE_MODES}")
+    if mode == "auto":
+        plan = plan_vae_decode(latents.shape, vae_scale_factor, vae.dtype, free_device_memory(latents.device))
+        if plan.mode != "full":
+            print(f"🧩 VAE decode: {plan.mode}" + (f" ({plan.tile_size}px tiles)" if plan.tile_size else ""))
+    else:
+        plan = DecodePlan(mode, tile_size if mode == "tiled" else None)
+
+    with vae_decode_plan(vae, plan, vae_scale_factor):
+        return vae.decode(latents, return_dict=False)[0]
+
+
+def decode_latents_with_vae(
+    vae,
+    latents: torch.Tensor,
+    mode: str = "auto",
+    output_type: str = "pil",
+    image_processor: Optional[VaeImageProcessor] = None,
+):
+    """
+    Decodes denoised model-space latents (as returned with `output_type="latent"`) with a bare `AutoencoderKL`, so the
+    decode stage does not need the transformer or the text encoders.
+    """
+    vae_scale_factor = 2 ** (len(vae.config.block_out_channels) - 1)
+    if image_processor is None:
+        image_processor = VaeImageProcessor(vae_scale_factor=vae_scale_factor * 2)
+    latents = (latents / vae.config.scaling_factor) + vae.config.shift_factor
+    with span("vae_decode", batch_size=latents.shape[0], mode=mode):
+        image = vae_decode(vae, latents, mode=mode, vae_scale_factor=vae_scale_factor)
+    with span("postprocess", output_type=output_type):
+        return image_processor.postprocess(image, output_type=output_type)
+
+
+def vae_under_model_offload(vae) -> bool:
+    # accelerate's model offload hook moves the previously used model off the GPU when the VAE runs, which must not
+    # happen while another thread is denoising
+    return type(getattr(vae, "_hf_hook", None)).__name__ == "CpuOffload"
+
+
+class PipelinedDecoder:
+    """
+    Decodes latents on a background thread so the caller can start denoising the next batch right away.
+
+    On CUDA the decode runs on its own stream, ordered after the kernels that produced the latents, so the VAE decode
+    of batch N overlaps with the transformer steps of batch N+1.
+
+    Args:
+        pipe (`HiDreamImagePipeline`):
+            Pipeline whose `decode_latents` is used.
+        output_type (`str`, defaults to `"pil"`):
+            Output type passed to `decode_latents`.
+    """
+
+    def __init__(self, pipe, output_type: str = "pil"):
+        self.pipe = pipe
+        self.output_type = output_type
+        self._queue = queue.Queue()
+        self._stream = None
+        self._thread = threading.Thread(target=self._loop, name="hdi1-vae-decoder", daemon=True)
+        self._thread.start()
+
+    def submit(self, latents: torch.Tensor) -> Future:
+        """Queues `latents` for decoding. The future resolves to the decoded images."""
+        event = None
+        if latents.is_cuda:
+            event = torch.cuda.Event()
+            event.record(torch.cuda.current_stream(latents.device))
+        future = Future()
+        self._queue.put((latents, event, future))
+        return future
+
+    def _decode(self, latents: torch.Tensor, event):
+        if event is None:
+            return self.pipe.decode_latents(latents, output_type=self.output_type)
+        if self._stream is None:
+            self._stream = torch.cuda.Stream(latents.device)
+        with torch.cuda.stream(self._stream):
+            self._stream.wait_event(event)
+            # the latents were allocated on the producer's stream; don't let the allocator reuse them early
+            latents.record_stream(self._stream)
+            return self.pipe.decode_latents(latents, output_type=self.output_type)
+
+    def _loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            latents, event, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                # inference mode is thread-local
+                with torch.inference_mode():
+                    future.set_result(self._decode(latents, event))
+            except Exception as e:
+                future.set_exception(e)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
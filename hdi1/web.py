@@ -3,8 +3,11 @@ import gradio as gr
 import logging
 import os
 import tempfile
-import glob
 import sys
+import argparse
+import queue
+import uuid
+from concurrent.futures import CancelledError
 from datetime import datetime
 from PIL import Image
 
@@ -17,9 +20,25 @@ if __name__ == "__main__":
 # Handle imports for both direct execution and module import
 try:
     from .nf4 import *
+    from .batching import MicroBatchScheduler
+    from .continuous import ContinuousBatchScheduler, ContinuousPipelineEngine
+    from .api import start_api_server
+    from .cancellation import GenerationCancelled
+    from .vae_decode import VAE_DECODE_MODES
+    from .image_encoder import DEFAULT_ENCODE_OPTIONS, ImageEncoderPool
+    from .output_files import OutputFileManager
+    from .schedulers.registry import load_schedules, model_evaluations, scheduler_names
 except ImportError:
     # Fallback for direct execution
     from hdi1.nf4 import *
+    from hdi1.batching import MicroBatchScheduler
+    from hdi1.continuous import ContinuousBatchScheduler, ContinuousPipelineEngine
+    from hdi1.api import start_api_server
+    from hdi1.cancellation import GenerationCancelled
+    from hdi1.vae_decode import VAE_DECODE_MODES
+    from hdi1.image_encoder import DEFAULT_ENCODE_OPTIONS, ImageEncoderPool
+    from hdi1.output_files import OutputFileManager
+    from hdi1.schedulers.registry import load_schedules, model_evaluations, scheduler_names
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -740,15 +759,29 @@ RESOLUTION_OPTIONS = [
     "832 × 1248 (Portrait)"
 ]
 
-# Scheduler options (flow-matching only)
-SCHEDULER_OPTIONS = [
-    "FlashFlowMatchEulerDiscreteScheduler",
-    "FlowUniPCMultistepScheduler"
-]
+# Scheduler options (flow-matching only): the scheduler classes followed by their presets, e.g. dpm++3m, deis, midpoint
+SCHEDULER_OPTIONS = scheduler_names()
 
 # Image format options
 IMAGE_FORMAT_OPTIONS = ["PNG", "JPEG", "WEBP"]
 
+# Request batching: requests with the same model, scheduler, resolution, steps, guidance and shift
+# that arrive within BATCH_WAIT_SECONDS of each other run as one pipeline call
+MAX_BATCH_SIZE = 4
+BATCH_WAIT_SECONDS = 0.1
+MAX_CONCURRENT_REQUESTS = 16
+
+# Live previews: how often the denoised latents are projected to RGB, and how often the UI polls for them
+PREVIEW_EVERY_N_STEPS = 1
+PREVIEW_POLL_SECONDS = 0.1
+
+# Images are encoded once per request on a background pool; the saved copy and the download copy share the bytes
+IMAGE_ENCODER_THREADS = 2
+
+# Download copies in the temp directory are tracked in memory and expired in the background by age and count
+TEMP_FILE_MAX_AGE_SECONDS = 3600
+TEMP_FILE_MAX_COUNT = 64
+
 # Parse resolution string to get height and width
 def parse_resolution(resolution_str):
     try:
@@ -756,41 +789,14 @@ def parse_resolution(resolution_str):
     except (ValueError, IndexError) as e:
         raise ValueError("Invalid resolution format") from e
 
-def clean_previous_temp_files():
-    """Delete temporary files from previous generations matching hdi1_* pattern and log Gradio temp files."""
-    temp_dir = tempfile.gettempdir()
-    patterns = [os.path.join(temp_dir, f"hdi1_*.{ext}") for ext in ["png", "jpeg", "webp"]]
-    deleted_files = []
-    
-    # Clean hdi1_* files
-    for pattern in patterns:
-        for temp_file in glob.glob(pattern):
-            try:
-                os.remove(temp_file)
-                deleted_files.append(temp_file)
-                logger.info(f"Deleted temporary file: {temp_file}")
-            except OSError as e:
-                logger.warning(f"Failed to delete temporary file {temp_file}: {str(e)}")
-    
-    # Log Gradio temp files (for monitoring)
-    gradio_temp_dir = os.path.join(temp_dir, "gradio")
-    if os.path.exists(gradio_temp_dir):
-        for root, _, files in os.walk(gradio_temp_dir):
-            for file in files:
-                if file.endswith((".png", ".jpeg", ".webp")):
-                    gradio_file = os.path.join(root, file)
-                    logger.info(f"Found Gradio temporary file: {gradio_file}")
-    
-    return deleted_files
-
 def clean_all_temp_files():
     """Manually clean hdi1_* and Gradio temporary files, with user confirmation."""
     status_message = "Starting temporary file cleanup..."
     logger.info(status_message)
     
     try:
-        # Clean hdi1_* files
-        deleted_files = clean_previous_temp_files()
+        # Clean the download copies
+        deleted_files = temp_files.clear()
         
         # Clean Gradio temp files
         temp_dir = tempfile.gettempdir()
@@ -815,132 +821,136 @@ def clean_all_temp_files():
         logger.error(error_message)
         return error_message
 
-def gen_img_helper(model, prompt, res, seed, scheduler, guidance_scale, num_inference_steps, shift, image_format):
-    global pipe, current_model
+def get_queue_metrics():
+    return {
+        "batching": batch_scheduler.metrics(),
+        "encoding": encoder_pool.metrics(),
+        "temp_files": temp_files.metrics(),
+    }
+
+def new_request_id():
+    return uuid.uuid4().hex
+
+def cancel_generation(request_id):
+    if request_id and batch_scheduler.cancel(request_id):
+        logger.info(f"Cancelling request {request_id}")
+        return "🛑 Cancelling..."
+    return "⚠️ Nothing to cancel"
+
+def gen_img_helper(model, prompt, res, seed, scheduler, guidance_scale, num_inference_steps, shift, image_format, show_previews=True, keep_latents=False, request_id=None):
     status_message = "Starting image generation..."
+    # also names the saved files, so images of one batch finishing in the same second don't overwrite each other
+    request_id = request_id or new_request_id()
 
     try:
-        # Clean up previous temporary files
-        status_message = "Cleaning up previous temporary files..."
-        logger.info(status_message)
-        clean_previous_temp_files()
-        status_message = "Previous temporary files cleaned."
-
         # Validate inputs
-        if not prompt or len(prompt.strip()) == 0:
-            raise ValueError("Prompt cannot be empty")
-        if not isinstance(seed, (int, float)) or seed < -1:
-            raise ValueError("Seed must be -1 or a non-negative integer")
-        if num_inference_steps < 1 or num_inference_steps > 100:
-            raise ValueError("Number of inference steps must be between 1 and 100")
-        if guidance_scale < 0 or guidance_scale > 10:
-            raise ValueError("Guidance scale must be between 0 and 10")
-        if shift < 1 or shift > 10:
-            raise ValueError("Shift must be between 1 and 10")
-        
-
+        validate_generation_params(prompt, seed, guidance_scale, num_inference_steps, shift)
+        key = PipelineRunner.key(model, scheduler, parse_resolution(res), num_inference_steps, guidance_scale, shift)
 
-        # 1. Check if the model matches loaded model, load the model if not
-        if model != current_model:
-            status_message = f"Unloading model {current_model}..."
-            logger.info(status_message)
-            if pipe is not None:
-                del pipe
-                torch.cuda.empty_cache()
-            
-            status_message = f"Loading model {model}..."
-            logger.info(status_message)
-            pipe, _ = load_models(model)
-            current_model = model
-            status_message = "Model loaded successfully!"
-            logger.info(status_message)
-
-        # 2. Update scheduler
-        config = MODEL_CONFIGS[model]
-        scheduler_map = {
-            "FlashFlowMatchEulerDiscreteScheduler": FlashFlowMatchEulerDiscreteScheduler,
-            "FlowUniPCMultistepScheduler": FlowUniPCMultistepScheduler
-        }
-        if scheduler not in scheduler_map:
-            raise ValueError(f"Invalid scheduler: {scheduler}")
-        scheduler_class = scheduler_map[scheduler]
-        device = pipe._execution_device
-
-        # Set scheduler with shift for flow-matching schedulers
-        pipe.scheduler = scheduler_class(num_train_timesteps=1000, shift=shift, use_dynamic_shifting=False)
-
-        # 3. Generate image
+        # 1. Queue the request; compatible requests are batched together on the scheduler thread
         status_message = "Generating image..."
         logger.info(status_message)
-        res = parse_resolution(res)
-        image, seed = generate_image(pipe, model, prompt, res, seed, guidance_scale, num_inference_steps)
+        yield None, gr.update(), gr.update(), gr.update(), status_message
+        previews = queue.Queue()
+        payload = {"prompt": prompt, "seed": int(seed)}
+        if show_previews:
+            payload["on_preview"] = lambda step, image: previews.put((step, image))
+        # the image and its latents share one name
+        output_stem = os.path.join(OUTPUT_DIR, f"output_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}_{request_id}")
+        latents_path = None
+        if keep_latents:
+            # saved by the runner so the image can be re-decoded later without denoising again
+            os.makedirs(OUTPUT_DIR, exist_ok=True)
+            latents_path = f"{output_stem}.safetensors"
+            payload["latents_path"] = latents_path
+        request = batch_scheduler.submit(key, payload, request_id=request_id)
+        # previews come once per transformer evaluation; heun/midpoint take two per step
+        evaluations = model_evaluations(scheduler, key[3])
         
-        # 4. Save image locally with selected format
-        status_message = "Saving image locally..."
-        logger.info(status_message)
-        os.makedirs(OUTPUT_DIR, exist_ok=True)
-        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        file_extension = image_format.lower()
-        output_path = os.path.join(OUTPUT_DIR, f"output_{timestamp}.{file_extension}")
-        if image_format == "JPEG":
-            image = image.convert("RGB")  # JPEG doesn't support RGBA
-        image.save(output_path, format=image_format)
-        logger.info(f"Image saved to {output_path}")
+        # Stream previews while the batch denoises
+        while not request.future.done():
+            try:
+                step, preview = previews.get(timeout=PREVIEW_POLL_SECONDS)
+            except queue.Empty:
+                continue
+            while not previews.empty():
+                step, preview = previews.get_nowait()  # skip stale previews if the UI fell behind
+            yield preview, gr.update(), gr.update(), gr.update(), f"🖌️ Denoising step {step + 1}/{evaluations}..."
+        image, seed = request.future.result()
         
-        # 5. Prepare image for download in selected format
-        status_message = "Preparing image for download..."
+        # 2. Encode once in the selected format and write the bytes both to the outputs folder and to a temp file
+        # for download; the image is shown while the encoder pool works
+        status_message = "Saving image..."
         logger.info(status_message)
-        download_filename = f"generated_image_{timestamp}.{file_extension}"
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f".{file_extension}", prefix="hdi1_") as temp_file:
-            if image_format == "JPEG":
-                image = image.convert("RGB")  # Ensure JPEG compatibility
-            image.save(temp_file, format=image_format)
-            temp_file_path = temp_file.name
-        logger.info(f"Temporary file created at {temp_file_path}")
+        file_extension = image_format.lower()
+        output_path = f"{output_stem}.{file_extension}"
+        temp_file_path = temp_files.new_path(f"{request_id}.{file_extension}")
+        saved = encoder_pool.save(image, image_format, [output_path, temp_file_path])
+        yield image, seed, gr.update(), gr.update(), status_message
+        saved.result()
+        logger.info(f"Image saved to {output_path}, download copy at {temp_file_path}")
         
         status_message = "🎉 Image generation complete!"
         logger.info(status_message)
-        return image, seed, f"💾 Image saved to: {output_path}", temp_file_path, status_message
+        save_message = f"💾 Image saved to: {output_path}"
+        if latents_path is not None:
+            save_message += f" | latents: {latents_path}"
+        yield image, seed, save_message, temp_file_path, status_message
+
+    except (CancelledError, GenerationCancelled):
+        status_message = "🛑 Generation cancelled"
+        logger.info(status_message)
+        yield None, None, None, None, status_message
 
     except Exception as e:
         error_message = f"❌ Error: {str(e)}"
         logger.error(error_message)
-        return None, None, None, None, error_message
-
-def generate_image(pipe, model_type, prompt, resolution, seed, guidance_scale, num_inference_steps):
-    try:
-        # Parse resolution
-        width, height = resolution
-
-        # Handle seed
-        if seed == -1:
-            seed = torch.randint(0, 1000000, (1,)).item()
-        
-        generator = torch.Generator("cuda").manual_seed(seed)
-        
-        # Common parameters
-        params = {
-            "prompt": prompt,
-            "height": height,
-            "width": width,
-            "guidance_scale": guidance_scale,
-            "num_inference_steps": num_inference_steps,
-            "num_images_per_prompt": 1,
-            "generator": generator
-        }
-
-        images = pipe(**params).images
-        return images[0], seed
-    except Exception as e:
-        raise RuntimeError(f"Image generation failed: {str(e)}") from e
+        yield None, None, None, None, error_message
 
 if __name__ == "__main__":
     logging.getLogger("transformers.modeling_utils").setLevel(logging.ERROR)
     logging.getLogger("httpx").setLevel(logging.WARNING)
     
-    # Initialize globals without loading model
-    current_model = None
-    pipe = None
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--api-port", type=int, default=None,
+                        help="Also serve the HTTP API on this port, sharing the loaded model with the UI")
+    parser.add_argument("--api-host", type=str, default="127.0.0.1")
+    parser.add_argument("--vae-decode", type=str, default="auto", choices=VAE_DECODE_MODES,
+                        help="VAE decode strategy; auto picks full, sliced or tiled decode from the free memory")
+    parser.add_argument("--pipelined-decode", action="store_true",
+                        help="Decode each batch in the background while the next one denoises")
+    parser.add_argument("--continuous-batching", action="store_true",
+                        help="Admit and retire requests between denoising steps instead of batching whole generations")
+    parser.add_argument("--png-compress-level", type=int, default=DEFAULT_ENCODE_OPTIONS["PNG"]["compress_level"],
+                        choices=range(10), help="zlib level for PNG output (lossless; 1 is several times faster than 6 but larger)")
+    parser.add_argument("--jpeg-quality", type=int, default=DEFAULT_ENCODE_OPTIONS["JPEG"]["quality"])
+    parser.add_argument("--webp-quality", type=int, default=DEFAULT_ENCODE_OPTIONS["WEBP"]["quality"])
+    parser.add_argument("--schedules", type=str, nargs="+", default=[],
+                        help="Tuned sigma schedules (JSON files or directories) to offer as extra schedulers")
+    args = parser.parse_args()
+
+    # tuned schedules are listed after the built-in schedulers
+    load_schedules(args.schedules)
+    SCHEDULER_OPTIONS = scheduler_names()
+    
+    # The model is loaded lazily by the runner on the first request
+    runner = PipelineRunner(
+        preview_every=PREVIEW_EVERY_N_STEPS,
+        vae_decode_mode=args.vae_decode,
+        pipelined_decode=args.pipelined_decode,
+    )
+    if args.continuous_batching:
+        batch_scheduler = ContinuousBatchScheduler(ContinuousPipelineEngine(runner), max_batch_size=MAX_BATCH_SIZE).start()
+    else:
+        batch_scheduler = MicroBatchScheduler(runner, max_batch_size=MAX_BATCH_SIZE, max_wait=BATCH_WAIT_SECONDS).start()
+    encoder_pool = ImageEncoderPool(IMAGE_ENCODER_THREADS, {
+        "PNG": {"compress_level": args.png_compress_level},
+        "JPEG": {"quality": args.jpeg_quality},
+        "WEBP": {"quality": args.webp_quality},
+    })
+    temp_files = OutputFileManager(max_age=TEMP_FILE_MAX_AGE_SECONDS, max_files=TEMP_FILE_MAX_COUNT).start()
+    if args.api_port is not None:
+        start_api_server(batch_scheduler, args.api_host, args.api_port, encoder_pool=encoder_pool)
 
     # Create Gradio interface with forced theme
     custom_theme = gr.themes.Soft(
@@ -979,7 +989,8 @@ if __name__ == "__main__":
                     choices=SCHEDULER_OPTIONS,
                     value="FlashFlowMatchEulerDiscreteScheduler",
                     label="🔄 Scheduler Algorithm",
-                    info="Flow-matching schedulers provide stable, high-quality results optimized for HiDream"
+                    info="Flow-matching schedulers provide stable, high-quality results optimized for HiDream; "
+                         "FlowHeunDiscreteScheduler, heun and midpoint evaluate the model twice per step (about 2x the time)"
                 )
                 
                 gr.Markdown("### 🎨 Creative Input")
@@ -1007,6 +1018,18 @@ if __name__ == "__main__":
                     info="PNG: Best quality | JPEG: Smaller files | WEBP: Modern compression"
                 )
                 
+                show_previews = gr.Checkbox(
+                    value=True,
+                    label="👁️ Live Previews",
+                    info="Show a fast low-resolution preview after every denoising step"
+                )
+                
+                keep_latents = gr.Checkbox(
+                    value=False,
+                    label="🧬 Save Latents",
+                    info="Keep the denoised latents next to the image to re-decode later (python -m hdi1 --decode-latents)"
+                )
+                
                 gr.Markdown("### 🔧 Advanced Settings")
                 seed = gr.Number(
                     label="🎲 Seed (-1 for random)", 
@@ -1043,6 +1066,7 @@ if __name__ == "__main__":
                 )
                 
                 generate_btn = gr.Button("🎨 Generate Image", variant="primary")
+                stop_btn = gr.Button("🛑 Stop", variant="stop")
                 cleanup_btn = gr.Button("🧹 Clean Temporary Files", variant="secondary")
                 
             with gr.Column(scale=1):
@@ -1078,18 +1102,39 @@ if __name__ == "__main__":
                     interactive=False, 
                     file_types=[".png", ".jpeg", ".webp"]
                 )
+                
+                with gr.Accordion("📈 Queue Metrics", open=False):
+                    queue_metrics = gr.JSON(label="Queue depth, wait times, batch sizes and image encode throughput")
+                    refresh_metrics_btn = gr.Button("🔄 Refresh Metrics", variant="secondary")
         
         # Event handlers
+        request_id = gr.State(None)
         
         generate_btn.click(
+            fn=new_request_id,
+            inputs=[],
+            outputs=[request_id]
+        ).then(
             fn=gen_img_helper,
-            inputs=[model_type, prompt, resolution, seed, scheduler, guidance_scale, num_inference_steps, shift, image_format],
-            outputs=[output_image, seed_used, save_path, download_file, status_message]
+            inputs=[model_type, prompt, resolution, seed, scheduler, guidance_scale, num_inference_steps, shift, image_format, show_previews, keep_latents, request_id],
+            outputs=[output_image, seed_used, save_path, download_file, status_message],
+            # let concurrent requests reach the batch scheduler instead of queueing one by one in Gradio
+            concurrency_limit=MAX_CONCURRENT_REQUESTS
+        )
+        stop_btn.click(
+            fn=cancel_generation,
+            inputs=[request_id],
+            outputs=[status_message]
         )
         cleanup_btn.click(
             fn=clean_all_temp_files,
             inputs=[],
             outputs=[status_message]
         )
+        refresh_metrics_btn.click(
+            fn=get_queue_metrics,
+            inputs=[],
+            outputs=[queue_metrics]
+        )
 
     demo.launch(share=False, show_api=False)
@@ -0,0 +1,112 @@
+import torch
+from torch import nn
+
+from hdi1.offload import BlockStreamer, stream_transformer_blocks
+
+
+class Block(nn.Module):
+    def __init__(self, index: int):
+        super().__init__()
+        self.index = index
+        self.linear = nn.Linear(4, 4)
+        self.register_buffer("scale", torch.full((4,), float(index + 1)))
+        self.seen = []
+
+    def forward(self, x):
+        self.seen.append(self.linear.weight.data_ptr())
+        return self.linear(x) * self.scale
+
+
+class TinyTransformer(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.x_embedder = nn.Linear(4, 4)
+        self.double_stream_blocks = nn.ModuleList([Block(i) for i in range(2)])
+        self.single_stream_blocks = nn.ModuleList([Block(i) for i in range(2, 5)])
+
+    def forward(self, x):
+        x = self.x_embedder(x)
+        for block in list(self.double_stream_blocks) + list(self.single_stream_blocks):
+            x = block(x)
+        return x
+
+
+def record_loads(streamer):
+    loads = []
+    load = streamer._load
+
+    def recording_load(i):
+        if streamer._resident[i] is None:
+            loads.append(i)
+        load(i)
+
+    streamer._load = recording_load
+    return loads
+
+
+def test_streamed_output_matches_resident_model():
+    torch.manual_seed(0)
+    model = TinyTransformer()
+    x = torch.randn(3, 4)
+    expected = model(x)
+
+    streamer = stream_transformer_blocks(model, "cpu", prefetch_depth=2)
+    torch.testing.assert_close(model(x), expected)
+    torch.testing.assert_close(model(x), expected)
+    assert streamer.stats["loads"] == streamer.stats["prefetch_hits"] + streamer.stats["stalls"] + 2
+
+
+def test_blocks_run_on_device_copies_and_return_to_host_buffers():
+    blocks = [Block(i) for i in range(4)]
+    streamer = BlockStreamer(blocks, "cpu", prefetch_depth=1).attach()
+    host_ptrs = [block.linear.weight.data_ptr() for block in blocks]
+
+    resident_during = []
+    for block in blocks:
+        block.register_forward_pre_hook(
+            lambda module, args: resident_during.append(
+                [k for k, tensors in enumerate(streamer._resident) if tensors is not None]
+            )
+        )
+    x = torch.randn(2, 4)
+    for block in blocks:
+        x = block(x)
+
+    for block, host_ptr in zip(blocks, host_ptrs):
+        # the block computed with a device copy, then got its host buffer back
+        assert block.seen[-1] != host_ptr
+        assert block.linear.weight.data_ptr() == host_ptr
+        assert block.linear.weight.device.type == "cpu"
+    # while block i runs, only block i and the next `prefetch_depth` blocks (wrapping around) are resident
+    assert resident_during == [[0, 1], [1, 2], [2, 3], [0, 3]]
+    assert all(tensors is None for tensors in streamer._resident[1:])
+
+
+def test_prefetch_order_wraps_across_steps():
+    blocks = [Block(i) for i in range(4)]
+    streamer = BlockStreamer(blocks, "cpu", prefetch_depth=2).attach()
+    loads = record_loads(streamer)
+
+    x = torch.randn(2, 4)
+    for _ in range(2):
+        for block in blocks:
+            block(x)
+
+    # block 0 stalls once; afterwards every block is loaded `prefetch_depth` blocks ahead, wrapping into the next step
+    assert loads == [0, 1, 2, 3, 0, 1, 2, 3, 0, 1]
+    assert streamer.stats["stalls"] == 1
+    assert streamer.stats["prefetch_hits"] == 7
+
+
+def test_prefetch_depth_zero_loads_on_demand():
+    blocks = [Block(i) for i in range(3)]
+    streamer = BlockStreamer(blocks, "cpu", prefetch_depth=0).attach()
+    loads = record_loads(streamer)
+
+    x = torch.randn(2, 4)
+    for block in blocks:
+        block(x)
+
+    assert loads == [0, 1, 2]
+    assert streamer.stats["stalls"] == 3
+    assert streamer.stats["prefetch_hits"] == 0
@@ -0,0 +1,69 @@
+import json
+import math
+
+import pytest
+import torch
+
+from hdi1.schedulers import registry
+from hdi1.schedulers.registry import SigmaSchedule, make_scheduler, register_schedule, schedule_sigmas
+
+
+@pytest.fixture
+def schedules():
+    yield registry.SCHEDULES
+    registry.SCHEDULES.clear()
+
+
+def run_schedule(name: str, shift: float = 3.0):
+    scheduler = make_scheduler(name, shift)
+    scheduler.set_timesteps(sigmas=schedule_sigmas(name), device="cpu")
+    generator = torch.Generator().manual_seed(0)
+    sample = torch.randn(1, 4, 8, 8, generator=generator)
+    for t in scheduler.timesteps:
+        model_output = torch.randn(sample.shape, generator=generator)
+        sample = scheduler.step(model_output, t, sample, return_dict=False)[0]
+    return scheduler, sample
+
+
+def test_preset_schedule_steps_through_dpm_solver(schedules, tmp_path):
+    path = tmp_path / "dpm-6.json"
+    path.write_text(json.dumps({
+        "scheduler": "dpm++2m",
+        "sigmas": [0.999, 0.95, 0.85, 0.7, 0.45, 0.2],
+        "shift": 1.0,
+    }))
+    register_schedule(SigmaSchedule.load(str(path)))
+
+    scheduler, sample = run_schedule("dpm-6")
+
+    assert scheduler.config.solver_order == 2
+    assert len(scheduler.timesteps) == 6
+    assert scheduler.sigmas[0].item() == pytest.approx(0.999)
+    assert torch.isfinite(sample).all()
+
+
+@pytest.mark.parametrize("scheduler_name", ["dpm++3m", "deis", "unipc-bh1"])
+def test_shifted_schedule_stays_finite(schedules, scheduler_name):
+    # shifting moves every sigma but 1 towards 1; the log-SNR solvers must still see finite values
+    register_schedule(SigmaSchedule("tuned", scheduler_name, [0.999, 0.9, 0.7, 0.5, 0.3, 0.1]))
+
+    _, sample = run_schedule("tuned", shift=6.0)
+
+    assert torch.isfinite(sample).all()
+
+
+@pytest.mark.parametrize("sigmas", [[1.0, 0.5, 0.1], [0.9, 0.5, 0.0], [0.9, 0.9, 0.1], [0.5, 0.7]])
+def test_invalid_sigmas_are_rejected(sigmas):
+    with pytest.raises(ValueError):
+        SigmaSchedule("bad", "dpm++2m", sigmas)
+
+
+def test_captured_schedule_starts_below_one():
+    scheduler = make_scheduler("FlashFlowMatchEulerDiscreteScheduler", 3.0)
+    scheduler.set_timesteps(8, device="cpu")
+
+    schedule = SigmaSchedule.from_scheduler("captured", "FlashFlowMatchEulerDiscreteScheduler", scheduler)
+
+    assert schedule.sigmas[0] <= registry.MAX_SCHEDULE_SIGMA
+    assert len(schedule.sigmas) == 8
+    assert all(math.isfinite(sigma) for sigma in schedule.sigmas)
@@ -0,0 +1,100 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from hdi1 import nf4
+
+
+class FakeTokenizer:
+    pad_token = None
+    eos_token = "<eos>"
+
+    @classmethod
+    def from_pretrained(cls, name):
+        return cls()
+
+    def __call__(self, prompts, max_length, **kwargs):
+        # the second half of every row is padding and must not count
+        attention_mask = torch.zeros(len(prompts), max_length, dtype=torch.long)
+        attention_mask[:, : max_length // 2] = 1
+        return SimpleNamespace(input_ids=torch.zeros_like(attention_mask), attention_mask=attention_mask)
+
+
+class FakeEncoder:
+    device = torch.device("cpu")
+
+    def __init__(self, hidden_states):
+        self.hidden_states = hidden_states
+
+    def __call__(self, input_ids, attention_mask, output_hidden_states):
+        assert output_hidden_states
+        return SimpleNamespace(hidden_states=self.hidden_states)
+
+
+def hidden_states(num_layers=3, batch=2, seq_len=128, dim=16):
+    generator = torch.Generator().manual_seed(0)
+    # index 0 is the embedding output, which the pipeline never uses
+    return [torch.randn(batch, seq_len, dim, generator=generator) for _ in range(num_layers + 1)]
+
+
+@pytest.fixture
+def encoders(monkeypatch):
+    loaded = {}
+
+    def load_text_encoder(quant, device="auto"):
+        return FakeEncoder(loaded[quant])
+
+    monkeypatch.setattr(nf4, "PreTrainedTokenizerFast", FakeTokenizer)
+    monkeypatch.setattr(nf4, "load_text_encoder", load_text_encoder)
+    return loaded
+
+
+def test_matching_embeddings_keep_the_quantized_encoder(encoders):
+    reference = hidden_states()
+    encoders["bf16"] = reference
+    encoders["nf4"] = [layer * 1.5 for layer in reference]
+
+    report = nf4.check_text_encoder_quality("nf4", prompts=["a", "b"])
+
+    # a uniform scale changes the relative error, but not the direction
+    assert report["min_layer_cosine"] == pytest.approx(1.0)
+    assert report["mean_rel_error"] == pytest.approx(0.5, rel=1e-4)
+    assert report["passed"]
+    assert report["text_encoder_quant"] == "nf4"
+
+
+def test_one_bad_layer_falls_back_to_bf16(encoders):
+    reference = hidden_states()
+    candidate = [layer.clone() for layer in reference]
+    candidate[2] = -candidate[2]
+    encoders["bf16"] = reference
+    encoders["int8"] = candidate
+
+    report = nf4.check_text_encoder_quality("int8", prompts=["a", "b"])
+
+    assert report["mean_cosine"] == pytest.approx(1 / 3, abs=1e-4)
+    assert report["worst_layer"] == 1
+    assert not report["passed"]
+    assert report["text_encoder_quant"] == "bf16"
+
+
+def test_threshold_is_inclusive_and_ignores_padding(encoders):
+    reference = hidden_states()
+    candidate = [layer.clone() for layer in reference]
+    for layer in candidate[1:]:
+        # zero out half of the features of the attended tokens only: cos = 1/sqrt(2) there
+        layer[:, :64, :8] = 0
+        layer[:, 64:] = torch.randn(layer[:, 64:].shape)
+    encoders["bf16"] = reference
+    encoders["cpu-int8"] = candidate
+
+    report = nf4.check_text_encoder_quality("cpu-int8", prompts=["a", "b"], min_cosine=0.5)
+    cosine = report["min_layer_cosine"]
+    assert 0.5 < cosine < 0.9
+    assert report["passed"]
+
+    assert nf4.check_text_encoder_quality("cpu-int8", prompts=["a", "b"], min_cosine=cosine)["passed"]
+    report = nf4.check_text_encoder_quality("cpu-int8", prompts=["a", "b"], min_cosine=cosine + 1e-3)
+    assert not report["passed"]
+    assert report["text_encoder_quant"] == "bf16"